@@ -1,14 +1,88 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
-from models.model import conectar_db, criar_banco
-from models.auth import hash_senha, verificar_senha
+from flask import Flask, Response, g, render_template, request, redirect, url_for, session, flash, jsonify, make_response, get_flashed_messages
+from models.model import conectar_db, liberar_conexao, estatisticas_pool, repetir_se_ocupado, lendo_da_replica, somente_leitura
+from models.catalogo import listar_disponiveis, buscar_produtos, decodificar_cursor, por_pagina_valido, obter_produto, descartar_cache_local, estatisticas_catalogo, geracao_catalogo
+from models.cache import CacheLRU
+from models.migracoes import aplicar_migracoes, verificar_versao, cli as db_cli
+from models.carrinho import Dono, dono_carrinho, obter_armazenamento, iniciar_limpeza_carrinhos, cli as carrinho_cli
+from models.reservas import iniciar_limpeza_reservas
+from models.pedidos import finalizar_pedido, listar_pedidos, exportar_pedidos, FORMATOS_EXPORTACAO, CarrinhoVazio, EstoqueInsuficiente, cli as pedidos_cli
+from models.auth import hash_senha, verificar_senha, precisa_rehash, ServicoSenhaOcupado
+from models.metricas import instrumentar, texto_metricas
+from models.replica import iniciar_atualizacao_replica
+from models.tarefas import cli as tarefas_cli
+from models.sessoes import criar_interface_sessao, cli as sessoes_cli
+from models.importacao import cli as catalogo_cli
+from models.fragmentos import configurar_templates, estatisticas_fragmentos
+from models.limites import admitir, verificar, penalizar, vaga_checkout, estatisticas_limites
+from routes.api import api
 import sqlite3
 from functools import wraps
+from werkzeug.middleware.proxy_fix import ProxyFix
+import hashlib
+import hmac
+import ipaddress
 import os
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'sua-chave-secreta-mude-em-producao')
+# Com SESSAO_BACKEND=sqlite|memoria o cookie leva só um id opaco
+app.session_interface = criar_interface_sessao()
+configurar_templates(app)
 
-criar_banco()
+instrumentar(app)
+app.teardown_appcontext(liberar_conexao)
+app.cli.add_command(db_cli)
+app.cli.add_command(carrinho_cli)
+app.cli.add_command(pedidos_cli)
+app.cli.add_command(tarefas_cli)
+app.cli.add_command(sessoes_cli)
+app.cli.add_command(catalogo_cli)
+app.register_blueprint(api)
+
+# Atrás do Nginx o IP do cliente vem no X-Forwarded-For; sem isto todos os
+# acessos teriam o IP do proxy e dividiriam os mesmos limites.
+PROXIES_CONFIAVEIS = int(os.environ.get('PROXIES_CONFIAVEIS', '0'))
+if PROXIES_CONFIAVEIS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIAVEIS, x_proto=PROXIES_CONFIAVEIS)
+
+# /metrics e /status/* mostram SQL, configuração e carga: só para as redes
+# listadas (o Prometheus, por exemplo) ou com Authorization: Bearer <token>
+STATUS_REDES = [
+    ipaddress.ip_network(rede.strip())
+    for rede in os.environ.get('STATUS_REDES', '127.0.0.0/8,::1/128').split(',') if rede.strip()
+]
+STATUS_TOKEN = os.environ.get('STATUS_TOKEN', '')
+
+# As migrações rodam uma vez (flask db upgrade ou on_starting do gunicorn);
+# cada worker apenas confere a versão do schema, ao iniciar ou na primeira
+# requisição. Importar o app (comandos flask db, python app.py) não confere.
+schema_conferido = {'pid': None}
+
+def conferir_schema():
+    if schema_conferido['pid'] == os.getpid():
+        return
+    schema_conferido['pid'] = os.getpid()
+    versao_schema, versao_schema_esperada = verificar_versao()
+    if versao_schema < versao_schema_esperada:
+        app.logger.warning(
+            'Schema do banco na versão %s, esperada %s. Execute "flask db upgrade".',
+            versao_schema, versao_schema_esperada
+        )
+
+def acesso_interno(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        try:
+            endereco = ipaddress.ip_address(request.remote_addr or '')
+        except ValueError:
+            endereco = None
+        if endereco is not None and any(endereco in rede for rede in STATUS_REDES):
+            return f(*args, **kwargs)
+        autorizacao = request.headers.get('Authorization', '').encode()
+        if STATUS_TOKEN and hmac.compare_digest(autorizacao, f'Bearer {STATUS_TOKEN}'.encode()):
+            return f(*args, **kwargs)
+        return Response('Acesso restrito.\n', status=403, mimetype='text/plain')
+    return decorated_function
 
 def login_required(f):
     @wraps(f)
@@ -19,6 +93,50 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def muitas_tentativas(template, espera):
+    flash('Muitas tentativas. Aguarde alguns instantes e tente novamente.', 'warning')
+    return render_template(template), 429, {'Retry-After': str(max(1, round(espera)))}
+
+@app.before_request
+def tarefas_de_fundo():
+    conferir_schema()
+    iniciar_limpeza_carrinhos()
+    iniciar_limpeza_reservas()
+    iniciar_atualizacao_replica()
+
+paginas_catalogo = CacheLRU(int(os.environ.get('PAGINAS_CACHE_TAMANHO', '512')))
+
+def cache_catalogo(f):
+    # Páginas do catálogo para visitantes sem mensagens pendentes: o HTML é
+    # o mesmo para todos enquanto a geração do catálogo não mudar.
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('cliente_id') or session.get('_flashes'):
+            return f(*args, **kwargs)
+        
+        chave = (request.path, request.query_string, geracao_catalogo())
+        pagina = paginas_catalogo.obter(chave)
+        
+        if pagina is None:
+            resposta = make_response(f(*args, **kwargs))
+            if resposta.status_code != 200 or get_flashed_messages():
+                return resposta
+            html = resposta.get_data()
+            pagina = (html, hashlib.sha1(html).hexdigest())
+            paginas_catalogo.definir(chave, pagina)
+        
+        html, etag = pagina
+        if request.if_none_match.contains(etag):
+            resposta = make_response('', 304)
+        else:
+            resposta = make_response(html)
+        resposta.set_etag(etag)
+        resposta.cache_control.public = True
+        resposta.cache_control.max_age = 0
+        resposta.cache_control.must_revalidate = True
+        return resposta
+    return decorated_function
+
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -30,6 +148,13 @@ def login():
             flash('Por favor, preencha todos os campos.', 'danger')
             return render_template('login.html')
         
+        # Antes do hash e do banco: uma rajada de tentativas é recusada aqui.
+        # A conta só perde fichas nas senhas erradas.
+        conta = email.strip().lower()
+        espera = admitir('login_ip', request.remote_addr) or verificar('login_conta', conta)
+        if espera:
+            return muitas_tentativas('login.html', espera)
+        
         conexao = conectar_db()
         cursor = conexao.cursor()
         
@@ -39,69 +164,34 @@ def login():
             
             if cliente and verificar_senha(senha, cliente['senha_hash']):
                 cliente_id = cliente['id']
+                
+                # Hash legado ou com custo antigo: regrava com os parâmetros atuais
+                if precisa_rehash(cliente['senha_hash']):
+                    try:
+                        cursor.execute('UPDATE clientes SET senha_hash = ? WHERE id = ?', (hash_senha(senha), cliente_id))
+                        conexao.commit()
+                    except (sqlite3.Error, ServicoSenhaOcupado):
+                        conexao.rollback()
+                
                 session['cliente_id'] = cliente_id
                 session['cliente_nome'] = cliente['nome']
                 session['cliente_email'] = cliente['email']
                 
                 try:
-                    cursor.execute('''
-                        SELECT id, produto_id, nome_produto, preco_unitario, quantidade
-                        FROM carrinho_compras
-                        WHERE cliente_id IS NULL
-                    ''')
-                    itens_visitante = cursor.fetchall()
-                    
-                    if itens_visitante:
-                        for item_visitante in itens_visitante:
-                            item_id_visitante = item_visitante['id']
-                            produto_id = item_visitante['produto_id']
-                            quantidade_visitante = item_visitante['quantidade']
-                            
-                            cursor.execute('''
-                                SELECT id, quantidade FROM carrinho_compras
-                                WHERE cliente_id = ? AND produto_id = ?
-                            ''', (cliente_id, produto_id))
-                            item_existente = cursor.fetchone()
-                            
-                            if item_existente:
-                                nova_quantidade = item_existente['quantidade'] + quantidade_visitante
-                                
-                                cursor.execute('SELECT estoque FROM produtos WHERE id = ?', (produto_id,))
-                                produto = cursor.fetchone()
-                                
-                                if produto and nova_quantidade <= produto['estoque']:
-                                    cursor.execute('''
-                                        UPDATE carrinho_compras
-                                        SET quantidade = ?
-                                        WHERE id = ?
-                                    ''', (nova_quantidade, item_existente['id']))
-                                else:
-                                    pass
-                                
-                                cursor.execute('''
-                                    DELETE FROM carrinho_compras
-                                    WHERE id = ?
-                                ''', (item_id_visitante,))
-                            else:
-                                cursor.execute('''
-                                    UPDATE carrinho_compras
-                                    SET cliente_id = ?
-                                    WHERE id = ?
-                                ''', (cliente_id, item_id_visitante))
-                        
-                        conexao.commit()
+                    if session.get('session_id'):
+                        obter_armazenamento().mesclar(session.pop('session_id'), cliente_id)
                 except sqlite3.Error as e:
-                    conexao.rollback()
                     pass
                 
                 flash(f'Bem-vindo, {cliente["nome"]}!', 'success')
                 return redirect(url_for('index'))
             else:
+                penalizar('login_conta', conta)
                 flash('Email ou senha incorretos.', 'danger')
+        except ServicoSenhaOcupado:
+            flash('Muitos acessos no momento. Tente novamente em instantes.', 'warning')
         except sqlite3.Error as e:
             flash(f'Erro ao fazer login: {e}', 'danger')
-        finally:
-            conexao.close()
     
     return render_template('login.html')
 
@@ -117,6 +207,10 @@ def registrar():
             flash('Por favor, preencha todos os campos obrigatórios.', 'danger')
             return render_template('registrar.html')
         
+        espera = admitir('registro_ip', request.remote_addr)
+        if espera:
+            return muitas_tentativas('registrar.html', espera)
+        
         conexao = conectar_db()
         cursor = conexao.cursor()
         
@@ -135,11 +229,11 @@ def registrar():
             
             flash('Cadastro realizado com sucesso! Faça login para continuar.', 'success')
             return redirect(url_for('login'))
+        except ServicoSenhaOcupado:
+            flash('Muitos acessos no momento. Tente novamente em instantes.', 'warning')
         except sqlite3.Error as e:
             flash(f'Erro ao cadastrar: {e}', 'danger')
             conexao.rollback()
-        finally:
-            conexao.close()
     
     return render_template('registrar.html')
 
@@ -151,29 +245,36 @@ def logout():
 
 
 @app.route('/')
+@somente_leitura(replica=True)
+@cache_catalogo
 def index():
     conexao = conectar_db()
-    cursor = conexao.cursor()
+    busca = request.args.get('q', '').strip()
+    apos = decodificar_cursor(request.args.get('cursor'))
+    por_pagina = por_pagina_valido(request.args.get('por_pagina', type=int))
+    # Lida antes dos produtos: versiona os cards em cache no template
+    geracao = geracao_catalogo(conexao)
     
     try:
-        cursor.execute('SELECT id, nome, descricao, preco, estoque FROM produtos WHERE estoque > 0 ORDER BY nome')
-        produtos = cursor.fetchall()
+        if busca:
+            produtos, proximo = buscar_produtos(conexao, busca, apos, por_pagina)
+        else:
+            produtos, proximo = listar_disponiveis(conexao, apos, por_pagina)
     except sqlite3.Error as e:
         flash(f'Erro ao carregar produtos: {e}', 'danger')
-        produtos = []
-    finally:
-        conexao.close()
+        produtos, proximo = [], None
     
-    return render_template('index.html', produtos=produtos)
+    return render_template('index.html', produtos=produtos, proximo=proximo, busca=busca,
+                           por_pagina=por_pagina, paginado=apos is not None, geracao=geracao)
 
 @app.route('/produto/<int:id>')
+@somente_leitura(replica=True)
+@cache_catalogo
 def produto_detalhes(id):
     conexao = conectar_db()
-    cursor = conexao.cursor()
     
     try:
-        cursor.execute('SELECT id, nome, descricao, preco, estoque FROM produtos WHERE id = ?', (id,))
-        produto = cursor.fetchone()
+        produto = obter_produto(conexao, id)
         
         if not produto:
             flash('Produto não encontrado.', 'danger')
@@ -181,154 +282,87 @@ def produto_detalhes(id):
     except sqlite3.Error as e:
         flash(f'Erro ao carregar produto: {e}', 'danger')
         return redirect(url_for('index'))
-    finally:
-        conexao.close()
     
     return render_template('produto_detalhes.html', produto=produto)
 
 
 @app.route('/carrinho', methods=['GET', 'POST'])
+@somente_leitura()
 def carrinho():
-    conexao = conectar_db()
-    cursor = conexao.cursor()
+    armazenamento = obter_armazenamento()
     
     if request.method == 'POST':
         acao = request.form.get('acao')
-        produto_id = request.form.get('produto_id')
+        produto_id = request.form.get('produto_id', type=int)
         quantidade = request.form.get('quantidade', type=int)
         
         if acao == 'adicionar':
-            cursor.execute('SELECT id, nome, preco, estoque FROM produtos WHERE id = ?', (produto_id,))
+            conexao = conectar_db()
+            cursor = conexao.cursor()
+            cursor.execute('SELECT id, nome, preco FROM produtos WHERE id = ?', (produto_id,))
             produto = cursor.fetchone()
             
             if not produto:
                 flash('Produto não encontrado.', 'danger')
                 return redirect(url_for('index'))
             
-            if quantidade > produto['estoque']:
-                flash(f'Quantidade solicitada ({quantidade}) excede o estoque disponível ({produto["estoque"]}).', 'danger')
+            if not quantidade or quantidade <= 0:
+                flash('Quantidade deve ser maior que zero.', 'danger')
                 return redirect(url_for('produto_detalhes', id=produto_id))
             
-            cliente_id = session.get('cliente_id')
+            # A validação do estoque é a própria reserva, feita pelo carrinho
+            dono = dono_carrinho(criar=True)
+            adicionado, nova_quantidade = armazenamento.adicionar(dono, produto, quantidade)
             
-            if cliente_id:
-                cursor.execute(
-                    'SELECT id, quantidade FROM carrinho_compras WHERE cliente_id = ? AND produto_id = ?',
-                    (cliente_id, produto_id)
-                )
-            else:
-                session_id = session.get('session_id', '')
-                cursor.execute(
-                    'SELECT id, quantidade FROM carrinho_compras WHERE cliente_id IS NULL AND produto_id = ?',
-                    (produto_id,)
-                )
-            
-            item_existente = cursor.fetchone()
-            
-            if item_existente:
-                nova_quantidade = item_existente['quantidade'] + quantidade
-                if nova_quantidade > produto['estoque']:
-                    flash(f'Quantidade total ({nova_quantidade}) excede o estoque disponível ({produto["estoque"]}).', 'danger')
-                    return redirect(url_for('produto_detalhes', id=produto_id))
-                
-                cursor.execute(
-                    'UPDATE carrinho_compras SET quantidade = ? WHERE id = ?',
-                    (nova_quantidade, item_existente['id'])
-                )
-            else:
-                if cliente_id:
-                    cursor.execute(
-                        'INSERT INTO carrinho_compras (cliente_id, produto_id, nome_produto, preco_unitario, quantidade) VALUES (?, ?, ?, ?, ?)',
-                        (cliente_id, produto_id, produto['nome'], produto['preco'], quantidade)
-                    )
-                else:
-                    cursor.execute(
-                        'INSERT INTO carrinho_compras (cliente_id, produto_id, nome_produto, preco_unitario, quantidade) VALUES (NULL, ?, ?, ?, ?)',
-                        (produto_id, produto['nome'], produto['preco'], quantidade)
-                    )
+            if not adicionado:
+                disponivel = armazenamento.disponivel(dono, produto_id)
+                flash(f'Quantidade total ({nova_quantidade}) excede o estoque disponível ({disponivel}).', 'danger')
+                return redirect(url_for('produto_detalhes', id=produto_id))
             
-            conexao.commit()
             flash('Produto adicionado ao carrinho!', 'success')
             return redirect(url_for('carrinho'))
         
         elif acao == 'remover':
-            item_id = request.form.get('item_id')
-            cliente_id = session.get('cliente_id')
+            item_id = request.form.get('item_id', type=int)
+            dono = dono_carrinho()
             
-            if cliente_id:
-                cursor.execute('DELETE FROM carrinho_compras WHERE id = ? AND cliente_id = ?', (item_id, cliente_id))
-            else:
-                cursor.execute('DELETE FROM carrinho_compras WHERE id = ? AND cliente_id IS NULL', (item_id,))
+            if dono:
+                armazenamento.remover(dono, item_id)
             
-            conexao.commit()
             flash('Item removido do carrinho.', 'info')
             return redirect(url_for('carrinho'))
         
         elif acao == 'atualizar':
-            item_id = request.form.get('item_id')
+            item_id = request.form.get('item_id', type=int)
             nova_quantidade = request.form.get('quantidade', type=int)
             
             if nova_quantidade <= 0:
                 flash('Quantidade deve ser maior que zero.', 'danger')
                 return redirect(url_for('carrinho'))
             
-            cursor.execute('SELECT produto_id, quantidade FROM carrinho_compras WHERE id = ?', (item_id,))
-            item = cursor.fetchone()
+            dono = dono_carrinho()
+            item = armazenamento.obter_item(dono, item_id) if dono else None
             
             if item:
-                cursor.execute('SELECT estoque FROM produtos WHERE id = ?', (item['produto_id'],))
-                produto = cursor.fetchone()
-                
-                if nova_quantidade > produto['estoque']:
-                    flash(f'Quantidade solicitada excede o estoque disponível ({produto["estoque"]}).', 'danger')
+                if not armazenamento.atualizar(dono, item_id, nova_quantidade):
+                    disponivel = armazenamento.disponivel(dono, item['produto_id'])
+                    flash(f'Quantidade solicitada excede o estoque disponível ({disponivel}).', 'danger')
                     return redirect(url_for('carrinho'))
                 
-                cliente_id = session.get('cliente_id')
-                if cliente_id:
-                    cursor.execute(
-                        'UPDATE carrinho_compras SET quantidade = ? WHERE id = ? AND cliente_id = ?',
-                        (nova_quantidade, item_id, cliente_id)
-                    )
-                else:
-                    cursor.execute(
-                        'UPDATE carrinho_compras SET quantidade = ? WHERE id = ? AND cliente_id IS NULL',
-                        (nova_quantidade, item_id)
-                    )
-                
-                conexao.commit()
                 flash('Quantidade atualizada!', 'success')
             
             return redirect(url_for('carrinho'))
     
-    cliente_id = session.get('cliente_id')
+    dono = dono_carrinho()
     
     try:
-        if cliente_id:
-            cursor.execute('''
-                SELECT c.id, c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade,
-                       (c.preco_unitario * c.quantidade) as subtotal
-                FROM carrinho_compras c
-                WHERE c.cliente_id = ?
-                ORDER BY c.criado_em DESC
-            ''', (cliente_id,))
-        else:
-            cursor.execute('''
-                SELECT c.id, c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade,
-                       (c.preco_unitario * c.quantidade) as subtotal
-                FROM carrinho_compras c
-                WHERE c.cliente_id IS NULL
-                ORDER BY c.criado_em DESC
-            ''')
-        
-        itens = cursor.fetchall()
+        itens = armazenamento.listar(dono) if dono else []
         
         total = sum(item['subtotal'] for item in itens)
     except sqlite3.Error as e:
         flash(f'Erro ao carregar carrinho: {e}', 'danger')
         itens = []
         total = 0
-    finally:
-        conexao.close()
     
     return render_template('carrinho.html', itens=itens, total=total)
 
@@ -338,6 +372,8 @@ def checkout():
     conexao = conectar_db()
     cursor = conexao.cursor()
     cliente_id = session['cliente_id']
+    armazenamento = obter_armazenamento()
+    status, cabecalhos = 200, {}
     
     if request.method == 'POST':
         tipo_pagamento = request.form.get('tipo_pagamento')
@@ -346,71 +382,34 @@ def checkout():
             flash('Selecione um método de pagamento.', 'danger')
             return redirect(url_for('checkout'))
         
-        try:
-            cursor.execute('''
-                SELECT produto_id, nome_produto, preco_unitario, quantidade
-                FROM carrinho_compras
-                WHERE cliente_id = ?
-            ''', (cliente_id,))
-            itens_carrinho = cursor.fetchall()
-            
-            if not itens_carrinho:
-                flash('Seu carrinho está vazio.', 'warning')
-                return redirect(url_for('carrinho'))
-            
-            for item in itens_carrinho:
-                cursor.execute('SELECT estoque FROM produtos WHERE id = ?', (item['produto_id'],))
-                produto = cursor.fetchone()
-                
-                if not produto or produto['estoque'] < item['quantidade']:
-                    flash(f'Produto "{item["nome_produto"]}" sem estoque suficiente.', 'danger')
+        with vaga_checkout() as admitido:
+            if admitido:
+                try:
+                    pedido_id = repetir_se_ocupado(
+                        lambda: finalizar_pedido(conexao, cliente_id, tipo_pagamento, armazenamento)
+                    )
+                except CarrinhoVazio:
+                    flash('Seu carrinho está vazio.', 'warning')
                     return redirect(url_for('carrinho'))
-            
-            total = sum(item['preco_unitario'] * item['quantidade'] for item in itens_carrinho)
-            
-            cursor.execute(
-                'INSERT INTO pedidos (cliente_id, status) VALUES (?, ?)',
-                (cliente_id, 'pendente')
-            )
-            pedido_id = cursor.lastrowid
-            
-            for item in itens_carrinho:
-                cursor.execute(
-                    'INSERT INTO itens_pedido (pedido_id, produto_id, quantidade, preco_unitario) VALUES (?, ?, ?, ?)',
-                    (pedido_id, item['produto_id'], item['quantidade'], item['preco_unitario'])
-                )
-                
-                cursor.execute(
-                    'UPDATE produtos SET estoque = estoque - ? WHERE id = ?',
-                    (item['quantidade'], item['produto_id'])
-                )
-            
-            cursor.execute(
-                'INSERT INTO pagamentos (pedido_id, tipo, valor, status) VALUES (?, ?, ?, ?)',
-                (pedido_id, tipo_pagamento, total, 'aguardando')
-            )
-            
-            cursor.execute('DELETE FROM carrinho_compras WHERE cliente_id = ?', (cliente_id,))
-            
-            conexao.commit()
+                except EstoqueInsuficiente as e:
+                    flash(str(e), 'danger')
+                    return redirect(url_for('carrinho'))
+                except sqlite3.Error as e:
+                    flash(f'Erro ao processar pedido: {e}', 'danger')
+                    return redirect(url_for('carrinho'))
+        
+        if admitido:
+            armazenamento.esvaziar(Dono(cliente_id, None))
+            descartar_cache_local()
             flash(f'Pedido #{pedido_id} criado com sucesso!', 'success')
             return redirect(url_for('pedido_detalhes', id=pedido_id))
-            
-        except sqlite3.Error as e:
-            flash(f'Erro ao processar pedido: {e}', 'danger')
-            conexao.rollback()
-            return redirect(url_for('carrinho'))
-        finally:
-            conexao.close()
+        
+        # Sem vaga: a resposta sai na hora, com o checkout pronto para tentar de novo
+        flash('Muitos pedidos sendo processados agora. Tente novamente em instantes.', 'warning')
+        status, cabecalhos = 503, {'Retry-After': '1'}
     
     try:
-        cursor.execute('''
-            SELECT c.id, c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade,
-                   (c.preco_unitario * c.quantidade) as subtotal
-            FROM carrinho_compras c
-            WHERE c.cliente_id = ?
-        ''', (cliente_id,))
-        itens = cursor.fetchall()
+        itens = armazenamento.listar(Dono(cliente_id, None))
         
         if not itens:
             flash('Seu carrinho está vazio.', 'warning')
@@ -424,26 +423,30 @@ def checkout():
     except sqlite3.Error as e:
         flash(f'Erro ao carregar checkout: {e}', 'danger')
         return redirect(url_for('carrinho'))
-    finally:
-        conexao.close()
     
-    return render_template('checkout.html', itens=itens, total=total, cliente=cliente)
+    return render_template('checkout.html', itens=itens, total=total, cliente=cliente), status, cabecalhos
 
 @app.route('/pedido/<int:id>')
 @login_required
+@somente_leitura(replica=True)
 def pedido_detalhes(id):
-    conexao = conectar_db()
-    cursor = conexao.cursor()
     cliente_id = session['cliente_id']
     
     try:
-        cursor.execute('''
-            SELECT p.id, p.data, p.status, c.nome as cliente_nome
-            FROM pedidos p
-            JOIN clientes c ON p.cliente_id = c.id
-            WHERE p.id = ? AND p.cliente_id = ?
-        ''', (id, cliente_id))
-        pedido = cursor.fetchone()
+        for tentativa in range(2):
+            cursor = conectar_db().cursor()
+            cursor.execute('''
+                SELECT p.id, p.data, p.status, p.total, c.nome as cliente_nome
+                FROM pedidos p
+                JOIN clientes c ON p.cliente_id = c.id
+                WHERE p.id = ? AND p.cliente_id = ?
+            ''', (id, cliente_id))
+            pedido = cursor.fetchone()
+            
+            # Pedido recém-criado ainda não copiado para a réplica: lê do principal
+            if pedido or not lendo_da_replica():
+                break
+            g.leitura = 'ro'
         
         if not pedido:
             flash('Pedido não encontrado.', 'danger')
@@ -462,15 +465,67 @@ def pedido_detalhes(id):
         cursor.execute('SELECT tipo, valor, status FROM pagamentos WHERE pedido_id = ?', (id,))
         pagamento = cursor.fetchone()
         
-        total = sum(item['subtotal'] for item in itens)
+        total = pedido['total']
         
     except sqlite3.Error as e:
         flash(f'Erro ao carregar pedido: {e}', 'danger')
         return redirect(url_for('index'))
-    finally:
-        conexao.close()
     
     return render_template('pedido_detalhes.html', pedido=pedido, itens=itens, pagamento=pagamento, total=total)
 
+@app.route('/pedidos')
+@login_required
+@somente_leitura()
+def pedidos():
+    antes = request.args.get('antes', type=int)
+    
+    try:
+        lista, proximo = listar_pedidos(conectar_db(), session['cliente_id'], antes)
+    except sqlite3.Error as e:
+        flash(f'Erro ao carregar pedidos: {e}', 'danger')
+        lista, proximo = [], None
+    
+    return render_template('pedidos.html', pedidos=lista, proximo=proximo, paginado=antes is not None)
+
+@app.route('/pedidos/exportar')
+@login_required
+def exportar_historico():
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS_EXPORTACAO:
+        flash('Formato de exportação inválido.', 'danger')
+        return redirect(url_for('pedidos'))
+    
+    # O corpo é gerado enquanto é enviado, um lote de pedidos por vez
+    return Response(
+        exportar_pedidos(session['cliente_id'], formato),
+        mimetype=FORMATOS_EXPORTACAO[formato],
+        headers={'Content-Disposition': f'attachment; filename=pedidos.{formato}'}
+    )
+
+@app.route('/status/pool')
+@acesso_interno
+def status_pool():
+    return jsonify(estatisticas_pool())
+
+@app.route('/status/catalogo')
+@acesso_interno
+def status_catalogo():
+    estatisticas = estatisticas_catalogo()
+    estatisticas['paginas'] = paginas_catalogo.estatisticas()
+    estatisticas['fragmentos'] = estatisticas_fragmentos(app)
+    return jsonify(estatisticas)
+
+@app.route('/status/limites')
+@acesso_interno
+def status_limites():
+    return jsonify(estatisticas_limites())
+
+@app.route('/metrics')
+@acesso_interno
+def metrics():
+    # Formato texto do Prometheus, somando todos os workers do gunicorn
+    return Response(texto_metricas(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
+    aplicar_migracoes()
     app.run(debug=True, host='0.0.0.0', port=5000)
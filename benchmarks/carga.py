@@ -0,0 +1,307 @@
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PALAVRAS = (
+    'notebook', 'mouse', 'teclado', 'monitor', 'webcam', 'headset', 'ssd', 'placa',
+    'smartphone', 'tablet', 'relogio', 'fone', 'caixa', 'roteador', 'impressora',
+    'camera', 'drone', 'hub', 'cabo', 'carregador', 'suporte', 'microfone',
+)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def preparar_banco(caminho, produtos, estoque):
+    env = dict(os.environ, DB_PATH=caminho)
+    subprocess.run(
+        [sys.executable, '-c', 'from models.migracoes import aplicar_migracoes; aplicar_migracoes()'],
+        cwd=RAIZ, env=env, check=True,
+    )
+
+    conexao = sqlite3.connect(caminho)
+    existentes = conexao.execute('SELECT COUNT(*) FROM produtos').fetchone()[0]
+    aleatorio = random.Random(42)
+
+    def linhas():
+        for i in range(existentes, produtos):
+            nome = f'{aleatorio.choice(PALAVRAS).title()} {aleatorio.choice(PALAVRAS)} {i:07d}'
+            descricao = ' '.join(aleatorio.choice(PALAVRAS) for _ in range(8))
+            yield nome, descricao, round(aleatorio.uniform(10, 5000), 2), estoque
+
+    conexao.executemany('INSERT INTO produtos (nome, descricao, preco, estoque) VALUES (?, ?, ?, ?)', linhas())
+    conexao.execute('UPDATE produtos SET estoque = ?', (estoque,))
+    conexao.execute('UPDATE catalogo_versao SET geracao = geracao + 1 WHERE id = 1')
+    conexao.commit()
+    conexao.close()
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def iniciar_servidor(args, caminho, porta):
+    # Todos os usuários simulados vêm de 127.0.0.1: sem limites de login
+    env = dict(os.environ, DB_PATH=caminho, GUNICORN_MODO=args.modo)
+    env.setdefault('LIMITES_ATIVOS', '0')
+    if args.workers:
+        env['GUNICORN_WORKERS'] = str(args.workers)
+    if args.threads:
+        env['GUNICORN_THREADS'] = str(args.threads)
+
+    if args.servidor == 'gunicorn' and shutil.which('gunicorn'):
+        comando = ['gunicorn', '-c', 'gunicorn_config.py', '--bind', f'127.0.0.1:{porta}',
+                   '--access-logfile', '/dev/null', '--log-level', 'warning']
+    else:
+        comando = [sys.executable, '-c',
+                   'import sys; from werkzeug.serving import run_simple; from app import app; '
+                   f'run_simple("127.0.0.1", {porta}, app, threaded=True)']
+
+    processo = subprocess.Popen(comando, cwd=RAIZ, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{porta}/', timeout=1).read()
+            return processo
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            if processo.poll() is not None:
+                raise RuntimeError(processo.stderr.read().decode())
+            time.sleep(0.2)
+    processo.terminate()
+    raise RuntimeError('Servidor não respondeu em 30s')
+
+
+class SemRedirecionamento(urllib.request.HTTPRedirectHandler):
+    # Cada requisição é medida sozinha; o 302 conta como resposta
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Usuario:
+    def __init__(self, base, produtos, resultados, aleatorio):
+        self.base = base
+        self.produtos = produtos
+        self.resultados = resultados
+        self.aleatorio = aleatorio
+        self.navegador = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            SemRedirecionamento(),
+        )
+
+    def requisitar(self, rota, caminho, dados=None):
+        corpo = urllib.parse.urlencode(dados).encode() if dados is not None else None
+        inicio = time.perf_counter()
+        erro = False
+        conteudo = b''
+        location = None
+        try:
+            resposta = self.navegador.open(self.base + caminho, corpo, timeout=60)
+            conteudo = resposta.read()
+        except urllib.error.HTTPError as e:
+            location = e.headers.get('Location')
+            erro = e.code >= 400
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            erro = True
+        self.resultados.registrar(rota, time.perf_counter() - inicio, erro)
+        return conteudo, location
+
+    def navegar(self):
+        conteudo, _ = self.requisitar('GET /', '/')
+        cursor = None
+        marcador = b'cursor='
+        if marcador in conteudo:
+            inicio = conteudo.index(marcador) + len(marcador)
+            cursor = conteudo[inicio:conteudo.index(b'"', inicio)].decode()
+        if cursor:
+            self.requisitar('GET /?cursor', '/?cursor=' + cursor)
+        self.requisitar('GET /?q', '/?q=' + self.aleatorio.choice(PALAVRAS))
+        for _ in range(self.aleatorio.randint(1, 4)):
+            self.requisitar('GET /produto/<id>', f'/produto/{self.aleatorio.choice(self.produtos)}')
+
+    def comprar(self, numero):
+        escolhidos = self.aleatorio.sample(self.produtos, 3)
+        for produto_id in escolhidos:
+            self.requisitar('POST /carrinho adicionar', '/carrinho',
+                            {'acao': 'adicionar', 'produto_id': produto_id, 'quantidade': 1})
+        conteudo, _ = self.requisitar('GET /carrinho', '/carrinho')
+
+        itens = []
+        marcador = b'name="item_id" value="'
+        posicao = conteudo.find(marcador)
+        while posicao >= 0:
+            inicio = posicao + len(marcador)
+            itens.append(conteudo[inicio:conteudo.index(b'"', inicio)].decode())
+            posicao = conteudo.find(marcador, inicio)
+        if itens:
+            self.requisitar('POST /carrinho atualizar', '/carrinho',
+                            {'acao': 'atualizar', 'item_id': itens[0], 'quantidade': 2})
+            self.requisitar('POST /carrinho remover', '/carrinho',
+                            {'acao': 'remover', 'item_id': itens[-1]})
+
+        email = f'carga-{os.getpid()}-{numero}@exemplo.com'
+        self.requisitar('POST /registrar', '/registrar',
+                        {'nome': 'Carga', 'email': email, 'senha': 'senha-de-carga'})
+        self.requisitar('POST /login', '/login', {'email': email, 'senha': 'senha-de-carga'})
+        self.requisitar('GET /checkout', '/checkout')
+        _, location = self.requisitar('POST /checkout', '/checkout', {'tipo_pagamento': 'pix'})
+        if location and '/pedido/' in location:
+            self.requisitar('GET /pedido/<id>', urllib.parse.urlparse(location).path)
+        self.requisitar('GET /logout', '/logout')
+
+
+class Resultados:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {}
+        self.erros = {}
+
+    def registrar(self, rota, duracao, erro):
+        with self.lock:
+            self.latencias.setdefault(rota, []).append(duracao)
+            if erro:
+                self.erros[rota] = self.erros.get(rota, 0) + 1
+
+    def resumo(self, duracao):
+        rotas = {}
+        total = 0
+        for rota, valores in sorted(self.latencias.items()):
+            total += len(valores)
+            rotas[rota] = {
+                'requisicoes': len(valores),
+                'erros': self.erros.get(rota, 0),
+                'por_segundo': round(len(valores) / duracao, 2),
+                'p50_ms': round(statistics.median(valores) * 1000, 2),
+                'p95_ms': round(percentil(valores, 95) * 1000, 2),
+                'p99_ms': round(percentil(valores, 99) * 1000, 2),
+            }
+        return {'requisicoes': total, 'por_segundo': round(total / duracao, 2), 'rotas': rotas}
+
+
+def executar_carga(args, base, produtos):
+    resultados = Resultados()
+    fim = time.monotonic() + args.duracao
+    contador = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def sessao(indice):
+        aleatorio = random.Random(args.semente + indice)
+        while time.monotonic() < fim:
+            with lock:
+                numero = next(contador)
+            usuario = Usuario(base, produtos, resultados, aleatorio)
+            usuario.navegar()
+            if aleatorio.random() < args.compradores:
+                usuario.comprar(numero)
+
+    inicio = time.monotonic()
+    threads = [threading.Thread(target=sessao, args=(i,)) for i in range(args.usuarios)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return resultados.resumo(time.monotonic() - inicio)
+
+
+def comparar(atual, anterior, tolerancia):
+    regressoes = []
+    print(f'\n{"rota":28} {"p95 antes":>10} {"p95 agora":>10} {"req/s antes":>12} {"req/s agora":>12}')
+    for rota, dados in atual['rotas'].items():
+        antes = anterior['rotas'].get(rota)
+        if not antes:
+            continue
+        print(f'{rota:28} {antes["p95_ms"]:10.1f} {dados["p95_ms"]:10.1f} {antes["por_segundo"]:12.1f} {dados["por_segundo"]:12.1f}')
+        if dados['p95_ms'] > antes['p95_ms'] * (1 + tolerancia / 100):
+            regressoes.append(rota)
+    return regressoes
+
+
+def imprimir(resumo):
+    print(f'\n{"rota":28} {"req":>7} {"erros":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for rota, dados in resumo['rotas'].items():
+        print(f'{rota:28} {dados["requisicoes"]:7} {dados["erros"]:6} {dados["por_segundo"]:8.1f} '
+              f'{dados["p50_ms"]:8.1f} {dados["p95_ms"]:8.1f} {dados["p99_ms"]:8.1f}')
+    print(f'\ntotal: {resumo["requisicoes"]} requisições, {resumo["por_segundo"]} req/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Carga com a jornada completa do cliente contra app:app.')
+    parser.add_argument('--produtos', type=int, default=5000, help='tamanho do catálogo semeado')
+    parser.add_argument('--estoque', type=int, default=100000)
+    parser.add_argument('--usuarios', type=int, default=20, help='usuários simultâneos')
+    parser.add_argument('--duracao', type=float, default=30, help='segundos de carga')
+    parser.add_argument('--compradores', type=float, default=0.2, help='fração das sessões que compram')
+    parser.add_argument('--servidor', choices=('gunicorn', 'werkzeug'), default='gunicorn')
+    parser.add_argument('--modo', choices=('sync', 'gthread'), default='sync')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--semente', type=int, default=1)
+    parser.add_argument('--banco', help='reaproveita este arquivo SQLite em vez de um temporário')
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    parser.add_argument('--comparar', help='JSON de uma execução anterior')
+    parser.add_argument('--tolerancia', type=float, default=10, help='%% de piora do p95 aceita em --comparar')
+    args = parser.parse_args()
+
+    diretorio = None
+    caminho = args.banco
+    if not caminho:
+        diretorio = tempfile.mkdtemp(prefix='carga-')
+        caminho = os.path.join(diretorio, 'ecommerce.db')
+
+    try:
+        preparar_banco(caminho, args.produtos, args.estoque)
+        with sqlite3.connect(caminho) as conexao:
+            produtos = [linha[0] for linha in conexao.execute('SELECT id FROM produtos')]
+
+        porta = porta_livre()
+        servidor = iniciar_servidor(args, caminho, porta)
+        try:
+            resumo = executar_carga(args, f'http://127.0.0.1:{porta}', produtos)
+        finally:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+    finally:
+        if diretorio:
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    resultado = {
+        'configuracao': {chave: valor for chave, valor in vars(args).items() if chave not in ('saida', 'comparar')},
+        'executado_em': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        **resumo,
+    }
+    imprimir(resultado)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, indent=2, ensure_ascii=False)
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as arquivo:
+            regressoes = comparar(resultado, json.load(arquivo), args.tolerancia)
+        if regressoes:
+            print(f'\nRegressão de p95 acima de {args.tolerancia}%: {", ".join(regressoes)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
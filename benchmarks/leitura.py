@@ -0,0 +1,187 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.catalogo import SQL_PRIMEIRA_PAGINA
+from models.migracoes import migrar
+from models.pedidos import finalizar_pedido
+from models.pool import obter_pool
+from models.replica import atualizar_replica
+
+MODOS = ('primario', 'ro', 'replica')
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def preparar_banco(caminho, produtos, compradores):
+    conexao = sqlite3.connect(caminho)
+    migrar(conexao)
+    conexao.executemany(
+        'INSERT INTO produtos (nome, descricao, preco, estoque) VALUES (?, ?, ?, ?)',
+        ((f'Produto {i:07d}', f'Descrição do produto {i}', 10 + i % 500, 10 ** 9) for i in range(produtos))
+    )
+    # os produtos da migração também: o estoque não acaba durante a medição
+    conexao.execute('UPDATE produtos SET estoque = ?', (10 ** 9,))
+    conexao.executemany(
+        'INSERT INTO clientes (nome, email, senha_hash) VALUES (?, ?, ?)',
+        ((f'Comprador {i}', f'comprador{i}@exemplo.com', 'x') for i in range(compradores))
+    )
+    conexao.commit()
+    ids = [linha[0] for linha in conexao.execute('SELECT id FROM produtos')]
+    clientes = [linha[0] for linha in conexao.execute('SELECT id FROM clientes')]
+    conexao.close()
+    return ids, clientes
+
+
+def leitor(modo, banco, replica, produtos, fim, resultados):
+    # Cada operação é o que /produto/<id> e / fazem sem cache: um produto
+    # pelo id e a primeira página do catálogo.
+    if modo == 'primario':
+        pool = obter_pool(banco)
+    elif modo == 'ro':
+        pool = obter_pool(banco, somente_leitura=True)
+    else:
+        pool = obter_pool(replica, somente_leitura=True)
+
+    aleatorio = random.Random(os.getpid())
+    latencias = []
+    while time.time() < fim:
+        inicio = time.perf_counter()
+        conexao = pool.obter()
+        try:
+            conexao.execute(
+                'SELECT id, nome, descricao, preco, estoque FROM produtos WHERE id = ?',
+                (aleatorio.choice(produtos),)
+            ).fetchone()
+            conexao.execute(SQL_PRIMEIRA_PAGINA, (25,)).fetchall()
+        finally:
+            conexao.close()
+        latencias.append(time.perf_counter() - inicio)
+    resultados.put(('leitor', latencias))
+
+
+def comprador(banco, cliente_id, produtos, fim, resultados):
+    pool = obter_pool(banco)
+    aleatorio = random.Random(cliente_id)
+    pedidos = 0
+    while time.time() < fim:
+        conexao = pool.obter()
+        try:
+            for produto_id in aleatorio.sample(produtos, 3):
+                conexao.execute(
+                    'INSERT INTO carrinho_compras (cliente_id, produto_id, nome_produto, preco_unitario, quantidade) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (cliente_id, produto_id, f'Produto {produto_id}', 10.0, 1)
+                )
+            conexao.commit()
+            finalizar_pedido(conexao, cliente_id, 'pix')
+            pedidos += 1
+        except sqlite3.OperationalError:
+            conexao.rollback()
+        finally:
+            conexao.close()
+    resultados.put(('comprador', pedidos))
+
+
+def copiador(banco, replica, intervalo, fim, resultados):
+    copias = 0
+    while time.time() < fim:
+        inicio = time.perf_counter()
+        if atualizar_replica(banco, replica):
+            copias += 1
+        time.sleep(max(0.0, intervalo - (time.perf_counter() - inicio)))
+    resultados.put(('copiador', copias))
+
+
+def executar(modo, args, banco, replica, produtos, clientes):
+    contexto = multiprocessing.get_context('fork')
+    resultados = contexto.Queue()
+    fim = time.time() + args.duracao
+    processos = [
+        contexto.Process(target=leitor, args=(modo, banco, replica, produtos, fim, resultados))
+        for _ in range(args.leitores)
+    ]
+    processos += [
+        contexto.Process(target=comprador, args=(banco, cliente_id, produtos, fim, resultados))
+        for cliente_id in clientes[:args.compradores]
+    ]
+    if modo == 'replica':
+        atualizar_replica(banco, replica)
+        processos.append(contexto.Process(target=copiador, args=(banco, replica, args.intervalo, fim, resultados)))
+
+    for processo in processos:
+        processo.start()
+
+    latencias = []
+    pedidos = 0
+    copias = 0
+    for _ in processos:
+        tipo, valor = resultados.get()
+        if tipo == 'leitor':
+            latencias.extend(valor)
+        elif tipo == 'comprador':
+            pedidos += valor
+        else:
+            copias = valor
+    for processo in processos:
+        processo.join()
+
+    return {
+        'modo': modo,
+        'leituras_por_segundo': round(len(latencias) / args.duracao, 1),
+        'leitura_p50_ms': round(statistics.median(latencias) * 1000, 3),
+        'leitura_p99_ms': round(percentil(latencias, 99) * 1000, 3),
+        'checkouts_por_segundo': round(pedidos / args.duracao, 1),
+        'copias_replica': copias,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Vazão de leitura do catálogo com checkouts concorrentes, por modo de DB_LEITURA.')
+    parser.add_argument('--modos', nargs='+', choices=MODOS, default=list(MODOS))
+    parser.add_argument('--produtos', type=int, default=20000)
+    parser.add_argument('--leitores', type=int, default=4, help='processos lendo o catálogo')
+    parser.add_argument('--compradores', type=int, default=2, help='processos fechando pedidos sem parar')
+    parser.add_argument('--duracao', type=float, default=10, help='segundos por modo')
+    parser.add_argument('--intervalo', type=float, default=5, help='DB_REPLICA_INTERVALO usado no modo replica')
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp(prefix='leitura-')
+    try:
+        banco = os.path.join(diretorio, 'ecommerce.db')
+        replica = os.path.join(diretorio, 'ecommerce-replica.db')
+        produtos, clientes = preparar_banco(banco, args.produtos, args.compradores)
+
+        linhas = []
+        for modo in args.modos:
+            linhas.append(executar(modo, args, banco, replica, produtos, clientes))
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    print(f'{"modo":10} {"leituras/s":>11} {"p50 ms":>8} {"p99 ms":>8} {"checkouts/s":>12} {"cópias":>7}')
+    for linha in linhas:
+        print(f'{linha["modo"]:10} {linha["leituras_por_segundo"]:11.1f} {linha["leitura_p50_ms"]:8.3f} '
+              f'{linha["leitura_p99_ms"]:8.3f} {linha["checkouts_por_segundo"]:12.1f} {linha["copias_replica"]:7}')
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'configuracao': vars(args), 'resultados': linhas}, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def decidir(args):
+    # Um "worker": decisões de login com IPs e contas variados, mais
+    # entradas e saídas do checkout, todas no mesmo arquivo compartilhado
+    processo, decisoes = args
+    from models.limites import admitir, penalizar, vaga_checkout, verificar
+    tempos = {'admitir': [], 'verificar_penalizar': [], 'vaga_checkout': []}
+    for i in range(decisoes):
+        ip = f'10.{processo}.{i % 256}.{i % 7}'
+        conta = f'cliente{i % 5000}@exemplo.com'
+
+        inicio = time.perf_counter()
+        admitir('login_ip', ip)
+        tempos['admitir'].append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        if not verificar('login_conta', conta):
+            penalizar('login_conta', conta)
+        tempos['verificar_penalizar'].append(time.perf_counter() - inicio)
+
+        inicio = time.perf_counter()
+        with vaga_checkout():
+            pass
+        tempos['vaga_checkout'].append(time.perf_counter() - inicio)
+    return tempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latência das decisões de limite de taxa e de vagas de checkout com vários processos.')
+    parser.add_argument('--processos', type=int, default=4)
+    parser.add_argument('--decisoes', type=int, default=20000, help='decisões de cada tipo por processo')
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp(prefix='limites-')
+    os.environ['LIMITES_ARQUIVO'] = os.path.join(diretorio, 'limites.bin')
+    os.environ.setdefault('METRICAS_ATIVAS', '0')
+    try:
+        from models.limites import reiniciar_limites
+        reiniciar_limites()
+        inicio = time.perf_counter()
+        with multiprocessing.Pool(args.processos) as pool:
+            resultados = pool.map(decidir, [(processo, args.decisoes) for processo in range(args.processos)])
+        duracao = time.perf_counter() - inicio
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    linhas = []
+    for operacao in resultados[0]:
+        tempos = [tempo for resultado in resultados for tempo in resultado[operacao]]
+        linhas.append({
+            'operacao': operacao,
+            'p50_us': round(statistics.median(tempos) * 1e6, 2),
+            'p99_us': round(percentil(tempos, 99) * 1e6, 2),
+        })
+    total = args.processos * args.decisoes * len(linhas)
+
+    print(f'{args.processos} processos, {total} decisões em {duracao:.2f} s ({total / duracao:.0f}/s)')
+    print(f'{"operação":20} {"p50 µs":>8} {"p99 µs":>8}')
+    for linha in linhas:
+        print(f'{linha["operacao"]:20} {linha["p50_us"]:8.2f} {linha["p99_us"]:8.2f}')
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'configuracao': vars(args), 'decisoes_por_segundo': round(total / duracao), 'latencias': linhas}, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
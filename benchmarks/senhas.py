@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CUSTOS = (
+    ('scrypt', {'SENHA_SCRYPT_N': 2 ** 13}),
+    ('scrypt', {'SENHA_SCRYPT_N': 2 ** 14}),
+    ('scrypt', {'SENHA_SCRYPT_N': 2 ** 15}),
+    ('pbkdf2_sha256', {'SENHA_PBKDF2_ITERACOES': 100000}),
+    ('pbkdf2_sha256', {'SENHA_PBKDF2_ITERACOES': 300000}),
+    ('pbkdf2_sha256', {'SENHA_PBKDF2_ITERACOES': 600000}),
+)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def configurar(auth, algoritmo, parametros):
+    auth.SENHA_ALGORITMO = algoritmo
+    for nome, valor in parametros.items():
+        setattr(auth, nome, valor)
+
+
+def medir_vazao(auth, amostras):
+    algoritmo, parametros = auth.parametros_atuais()
+    inicio = time.perf_counter()
+    for _ in range(amostras):
+        auth.calcular_hash(algoritmo, parametros, 'senha-de-teste', b'0123456789abcdef')
+    return amostras / (time.perf_counter() - inicio)
+
+
+def medir_logins(auth, logins, concorrencia):
+    # Rajada de logins: cada thread verifica senhas como o login() faria
+    senha_hash = auth.hash_senha('senha-de-teste')
+    latencias = []
+    recusados = []
+    lock = threading.Lock()
+    restantes = iter(range(logins))
+
+    def usuario():
+        while True:
+            with lock:
+                if next(restantes, None) is None:
+                    return
+            inicio = time.perf_counter()
+            try:
+                auth.verificar_senha('senha-de-teste', senha_hash)
+            except auth.ServicoSenhaOcupado:
+                with lock:
+                    recusados.append(time.perf_counter() - inicio)
+                continue
+            with lock:
+                latencias.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=usuario) for _ in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duracao = time.perf_counter() - inicio
+
+    return {
+        'logins_por_segundo': round(len(latencias) / duracao, 2),
+        'recusados': len(recusados),
+        'p50_ms': round(statistics.median(latencias) * 1000, 2) if latencias else None,
+        'p99_ms': round(percentil(latencias, 99) * 1000, 2) if latencias else None,
+    }
+
+
+def medir_rajada(args):
+    # Latência do catálogo sozinho e durante uma rajada de logins contra o
+    # gunicorn de verdade: os logins não podem tomar todos os workers
+    from benchmarks.carga import SemRedirecionamento, iniciar_servidor, porta_livre, preparar_banco
+
+    diretorio = tempfile.mkdtemp(prefix='rajada-')
+    caminho = os.path.join(diretorio, 'ecommerce.db')
+    os.environ['LIMITES_ARQUIVO'] = os.path.join(diretorio, 'limites.bin')
+    if args.concorrentes_definido:
+        os.environ['SENHA_CONCORRENTES'] = str(args.concorrentes)
+    try:
+        preparar_banco(caminho, 1000, 1000)
+        porta = porta_livre()
+        servidor = iniciar_servidor(args, caminho, porta)
+        base = f'http://127.0.0.1:{porta}'
+        try:
+            navegador = urllib.request.build_opener(SemRedirecionamento())
+
+            def enviar(caminho_url, dados=None):
+                corpo = urllib.parse.urlencode(dados).encode() if dados is not None else None
+                try:
+                    return navegador.open(base + caminho_url, corpo, timeout=60).status
+                except urllib.error.HTTPError as e:
+                    return e.code
+
+            credenciais = {'nome': 'Rajada', 'email': 'rajada@exemplo.com', 'senha': 'senha-de-teste'}
+            enviar('/registrar', credenciais)
+
+            def fase(logins):
+                parar = threading.Event()
+                lock = threading.Lock()
+                catalogo = []
+                resultados = {'aceitos': 0, 'recusados': 0}
+
+                def cliente_catalogo(semente):
+                    aleatorio = random.Random(semente)
+                    while not parar.is_set():
+                        inicio = time.perf_counter()
+                        enviar(f'/produto/{aleatorio.randint(1, 1000)}')
+                        with lock:
+                            catalogo.append(time.perf_counter() - inicio)
+
+                def cliente_login():
+                    while not parar.is_set():
+                        # 302 = login feito; 200 = formulário de volta com o aviso
+                        status = enviar('/login', {'email': credenciais['email'], 'senha': credenciais['senha']})
+                        with lock:
+                            resultados['aceitos' if status == 302 else 'recusados'] += 1
+
+                threads = [threading.Thread(target=cliente_catalogo, args=(i,)) for i in range(args.catalogo)]
+                threads += [threading.Thread(target=cliente_login) for _ in range(logins)]
+                for thread in threads:
+                    thread.start()
+                time.sleep(args.duracao)
+                parar.set()
+                for thread in threads:
+                    thread.join()
+                resultados.update({
+                    'catalogo_por_segundo': round(len(catalogo) / args.duracao, 2),
+                    'catalogo_p50_ms': round(statistics.median(catalogo) * 1000, 2),
+                    'catalogo_p99_ms': round(percentil(catalogo, 99) * 1000, 2),
+                })
+                return resultados
+
+            resultados = {'sem_rajada': fase(0), 'com_rajada': fase(args.concorrencia)}
+        finally:
+            servidor.terminate()
+            servidor.wait(timeout=30)
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    for nome, resultado in resultados.items():
+        print(
+            f"{nome:12} catálogo {resultado['catalogo_por_segundo']:8.1f} req/s  "
+            f"p50 {resultado['catalogo_p50_ms']:8.1f} ms  p99 {resultado['catalogo_p99_ms']:8.1f} ms  "
+            f"logins {resultado['aceitos']} aceitos, {resultado['recusados']} recusados"
+        )
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Custo do hash de senhas por configuração.')
+    parser.add_argument('--amostras', type=int, default=20, help='hashes para medir a vazão de um processo')
+    parser.add_argument('--logins', type=int, default=100)
+    parser.add_argument('--concorrencia', type=int, default=16)
+    parser.add_argument('--concorrentes', type=int, help='SENHA_CONCORRENTES (0 = sem limite; padrão: o do app)')
+    parser.add_argument('--rajada', action='store_true', help='mede o catálogo com e sem uma rajada de --concorrencia logins no gunicorn')
+    parser.add_argument('--catalogo', type=int, default=4, help='clientes do catálogo em --rajada')
+    parser.add_argument('--duracao', type=float, default=10, help='segundos de cada fase em --rajada')
+    parser.add_argument('--servidor', choices=('gunicorn', 'werkzeug'), default='gunicorn')
+    parser.add_argument('--modo', choices=('sync', 'gthread'), default='sync')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--threads', type=int)
+    parser.add_argument('--saida', help='arquivo JSON com os resultados')
+    args = parser.parse_args()
+    args.concorrentes_definido = args.concorrentes is not None
+
+    if args.rajada:
+        resultados = medir_rajada(args)
+        if args.saida:
+            with open(args.saida, 'w', encoding='utf-8') as arquivo:
+                json.dump(resultados, arquivo, indent=2)
+        return
+
+    # As vagas de cálculo ficam no arquivo de limites: um só para a medição
+    diretorio = tempfile.mkdtemp(prefix='senhas-')
+    os.environ['LIMITES_ARQUIVO'] = os.path.join(diretorio, 'limites.bin')
+    if args.concorrentes_definido:
+        os.environ['SENHA_CONCORRENTES'] = str(args.concorrentes)
+    os.environ.setdefault('METRICAS_ATIVAS', '0')
+    resultados = []
+    try:
+        from models import auth
+        from models.limites import SENHA_CONCORRENTES, reiniciar_limites
+        reiniciar_limites()
+        for algoritmo, parametros in CUSTOS:
+            configurar(auth, algoritmo, parametros)
+            resultado = {
+                'algoritmo': algoritmo,
+                'parametros': parametros,
+                'concorrentes': SENHA_CONCORRENTES,
+                'hashes_por_segundo': round(medir_vazao(auth, args.amostras), 2),
+            }
+            resultado.update(medir_logins(auth, args.logins, args.concorrencia))
+            resultados.append(resultado)
+            print(
+                f"{algoritmo:14} {json.dumps(parametros):32} "
+                f"{resultado['hashes_por_segundo']:8.1f} hash/s  "
+                f"{resultado['logins_por_segundo']:8.1f} login/s  "
+                f"{resultado['recusados']:4} recusados  "
+                f"p50 {resultado['p50_ms'] or 0:8.1f} ms  p99 {resultado['p99_ms'] or 0:8.1f} ms"
+            )
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultados, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
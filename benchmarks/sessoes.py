@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+BACKENDS = ('cookie', 'sqlite', 'memoria')
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def medir(app, backend, requisicoes, alterar):
+    # Abre e salva a sessão como o Flask faz em cada requisição, sem a rota:
+    # só o custo da sessão entra na conta.
+    from models.sessoes import criar_interface_sessao
+    interface = criar_interface_sessao(backend).interna
+    nome = app.config['SESSION_COOKIE_NAME']
+
+    # Estado de um cliente logado com o carrinho de visitante já mesclado
+    with app.test_request_context('/') as contexto:
+        sessao = interface.open_session(app, contexto.request)
+        sessao.update(cliente_id=1, cliente_nome='Cliente de Teste', cliente_email='cliente@exemplo.com')
+        resposta = app.response_class()
+        interface.save_session(app, sessao, resposta)
+    cookie = resposta.headers['Set-Cookie'].split(';', 1)[0].split('=', 1)[1]
+
+    tempos = []
+    enviados = []
+    for i in range(requisicoes):
+        with app.test_request_context('/', headers={'Cookie': f'{nome}={cookie}'}) as contexto:
+            inicio = time.perf_counter()
+            sessao = interface.open_session(app, contexto.request)
+            sessao.get('cliente_id')
+            if alterar:
+                sessao['_flashes'] = [('success', f'Produto {i} adicionado ao carrinho!')]
+            resposta = app.response_class()
+            interface.save_session(app, sessao, resposta)
+            tempos.append(time.perf_counter() - inicio)
+        novo = resposta.headers.get('Set-Cookie')
+        if novo:
+            cookie = novo.split(';', 1)[0].split('=', 1)[1]
+            enviados.append(len(cookie))
+
+    if hasattr(getattr(interface, 'armazenamento', None), 'descarregar'):
+        interface.armazenamento.descarregar()
+
+    return {
+        'backend': backend,
+        'requisicao': 'altera' if alterar else 'le',
+        'p50_us': round(statistics.median(tempos) * 1e6, 1),
+        'p99_us': round(percentil(tempos, 99) * 1e6, 1),
+        'cookie_bytes': len(cookie),
+        'set_cookie_por_requisicao': round(len(enviados) / requisicoes, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Custo de abrir e salvar a sessão e tamanho do cookie, por SESSAO_BACKEND.')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--requisicoes', type=int, default=5000)
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp(prefix='sessoes-')
+    os.environ['DB_PATH'] = os.path.join(diretorio, 'ecommerce.db')
+    os.environ.setdefault('METRICAS_ATIVAS', '0')
+    try:
+        from models.migracoes import aplicar_migracoes
+        aplicar_migracoes()
+        from app import app
+
+        linhas = []
+        for backend in args.backends:
+            for alterar in (False, True):
+                linhas.append(medir(app, backend, args.requisicoes, alterar))
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    print(f'{"backend":8} {"requisição":10} {"p50 µs":>8} {"p99 µs":>8} {"cookie":>7} {"Set-Cookie/req":>15}')
+    for linha in linhas:
+        print(f'{linha["backend"]:8} {linha["requisicao"]:10} {linha["p50_us"]:8.1f} {linha["p99_us"]:8.1f} '
+              f'{linha["cookie_bytes"]:7} {linha["set_cookie_por_requisicao"]:15.2f}')
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'configuracao': vars(args), 'resultados': linhas}, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
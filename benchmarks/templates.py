@@ -0,0 +1,117 @@
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def medir_carga(app, repeticoes, com_bytecode):
+    # Tempo para um worker novo ter todos os templates prontos
+    from models.fragmentos import carregar_templates
+    tempos = []
+    for _ in range(repeticoes):
+        app.jinja_env.cache.clear()
+        if not com_bytecode:
+            app.jinja_env.bytecode_cache.clear()
+        inicio = time.perf_counter()
+        carregar_templates(app)
+        tempos.append(time.perf_counter() - inicio)
+    return statistics.median(tempos)
+
+
+def medir_render(app, template, contexto, renderizacoes):
+    from flask import render_template
+    tempos = []
+    with app.test_request_context('/'):
+        html = render_template(template, **contexto)
+        for _ in range(renderizacoes):
+            inicio = time.perf_counter()
+            render_template(template, **contexto)
+            tempos.append(time.perf_counter() - inicio)
+    return html, tempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Carga dos templates com e sem bytecode e render com e sem cache de fragmentos.')
+    parser.add_argument('--produtos', type=int, default=24, help='cards na página do catálogo')
+    parser.add_argument('--itens', type=int, default=10, help='linhas no carrinho')
+    parser.add_argument('--renderizacoes', type=int, default=2000)
+    parser.add_argument('--repeticoes', type=int, default=20, help='cargas de todos os templates por modo')
+    parser.add_argument('--saida', help='grava o resultado em JSON')
+    args = parser.parse_args()
+
+    diretorio = tempfile.mkdtemp(prefix='templates-')
+    os.environ['DB_PATH'] = os.path.join(diretorio, 'ecommerce.db')
+    os.environ['TEMPLATES_BYTECODE_DIR'] = os.path.join(diretorio, 'bytecode')
+    os.environ.setdefault('METRICAS_ATIVAS', '0')
+    os.makedirs(os.environ['TEMPLATES_BYTECODE_DIR'])
+    try:
+        from models.migracoes import aplicar_migracoes
+        aplicar_migracoes()
+        from app import app
+        from models.cache import CacheLRU
+
+        carga = {
+            'compilando_ms': round(medir_carga(app, args.repeticoes, False) * 1000, 2),
+            'bytecode_ms': round(medir_carga(app, args.repeticoes, True) * 1000, 2),
+        }
+
+        produtos = [
+            {'id': i, 'nome': f'Produto <{i}>', 'descricao': f'Descrição do produto {i}', 'preco': 10 + i * 1.5, 'estoque': i % 7}
+            for i in range(args.produtos)
+        ]
+        itens = [
+            {'id': i, 'produto_id': i, 'nome_produto': f'Produto {i}', 'preco_unitario': 10 + i, 'quantidade': 1 + i % 3,
+             'subtotal': (10 + i) * (1 + i % 3)}
+            for i in range(args.itens)
+        ]
+        paginas = (
+            ('index.html', {'produtos': produtos, 'proximo': 'x', 'busca': '', 'por_pagina': args.produtos,
+                            'paginado': False, 'geracao': 1}),
+            ('carrinho.html', {'itens': itens, 'total': sum(item['subtotal'] for item in itens)}),
+        )
+
+        linhas = []
+        for template, contexto in paginas:
+            referencia = None
+            for fragmentos in (False, True):
+                app.jinja_env.cache_fragmentos = CacheLRU(10000) if fragmentos else None
+                html, tempos = medir_render(app, template, contexto, args.renderizacoes)
+                # O cache não pode mudar o HTML
+                if referencia is None:
+                    referencia = html
+                elif html != referencia:
+                    raise SystemExit(f'{template}: HTML com cache de fragmentos difere do original')
+                linhas.append({
+                    'template': template,
+                    'fragmentos': fragmentos,
+                    'p50_ms': round(statistics.median(tempos) * 1000, 3),
+                    'p99_ms': round(percentil(tempos, 99) * 1000, 3),
+                })
+    finally:
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    print(f'carga de todos os templates: compilando {carga["compilando_ms"]:.2f} ms, do bytecode {carga["bytecode_ms"]:.2f} ms')
+    print(f'{"template":14} {"fragmentos":>10} {"p50 ms":>8} {"p99 ms":>8}')
+    for linha in linhas:
+        print(f'{linha["template"]:14} {"sim" if linha["fragmentos"] else "não":>10} {linha["p50_ms"]:8.3f} {linha["p99_ms"]:8.3f}')
+
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as arquivo:
+            json.dump({'configuracao': vars(args), 'carga': carga, 'render': linhas}, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,27 @@
 import multiprocessing
+import os
+import sqlite3
+import tempfile
 
-workers = multiprocessing.cpu_count() * 2 + 1
+# sync: um processo por requisição simultânea (padrão)
+# gthread: menos processos, cada um atendendo GUNICORN_THREADS requisições
+# em threads; bem mais usuários simultâneos por GB de RAM, já que o tempo
+# de cada requisição é quase todo espera de I/O do SQLite.
+modo = os.environ.get('GUNICORN_MODO', 'sync')
+
+if modo == 'gthread':
+    if sqlite3.threadsafety == 0:
+        raise RuntimeError('O SQLite deste Python não suporta uso em threads; use GUNICORN_MODO=sync')
+    worker_class = 'gthread'
+    threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+    workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() + 1))
+    # uma conexão por thread, mais folga para a limpeza em segundo plano
+    os.environ.setdefault('DB_POOL_TAMANHO', str(threads + 2))
+elif modo == 'sync':
+    worker_class = 'sync'
+    workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+else:
+    raise RuntimeError(f'GUNICORN_MODO inválido: {modo}')
 
 bind = "0.0.0.0:8000"
 
@@ -10,4 +31,62 @@ accesslog = "-"
 errorlog = "-"
 loglevel = "info"
 
-wsgi_app = "app:app"
\ No newline at end of file
+wsgi_app = "app:app"
+
+
+servidor_carrinhos = None
+
+
+def on_starting(server):
+    # Antes de importar models: o diretório das métricas é lido na importação
+    if not os.environ.get('METRICAS_DIR'):
+        os.environ['METRICAS_DIR'] = tempfile.mkdtemp(prefix='ecommerce-metricas-')
+    from models.metricas import limpar_diretorio
+    limpar_diretorio()
+
+    # Baldes dos limites de login/cadastro cheios e nenhuma vaga de checkout
+    # ou de senha presa
+    from models.limites import SENHA_CONCORRENTES, reiniciar_limites
+    reiniciar_limites()
+
+    # No sync cada hash ocupa um worker inteiro: com vagas para todos, uma
+    # rajada de logins deixaria o catálogo sem worker livre
+    if modo == 'sync' and not 0 < SENHA_CONCORRENTES < server.cfg.workers:
+        raise RuntimeError(f'No modo sync SENHA_CONCORRENTES deve ficar entre 1 e {server.cfg.workers - 1} (workers - 1)')
+
+    # Roda no master, antes do fork: os workers só conferem a versão
+    from models.migracoes import aplicar_migracoes
+    aplicar_migracoes(eco=server.log.info)
+
+    # Com DB_LEITURA=replica os workers já começam com uma cópia pronta
+    from models.model import DB_LEITURA
+    if DB_LEITURA == 'replica':
+        from models.replica import atualizar_replica
+        atualizar_replica()
+
+    # Com CARRINHO_BACKEND=memoria e CARRINHO_MEMORIA_ENDERECO os workers
+    # compartilham os carrinhos por este servidor; sem endereço, só com um worker
+    global servidor_carrinhos
+    from models.carrinho import iniciar_servidor_carrinhos
+    servidor_carrinhos = iniciar_servidor_carrinhos(server.cfg.workers)
+
+
+def post_worker_init(worker):
+    # Carrega todos os templates antes da primeira requisição (com o
+    # bytecode em disco só o primeiro worker compila) e confere o schema
+    from app import app, conferir_schema
+    from models.fragmentos import carregar_templates
+    carregar_templates(app)
+    conferir_schema()
+
+
+def worker_exit(server, worker):
+    # No worker: grava as últimas métricas antes de sair
+    from models.metricas import salvar
+    salvar()
+
+
+def child_exit(server, worker):
+    # No master: soma as métricas do worker encerrado ao total
+    from models.metricas import arquivar_worker
+    arquivar_worker(worker.pid)
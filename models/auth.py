@@ -1,16 +1,92 @@
 import hashlib
+import hmac
+import os
 import secrets
 
+from models.limites import vaga
+
+# Formatos armazenados em clientes.senha_hash:
+#   scrypt$<n>$<r>$<p>$<salt>$<hash>
+#   pbkdf2_sha256$<iteracoes>$<salt>$<hash>
+#   <salt>:<sha256>   (legado, regravado no próximo login)
+SENHA_ALGORITMO = os.environ.get('SENHA_ALGORITMO', 'scrypt')
+SENHA_SCRYPT_N = int(os.environ.get('SENHA_SCRYPT_N', str(2 ** 14)))
+SENHA_SCRYPT_R = int(os.environ.get('SENHA_SCRYPT_R', '8'))
+SENHA_SCRYPT_P = int(os.environ.get('SENHA_SCRYPT_P', '1'))
+SENHA_PBKDF2_ITERACOES = int(os.environ.get('SENHA_PBKDF2_ITERACOES', '600000'))
+
+# Quanto um login espera por uma vaga de cálculo (SENHA_CONCORRENTES, em
+# models/limites.py, vale para o servidor inteiro) antes de ser recusado.
+# No modo sync o worker parado esperando não atende mais ninguém: sem vaga,
+# recusa na hora. No gthread quem espera é só uma thread.
+SENHA_TIMEOUT = float(os.environ.get('SENHA_TIMEOUT', '2' if os.environ.get('GUNICORN_MODO') == 'gthread' else '0'))
+
+
+class ServicoSenhaOcupado(Exception):
+	pass
+
+
+def parametros_atuais():
+	if SENHA_ALGORITMO == 'scrypt':
+		return ('scrypt', (SENHA_SCRYPT_N, SENHA_SCRYPT_R, SENHA_SCRYPT_P))
+	if SENHA_ALGORITMO == 'pbkdf2_sha256':
+		return ('pbkdf2_sha256', (SENHA_PBKDF2_ITERACOES,))
+	raise ValueError(f'SENHA_ALGORITMO inválido: {SENHA_ALGORITMO}')
+
+
+def calcular_hash(algoritmo, parametros, senha, salt):
+	if algoritmo == 'scrypt':
+		n, r, p = parametros
+		return hashlib.scrypt(senha.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r + 2 ** 20, dklen=32)
+	if algoritmo == 'pbkdf2_sha256':
+		return hashlib.pbkdf2_hmac('sha256', senha.encode(), salt, parametros[0])
+	if algoritmo == 'sha256':
+		return hashlib.sha256((senha + salt.decode()).encode()).digest()
+	raise ValueError(f'Algoritmo de senha desconhecido: {algoritmo}')
+
+
+def _decompor(senha_hash_armazenada):
+	partes = senha_hash_armazenada.split('$')
+	if partes[0] == 'scrypt' and len(partes) == 6:
+		return 'scrypt', tuple(int(v) for v in partes[1:4]), bytes.fromhex(partes[4]), bytes.fromhex(partes[5])
+	if partes[0] == 'pbkdf2_sha256' and len(partes) == 4:
+		return 'pbkdf2_sha256', (int(partes[1]),), bytes.fromhex(partes[2]), bytes.fromhex(partes[3])
+	salt, hash_armazenado = senha_hash_armazenada.split(':')
+	return 'sha256', (), salt.encode(), bytes.fromhex(hash_armazenado)
+
+
+def _executar(algoritmo, parametros, senha, salt):
+	if algoritmo == 'sha256':
+		return calcular_hash(algoritmo, parametros, senha, salt)
+
+	# scrypt e pbkdf2 soltam o GIL: o cálculo roda na thread da requisição
+	# e a vaga só volta quando ele termina
+	with vaga('senha', espera=SENHA_TIMEOUT) as admitido:
+		if not admitido:
+			raise ServicoSenhaOcupado('Cálculos de senha esgotados no servidor')
+		return calcular_hash(algoritmo, parametros, senha, salt)
+
+
 def hash_senha(senha):
-	salt = secrets.token_hex(16)
-	senha_hash = hashlib.sha256((senha + salt).encode()).hexdigest()
-	return f"{salt}:{senha_hash}"
+	algoritmo, parametros = parametros_atuais()
+	salt = secrets.token_bytes(16)
+	senha_hash = _executar(algoritmo, parametros, senha, salt)
+	campos = [algoritmo, *(str(v) for v in parametros), salt.hex(), senha_hash.hex()]
+	return '$'.join(campos)
+
 
 def verificar_senha(senha, senha_hash_armazenada):
 	try:
-		salt, hash_armazenado = senha_hash_armazenada.split(':')
-		hash_calculado = hashlib.sha256((senha + salt).encode()).hexdigest()
-		return hash_calculado == hash_armazenado
-	except:
+		algoritmo, parametros, salt, hash_armazenado = _decompor(senha_hash_armazenada)
+	except (ValueError, AttributeError):
 		return False
+	hash_calculado = _executar(algoritmo, parametros, senha, salt)
+	return hmac.compare_digest(hash_calculado, hash_armazenado)
+
 
+def precisa_rehash(senha_hash_armazenada):
+	try:
+		algoritmo, parametros, _, _ = _decompor(senha_hash_armazenada)
+	except (ValueError, AttributeError):
+		return False
+	return (algoritmo, parametros) != parametros_atuais()
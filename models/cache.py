@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+_AUSENTE = object()
+
+
+class CacheLRU:
+  def __init__(self, capacidade=1024, ttl=None):
+    self.capacidade = capacidade
+    self.ttl = ttl
+    self._itens = OrderedDict()
+    self._lock = threading.Lock()
+    self.acertos = 0
+    self.falhas = 0
+    self.despejos = 0
+    self.expirados = 0
+
+  def obter(self, chave, padrao=None):
+    with self._lock:
+      item = self._itens.get(chave, _AUSENTE)
+      if item is _AUSENTE:
+        self.falhas += 1
+        return padrao
+
+      valor, expira_em = item
+      if expira_em is not None and expira_em <= time.monotonic():
+        del self._itens[chave]
+        self.expirados += 1
+        self.falhas += 1
+        return padrao
+
+      self._itens.move_to_end(chave)
+      self.acertos += 1
+      return valor
+
+  def definir(self, chave, valor, ttl=_AUSENTE):
+    ttl = self.ttl if ttl is _AUSENTE else ttl
+    expira_em = time.monotonic() + ttl if ttl else None
+    with self._lock:
+      self._itens[chave] = (valor, expira_em)
+      self._itens.move_to_end(chave)
+      while len(self._itens) > self.capacidade:
+        self._itens.popitem(last=False)
+        self.despejos += 1
+
+  def remover(self, chave):
+    with self._lock:
+      self._itens.pop(chave, None)
+
+  def limpar(self):
+    with self._lock:
+      self._itens.clear()
+
+  def __len__(self):
+    return len(self._itens)
+
+  def estatisticas(self):
+    with self._lock:
+      consultas = self.acertos + self.falhas
+      return {
+        'itens': len(self._itens),
+        'capacidade': self.capacidade,
+        'acertos': self.acertos,
+        'falhas': self.falhas,
+        'despejos': self.despejos,
+        'expirados': self.expirados,
+        'taxa_acerto': round(self.acertos / consultas, 4) if consultas else 0.0,
+      }
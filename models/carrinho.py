@@ -0,0 +1,664 @@
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.managers import BaseManager
+
+import click
+from flask import session
+from flask.cli import AppGroup
+
+from models.model import conectar_db, conexao_dedicada, repetir_se_ocupado, transacao_imediata
+from models.reservas import RESERVAS_MINUTOS, disponivel_para, liberar, remover_reservas_vencidas, renovar, reservar, transferir
+
+# sqlite: cada alteração é gravada em carrinho_compras (padrão)
+# memoria: carrinhos em memória, gravados no SQLite só no checkout. Com
+# CARRINHO_MEMORIA_ENDERECO os workers compartilham um servidor de
+# carrinhos (multiprocessing.Manager) iniciado pelo master do gunicorn.
+CARRINHO_BACKEND = os.environ.get('CARRINHO_BACKEND', 'sqlite')
+CARRINHO_MEMORIA_ENDERECO = os.environ.get('CARRINHO_MEMORIA_ENDERECO', '')
+# O servidor troca objetos com pickle: quem tem a chave executa código nele.
+# Sem padrão; o servidor não sobe sem uma chave definida.
+CARRINHO_MEMORIA_CHAVE = os.environ.get('CARRINHO_MEMORIA_CHAVE', '').encode()
+
+CARRINHO_VISITANTE_TTL_HORAS = float(os.environ.get('CARRINHO_VISITANTE_TTL_HORAS', '72'))
+CARRINHO_LIMPEZA_INTERVALO = float(os.environ.get('CARRINHO_LIMPEZA_INTERVALO', '600'))
+CARRINHO_LIMPEZA_LOTE = int(os.environ.get('CARRINHO_LIMPEZA_LOTE', '500'))
+
+logger = logging.getLogger(__name__)
+
+Dono = namedtuple('Dono', 'cliente_id sessao_id')
+
+
+def chave_dono(dono):
+  # Chave do carrinho em memória e dono das reservas de estoque
+  if dono.cliente_id:
+    return f'cliente:{dono.cliente_id}'
+  return f'sessao:{dono.sessao_id}'
+
+
+def sessao_visitante():
+  # Carrinho de visitante é identificado por um token aleatório na sessão
+  if 'session_id' not in session:
+    session['session_id'] = secrets.token_urlsafe(16)
+  return session['session_id']
+
+
+def dono_carrinho(criar=False):
+  if session.get('cliente_id'):
+    return Dono(session['cliente_id'], None)
+  if criar:
+    return Dono(None, sessao_visitante())
+  if session.get('session_id'):
+    return Dono(None, session['session_id'])
+  return None
+
+
+SQL_LISTAR_CLIENTE = '''
+  SELECT c.id, c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade,
+         (c.preco_unitario * c.quantidade) as subtotal
+  FROM carrinho_compras c
+  WHERE c.cliente_id = ?
+  ORDER BY c.criado_em DESC
+'''
+
+SQL_LISTAR_VISITANTE = '''
+  SELECT c.id, c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade,
+         (c.preco_unitario * c.quantidade) as subtotal
+  FROM carrinho_compras c
+  WHERE c.cliente_id IS NULL AND c.sessao_id = ?
+  ORDER BY c.criado_em DESC
+'''
+
+SQL_ITEM_CLIENTE = 'SELECT id, produto_id, quantidade FROM carrinho_compras WHERE id = ? AND cliente_id = ?'
+SQL_ITEM_VISITANTE = 'SELECT id, produto_id, quantidade FROM carrinho_compras WHERE id = ? AND cliente_id IS NULL AND sessao_id = ?'
+
+SQL_PRODUTO_CLIENTE = 'SELECT id, quantidade FROM carrinho_compras WHERE cliente_id = ? AND produto_id = ?'
+SQL_PRODUTO_VISITANTE = 'SELECT id, quantidade FROM carrinho_compras WHERE cliente_id IS NULL AND sessao_id = ? AND produto_id = ?'
+
+SQL_MESCLAR_VISITANTE = '''
+  INSERT INTO carrinho_compras (cliente_id, produto_id, nome_produto, preco_unitario, quantidade)
+  SELECT ?, v.produto_id, v.nome_produto, v.preco_unitario, v.quantidade
+  FROM carrinho_compras v
+  WHERE v.cliente_id IS NULL AND v.sessao_id = ?
+  ON CONFLICT (cliente_id, produto_id) DO UPDATE
+  SET quantidade = quantidade + excluded.quantidade
+  WHERE quantidade + excluded.quantidade <= (
+    SELECT estoque FROM produtos WHERE id = excluded.produto_id
+  )
+'''
+
+SQL_LIMPAR_VISITANTE = 'DELETE FROM carrinho_compras WHERE cliente_id IS NULL AND sessao_id = ?'
+
+# Depois da transferência a reserva do cliente soma as duas; onde a
+# mesclagem manteve a quantidade dele, reserva só o que ficou no carrinho
+SQL_AJUSTAR_RESERVAS_MESCLADAS = '''
+  UPDATE reservas SET quantidade = (
+    SELECT c.quantidade FROM carrinho_compras c WHERE c.cliente_id = :cliente_id AND c.produto_id = reservas.produto_id
+  )
+  WHERE dono = :dono AND quantidade > (
+    SELECT c.quantidade FROM carrinho_compras c WHERE c.cliente_id = :cliente_id AND c.produto_id = reservas.produto_id
+  )
+'''
+
+SQL_REMOVER_EXPIRADOS = '''
+  DELETE FROM carrinho_compras
+  WHERE id IN (
+    SELECT id FROM carrinho_compras
+    WHERE cliente_id IS NULL AND criado_em < datetime('now', ?)
+    LIMIT ?
+  )
+'''
+
+
+class EstoqueIndisponivel(Exception):
+  def __init__(self, produto_id):
+    super().__init__(f'Estoque insuficiente para o produto {produto_id}.')
+    self.produto_id = produto_id
+
+
+class LoteInvalido(Exception):
+  def __init__(self, indice, mensagem):
+    super().__init__(mensagem)
+    self.indice = indice
+
+
+def resolver_lote(itens, operacoes):
+  # operacoes: (acao, alvo, quantidade), com alvo = produto_id em
+  # 'adicionar' e item_id em 'atualizar'/'remover'. Devolve a quantidade
+  # final de cada produto que muda; 0 tira o produto do carrinho.
+  produto_do_item = {item['id']: item['produto_id'] for item in itens}
+  atuais = {item['produto_id']: item['quantidade'] for item in itens}
+  finais = dict(atuais)
+  for indice, (acao, alvo, quantidade) in enumerate(operacoes):
+    if acao == 'adicionar':
+      finais[alvo] = finais.get(alvo, 0) + quantidade
+      continue
+    produto_id = produto_do_item.get(alvo)
+    if produto_id is None:
+      raise LoteInvalido(indice, f'Item {alvo} não está no carrinho.')
+    finais[produto_id] = quantidade if acao == 'atualizar' else 0
+  return {produto_id: quantidade for produto_id, quantidade in finais.items() if quantidade != atuais.get(produto_id, 0)}
+
+
+def mesclar_carrinho_visitante(conexao, cliente_id, sessao_id):
+  # Número fixo de comandos, qualquer que seja o tamanho do carrinho: itens novos
+  # passam para o cliente; itens repetidos somam se couberem no estoque
+  # (senão fica a quantidade que o cliente já tinha). As reservas do
+  # visitante passam para o cliente, limitadas ao carrinho mesclado.
+  destino = chave_dono(Dono(cliente_id, None))
+  conexao.execute(SQL_MESCLAR_VISITANTE, (cliente_id, sessao_id))
+  conexao.execute(SQL_LIMPAR_VISITANTE, (sessao_id,))
+  transferir(conexao, chave_dono(Dono(None, sessao_id)), destino)
+  conexao.execute(SQL_AJUSTAR_RESERVAS_MESCLADAS, {'cliente_id': cliente_id, 'dono': destino})
+
+
+class CarrinhoSQLite:
+  nome = 'sqlite'
+
+  def _filtro(self, dono):
+    if dono.cliente_id:
+      return dono.cliente_id
+    return dono.sessao_id
+
+  def listar(self, dono):
+    sql = SQL_LISTAR_CLIENTE if dono.cliente_id else SQL_LISTAR_VISITANTE
+    return conectar_db().execute(sql, (self._filtro(dono),)).fetchall()
+
+  def obter_item(self, dono, item_id):
+    sql = SQL_ITEM_CLIENTE if dono.cliente_id else SQL_ITEM_VISITANTE
+    return conectar_db().execute(sql, (item_id, self._filtro(dono))).fetchone()
+
+  def adicionar(self, dono, produto, quantidade):
+    conexao = conectar_db()
+    sql = SQL_PRODUTO_CLIENTE if dono.cliente_id else SQL_PRODUTO_VISITANTE
+    # Leitura do item, reserva e gravação na mesma transação de escrita:
+    # dois cliques simultâneos no mesmo produto não inserem duas linhas
+    with transacao_imediata(conexao):
+      item_existente = conexao.execute(sql, (self._filtro(dono), produto['id'])).fetchone()
+      nova_quantidade = quantidade + (item_existente['quantidade'] if item_existente else 0)
+
+      if not reservar(conexao, chave_dono(dono), produto['id'], nova_quantidade):
+        return False, nova_quantidade
+
+      if item_existente:
+        conexao.execute(
+          'UPDATE carrinho_compras SET quantidade = ? WHERE id = ?',
+          (nova_quantidade, item_existente['id'])
+        )
+      else:
+        conexao.execute(
+          'INSERT INTO carrinho_compras (cliente_id, sessao_id, produto_id, nome_produto, preco_unitario, quantidade) VALUES (?, ?, ?, ?, ?, ?)',
+          (dono.cliente_id, None if dono.cliente_id else dono.sessao_id, produto['id'], produto['nome'], produto['preco'], quantidade)
+        )
+
+      renovar(conexao, chave_dono(dono))
+    return True, nova_quantidade
+
+  def atualizar(self, dono, item_id, quantidade):
+    conexao = conectar_db()
+    sql = SQL_ITEM_CLIENTE if dono.cliente_id else SQL_ITEM_VISITANTE
+    # Como em adicionar: o item lido é o que a reserva e o UPDATE alteram
+    with transacao_imediata(conexao):
+      item = conexao.execute(sql, (item_id, self._filtro(dono))).fetchone()
+      if item is None:
+        return True
+      if not reservar(conexao, chave_dono(dono), item['produto_id'], quantidade):
+        return False
+      if dono.cliente_id:
+        conexao.execute(
+          'UPDATE carrinho_compras SET quantidade = ? WHERE id = ? AND cliente_id = ?',
+          (quantidade, item_id, dono.cliente_id)
+        )
+      else:
+        conexao.execute(
+          'UPDATE carrinho_compras SET quantidade = ? WHERE id = ? AND cliente_id IS NULL AND sessao_id = ?',
+          (quantidade, item_id, dono.sessao_id)
+        )
+      renovar(conexao, chave_dono(dono))
+    return True
+
+  def remover(self, dono, item_id):
+    conexao = conectar_db()
+    sql = SQL_ITEM_CLIENTE if dono.cliente_id else SQL_ITEM_VISITANTE
+    with transacao_imediata(conexao):
+      item = conexao.execute(sql, (item_id, self._filtro(dono))).fetchone()
+      if item is None:
+        return
+      liberar(conexao, chave_dono(dono), item['produto_id'])
+      if dono.cliente_id:
+        conexao.execute('DELETE FROM carrinho_compras WHERE id = ? AND cliente_id = ?', (item_id, dono.cliente_id))
+      else:
+        conexao.execute(
+          'DELETE FROM carrinho_compras WHERE id = ? AND cliente_id IS NULL AND sessao_id = ?',
+          (item_id, dono.sessao_id)
+        )
+
+  def aplicar_lote(self, dono, alteracoes, produtos):
+    # Reservas e itens numa transação só: ou o lote inteiro vale, ou nada
+    conexao = conectar_db()
+    sql = SQL_PRODUTO_CLIENTE if dono.cliente_id else SQL_PRODUTO_VISITANTE
+    with transacao_imediata(conexao):
+      for produto_id, quantidade in alteracoes.items():
+        if not reservar(conexao, chave_dono(dono), produto_id, quantidade):
+          raise EstoqueIndisponivel(produto_id)
+        existente = conexao.execute(sql, (self._filtro(dono), produto_id)).fetchone()
+        if existente and quantidade == 0:
+          conexao.execute('DELETE FROM carrinho_compras WHERE id = ?', (existente['id'],))
+        elif existente:
+          conexao.execute('UPDATE carrinho_compras SET quantidade = ? WHERE id = ?', (quantidade, existente['id']))
+        elif quantidade:
+          produto = produtos[produto_id]
+          conexao.execute(
+            'INSERT INTO carrinho_compras (cliente_id, sessao_id, produto_id, nome_produto, preco_unitario, quantidade) VALUES (?, ?, ?, ?, ?, ?)',
+            (dono.cliente_id, None if dono.cliente_id else dono.sessao_id, produto_id, produto['nome'], produto['preco'], quantidade)
+          )
+      renovar(conexao, chave_dono(dono))
+
+  def disponivel(self, dono, produto_id):
+    return disponivel_para(conectar_db(), chave_dono(dono), produto_id)
+
+  def mesclar(self, sessao_id, cliente_id):
+    conexao = conectar_db()
+    try:
+      mesclar_carrinho_visitante(conexao, cliente_id, sessao_id)
+      conexao.commit()
+    except Exception:
+      conexao.rollback()
+      raise
+
+  def persistir(self, conexao, cliente_id):
+    # Os itens já estão em carrinho_compras
+    pass
+
+  def esvaziar(self, dono):
+    # O checkout apaga as linhas na mesma transação do pedido
+    pass
+
+  def expirar(self, ttl_horas):
+    with conexao_dedicada() as conexao:
+      return remover_carrinhos_expirados(conexao, ttl_horas)
+
+
+class CarrinhosMemoria:
+  # Estado dos carrinhos em memória. Roda no próprio worker ou, atrás de
+  # um proxy, no servidor compartilhado: cada método é atômico. Cada item
+  # é também a reserva das suas unidades até reservado_ate, como uma linha
+  # de reservas no backend sqlite; o estoque físico vem de quem chama.
+  def __init__(self, validade_reserva=RESERVAS_MINUTOS * 60):
+    self._carrinhos = {}
+    # produto_id -> chaves dos carrinhos que têm o produto
+    self._detentores = {}
+    self._lock = threading.Lock()
+    self.validade_reserva = validade_reserva
+
+  def _reservado(self, produto_id, agora, exceto=()):
+    total = 0
+    for chave in self._detentores.get(produto_id, ()):
+      item = self._carrinhos[chave]['itens'][produto_id]
+      if chave not in exceto and item['reservado_ate'] >= agora:
+        total += item['quantidade']
+    return total
+
+  def _cabe(self, chave, produto_id, quantidade, estoque, agora):
+    return quantidade <= estoque - self._reservado(produto_id, agora, (chave,))
+
+  def _definir(self, chave, item, quantidade, agora):
+    carrinho = self._carrinhos.setdefault(chave, {'itens': {}})
+    existente = carrinho['itens'].get(item['produto_id'])
+    if existente is None:
+      existente = carrinho['itens'][item['produto_id']] = dict(item, criado_em=agora)
+      self._detentores.setdefault(item['produto_id'], set()).add(chave)
+    existente['quantidade'] = quantidade
+    existente['reservado_ate'] = agora + self.validade_reserva
+
+  def _tirar(self, chave, produto_id):
+    carrinho = self._carrinhos.get(chave)
+    if carrinho is None or carrinho['itens'].pop(produto_id, None) is None:
+      return
+    detentores = self._detentores[produto_id]
+    detentores.discard(chave)
+    if not detentores:
+      del self._detentores[produto_id]
+    if not carrinho['itens']:
+      del self._carrinhos[chave]
+
+  def _renovar(self, chave, agora):
+    # Mexer no carrinho renova as reservas ainda válidas, como o renovar()
+    # do sqlite; as vencidas só voltam disputando o estoque de novo
+    carrinho = self._carrinhos.get(chave)
+    if carrinho is None:
+      return
+    carrinho['atualizado_em'] = agora
+    for item in carrinho['itens'].values():
+      if item['reservado_ate'] >= agora:
+        item['reservado_ate'] = agora + self.validade_reserva
+
+  def listar(self, chave):
+    with self._lock:
+      itens = self._carrinhos.get(chave, {}).get('itens', {})
+      return [dict(item) for item in itens.values()]
+
+  def adicionar(self, chave, item, estoque):
+    agora = time.time()
+    with self._lock:
+      existente = self._carrinhos.get(chave, {}).get('itens', {}).get(item['produto_id'])
+      nova_quantidade = item['quantidade'] + (existente['quantidade'] if existente else 0)
+      if not self._cabe(chave, item['produto_id'], nova_quantidade, estoque, agora):
+        return False, nova_quantidade
+      self._definir(chave, item, nova_quantidade, agora)
+      self._renovar(chave, agora)
+      return True, nova_quantidade
+
+  def atualizar(self, chave, produto_id, quantidade, estoque):
+    agora = time.time()
+    with self._lock:
+      existente = self._carrinhos.get(chave, {}).get('itens', {}).get(produto_id)
+      if existente is None:
+        return True
+      if not self._cabe(chave, produto_id, quantidade, estoque, agora):
+        return False
+      self._definir(chave, existente, quantidade, agora)
+      self._renovar(chave, agora)
+      return True
+
+  def aplicar(self, chave, alteracoes, novos, estoques):
+    # Tudo ou nada: devolve o primeiro produto sem estoque, ou None
+    agora = time.time()
+    with self._lock:
+      for produto_id, quantidade in alteracoes.items():
+        if quantidade and not self._cabe(chave, produto_id, quantidade, estoques.get(produto_id, 0), agora):
+          return produto_id
+      itens = self._carrinhos.get(chave, {}).get('itens', {})
+      for produto_id, quantidade in alteracoes.items():
+        if not quantidade:
+          self._tirar(chave, produto_id)
+        else:
+          self._definir(chave, itens.get(produto_id) or novos[produto_id], quantidade, agora)
+      self._renovar(chave, agora)
+      return None
+
+  def disponivel(self, chave, produto_id, estoque):
+    with self._lock:
+      return max(estoque - self._reservado(produto_id, time.time(), (chave,)), 0)
+
+  def conferir(self, chave, estoques):
+    # Checkout: produtos do carrinho que não cabem no estoque descontadas
+    # as reservas válidas dos outros carrinhos
+    agora = time.time()
+    with self._lock:
+      itens = self._carrinhos.get(chave, {}).get('itens', {})
+      return [
+        produto_id for produto_id, item in itens.items()
+        if not self._cabe(chave, produto_id, item['quantidade'], estoques.get(produto_id, 0), agora)
+      ]
+
+  def remover(self, chave, produto_id):
+    with self._lock:
+      self._tirar(chave, produto_id)
+
+  def esvaziar(self, chave):
+    with self._lock:
+      for produto_id in list(self._carrinhos.get(chave, {}).get('itens', {})):
+        self._tirar(chave, produto_id)
+
+  def mesclar(self, origem, destino, estoques):
+    # Itens repetidos somam se couberem no estoque descontadas as reservas
+    # dos outros carrinhos; senão fica a quantidade do cliente. A reserva
+    # é o próprio item, então nunca passa do que ficou no carrinho.
+    agora = time.time()
+    with self._lock:
+      visitante = self._carrinhos.get(origem)
+      if not visitante:
+        return
+      for produto_id, item in list(visitante['itens'].items()):
+        self._tirar(origem, produto_id)
+        existente = self._carrinhos.get(destino, {}).get('itens', {}).get(produto_id)
+        if existente is None:
+          self._definir(destino, item, item['quantidade'], agora)
+          self._carrinhos[destino]['itens'][produto_id].update(criado_em=item['criado_em'], reservado_ate=item['reservado_ate'])
+          continue
+        livre = estoques.get(produto_id, 0) - self._reservado(produto_id, agora, (origem, destino))
+        if existente['quantidade'] + item['quantidade'] <= livre:
+          existente['quantidade'] += item['quantidade']
+          existente['reservado_ate'] = max(existente['reservado_ate'], item['reservado_ate'])
+      self._carrinhos[destino]['atualizado_em'] = agora
+
+  def expirar(self, prefixo, limite):
+    with self._lock:
+      expirados = [
+        chave for chave, carrinho in self._carrinhos.items()
+        if chave.startswith(prefixo) and carrinho.get('atualizado_em', 0) < limite
+      ]
+      removidos = 0
+      for chave in expirados:
+        for produto_id in list(self._carrinhos[chave]['itens']):
+          self._tirar(chave, produto_id)
+          removidos += 1
+      return removidos
+
+
+class CarrinhoMemoria:
+  nome = 'memoria'
+
+  def __init__(self, carrinhos):
+    self.carrinhos = carrinhos
+
+  def _chave(self, dono):
+    return chave_dono(dono)
+
+  def listar(self, dono):
+    itens = self.carrinhos.listar(self._chave(dono))
+    itens.sort(key=lambda item: item['criado_em'], reverse=True)
+    for item in itens:
+      item['id'] = item['produto_id']
+      item['subtotal'] = item['preco_unitario'] * item['quantidade']
+    return itens
+
+  def obter_item(self, dono, item_id):
+    for item in self.listar(dono):
+      if item['id'] == item_id:
+        return item
+    return None
+
+  def _estoques(self, conexao, produto_ids):
+    # Só leitura no SQLite: as reservas ficam com os carrinhos em memória
+    if not produto_ids:
+      return {}
+    marcadores = ', '.join('?' * len(produto_ids))
+    return dict(conexao.execute(
+      f'SELECT id, estoque FROM produtos WHERE id IN ({marcadores})', list(produto_ids)
+    ).fetchall())
+
+  def _estoque(self, produto_id):
+    return self._estoques(conectar_db(), [produto_id]).get(produto_id, 0)
+
+  def adicionar(self, dono, produto, quantidade):
+    item = {
+      'produto_id': produto['id'],
+      'nome_produto': produto['nome'],
+      'preco_unitario': produto['preco'],
+      'quantidade': quantidade,
+    }
+    return self.carrinhos.adicionar(self._chave(dono), item, self._estoque(produto['id']))
+
+  def atualizar(self, dono, item_id, quantidade):
+    return self.carrinhos.atualizar(self._chave(dono), item_id, quantidade, self._estoque(item_id))
+
+  def remover(self, dono, item_id):
+    self.carrinhos.remover(self._chave(dono), item_id)
+
+  def aplicar_lote(self, dono, alteracoes, produtos):
+    # O servidor confere todas as reservas do lote antes de mudar qualquer item
+    novos = {
+      produto_id: {'produto_id': produto_id, 'nome_produto': produto['nome'], 'preco_unitario': produto['preco']}
+      for produto_id, produto in produtos.items()
+    }
+    estoques = self._estoques(conectar_db(), list(alteracoes))
+    faltando = self.carrinhos.aplicar(self._chave(dono), alteracoes, novos, estoques)
+    if faltando is not None:
+      raise EstoqueIndisponivel(faltando)
+
+  def disponivel(self, dono, produto_id):
+    return self.carrinhos.disponivel(self._chave(dono), produto_id, self._estoque(produto_id))
+
+  def mesclar(self, sessao_id, cliente_id):
+    origem = self._chave(Dono(None, sessao_id))
+    produtos = [item['produto_id'] for item in self.carrinhos.listar(origem)]
+    if not produtos:
+      return
+    estoques = self._estoques(conectar_db(), produtos)
+    self.carrinhos.mesclar(origem, self._chave(Dono(cliente_id, None)), estoques)
+
+  def persistir(self, conexao, cliente_id):
+    # Chamado dentro da transação do checkout: é a única escrita do
+    # carrinho no SQLite. O estoque lido aqui já não muda até o commit; o
+    # que não couber nele, descontadas as reservas dos outros carrinhos,
+    # recusa o pedido.
+    chave = self._chave(Dono(cliente_id, None))
+    itens = self.carrinhos.listar(chave)
+    faltando = self.carrinhos.conferir(chave, self._estoques(conexao, [item['produto_id'] for item in itens]))
+    if faltando:
+      raise EstoqueIndisponivel(faltando[0])
+    conexao.execute('DELETE FROM carrinho_compras WHERE cliente_id = ?', (cliente_id,))
+    conexao.executemany(
+      'INSERT INTO carrinho_compras (cliente_id, produto_id, nome_produto, preco_unitario, quantidade) VALUES (?, ?, ?, ?, ?)',
+      [(cliente_id, item['produto_id'], item['nome_produto'], item['preco_unitario'], item['quantidade']) for item in itens]
+    )
+
+  def esvaziar(self, dono):
+    self.carrinhos.esvaziar(self._chave(dono))
+
+  def expirar(self, ttl_horas):
+    return self.carrinhos.expirar('sessao:', time.time() - ttl_horas * 3600)
+
+
+class ServidorCarrinhos(BaseManager):
+  pass
+
+
+_carrinhos_servidor = CarrinhosMemoria()
+
+
+def _carrinhos_compartilhados():
+  return _carrinhos_servidor
+
+
+ServidorCarrinhos.register('carrinhos', callable=_carrinhos_compartilhados)
+
+
+def _endereco(endereco):
+  host, _, porta = endereco.rpartition(':')
+  return (host or '127.0.0.1', int(porta))
+
+
+def _chave_servidor():
+  if not CARRINHO_MEMORIA_CHAVE:
+    raise RuntimeError('CARRINHO_MEMORIA_ENDERECO exige CARRINHO_MEMORIA_CHAVE (um segredo longo e aleatório)')
+  return CARRINHO_MEMORIA_CHAVE
+
+
+def iniciar_servidor_carrinhos(workers=1):
+  # Chamado no master do gunicorn (on_starting) antes do fork
+  if CARRINHO_BACKEND != 'memoria':
+    return None
+  if not CARRINHO_MEMORIA_ENDERECO:
+    # Cada worker teria o próprio dicionário e o carrinho "sumiria" quando
+    # a requisição caísse em outro processo
+    if workers > 1:
+      raise RuntimeError('CARRINHO_BACKEND=memoria com mais de um worker exige CARRINHO_MEMORIA_ENDERECO')
+    return None
+  servidor = ServidorCarrinhos(address=_endereco(CARRINHO_MEMORIA_ENDERECO), authkey=_chave_servidor())
+  servidor.start()
+  return servidor
+
+
+_armazenamento = {'pid': None, 'instancia': None}
+_armazenamento_lock = threading.Lock()
+
+
+def _criar_armazenamento():
+  if CARRINHO_BACKEND == 'sqlite':
+    return CarrinhoSQLite()
+  if CARRINHO_BACKEND == 'memoria':
+    if not CARRINHO_MEMORIA_ENDERECO:
+      return CarrinhoMemoria(CarrinhosMemoria())
+    cliente = ServidorCarrinhos(address=_endereco(CARRINHO_MEMORIA_ENDERECO), authkey=_chave_servidor())
+    cliente.connect()
+    return CarrinhoMemoria(cliente.carrinhos())
+  raise ValueError(f'CARRINHO_BACKEND inválido: {CARRINHO_BACKEND}')
+
+
+def obter_armazenamento():
+  if _armazenamento['pid'] != os.getpid():
+    with _armazenamento_lock:
+      if _armazenamento['pid'] != os.getpid():
+        _armazenamento['instancia'] = _criar_armazenamento()
+        _armazenamento['pid'] = os.getpid()
+  return _armazenamento['instancia']
+
+
+def remover_carrinhos_expirados(conexao, ttl_horas=CARRINHO_VISITANTE_TTL_HORAS, lote=CARRINHO_LIMPEZA_LOTE, pausa=0.01):
+  # Lotes pequenos, cada um na sua transação: o lock de escrita é solto
+  # entre eles e as requisições não esperam pela limpeza inteira.
+  removidos = 0
+  while True:
+    def remover_lote():
+      cursor = conexao.execute(SQL_REMOVER_EXPIRADOS, (f'-{ttl_horas} hours', lote))
+      conexao.commit()
+      return cursor.rowcount
+
+    quantidade = repetir_se_ocupado(remover_lote, conexao=conexao)
+    removidos += quantidade
+    if quantidade < lote:
+      return removidos
+    time.sleep(pausa)
+
+
+_limpeza = {'pid': None}
+_limpeza_lock = threading.Lock()
+
+
+def _laco_limpeza():
+  while True:
+    # jitter para os workers não limparem todos ao mesmo tempo
+    time.sleep(CARRINHO_LIMPEZA_INTERVALO * (0.5 + random.random()))
+    try:
+      removidos = obter_armazenamento().expirar(CARRINHO_VISITANTE_TTL_HORAS)
+      if removidos:
+        logger.info('Limpeza de carrinhos: %s itens expirados removidos', removidos)
+    except Exception:
+      logger.exception('Falha na limpeza de carrinhos expirados')
+
+
+def iniciar_limpeza_carrinhos():
+  # Uma thread por processo, criada depois do fork do gunicorn
+  if CARRINHO_LIMPEZA_INTERVALO <= 0 or _limpeza['pid'] == os.getpid():
+    return
+  with _limpeza_lock:
+    if _limpeza['pid'] == os.getpid():
+      return
+    _limpeza['pid'] = os.getpid()
+    threading.Thread(target=_laco_limpeza, name='limpeza-carrinhos', daemon=True).start()
+
+
+cli = AppGroup('carrinho', help='Manutenção dos carrinhos de compras.')
+
+
+@cli.command('limpar')
+@click.option('--ttl-horas', type=float, default=CARRINHO_VISITANTE_TTL_HORAS, show_default=True)
+def limpar_comando(ttl_horas):
+  """Remove carrinhos de visitantes expirados."""
+  removidos = obter_armazenamento().expirar(ttl_horas)
+  click.echo(f'{removidos} itens removidos.')
+
+
+@cli.command('liberar-reservas')
+def liberar_reservas_comando():
+  """Devolve ao estoque disponível as reservas vencidas."""
+  with conexao_dedicada() as conexao:
+    removidas = remover_reservas_vencidas(conexao)
+  click.echo(f'{removidas} reservas liberadas.')
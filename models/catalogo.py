@@ -0,0 +1,172 @@
+import base64
+import json
+import os
+import threading
+import time
+
+from models.cache import CacheLRU
+from models.model import conectar_db
+
+CATALOGO_CACHE_TAMANHO = int(os.environ.get('CATALOGO_CACHE_TAMANHO', '10000'))
+CATALOGO_CACHE_TTL = float(os.environ.get('CATALOGO_CACHE_TTL', '300'))
+# Intervalo em que a geração lida do SQLite é considerada atual. Escritas
+# feitas neste worker invalidam na hora; as dos outros aparecem em até
+# este tempo.
+CATALOGO_REVALIDAR_SEGUNDOS = float(os.environ.get('CATALOGO_REVALIDAR_SEGUNDOS', '1'))
+
+POR_PAGINA = int(os.environ.get('CATALOGO_POR_PAGINA', '24'))
+POR_PAGINA_MAXIMO = 100
+
+SQL_PRIMEIRA_PAGINA = '''
+  SELECT id, nome, descricao, preco, estoque FROM produtos
+  WHERE estoque > 0
+  ORDER BY nome, id LIMIT ?
+'''
+
+SQL_PROXIMA_PAGINA = '''
+  SELECT id, nome, descricao, preco, estoque FROM produtos
+  WHERE estoque > 0 AND (nome, id) > (?, ?)
+  ORDER BY nome, id LIMIT ?
+'''
+
+SQL_BUSCA = '''
+  SELECT p.id, p.nome, p.descricao, p.preco, p.estoque
+  FROM produtos_fts f
+  JOIN produtos p ON p.id = f.rowid
+  WHERE produtos_fts MATCH ? AND p.estoque > 0 AND (p.nome, p.id) > (?, ?)
+  ORDER BY p.nome, p.id LIMIT ?
+'''
+
+_produtos = CacheLRU(CATALOGO_CACHE_TAMANHO, CATALOGO_CACHE_TTL)
+_listagens = CacheLRU(256, CATALOGO_CACHE_TTL)
+
+_estado = {'geracao': None, 'verificada_em': 0.0, 'invalidacoes': 0}
+_lock = threading.Lock()
+
+
+def _descartar(geracao):
+  _produtos.limpar()
+  _listagens.limpar()
+  _estado['geracao'] = geracao
+  _estado['invalidacoes'] += 1
+
+
+def geracao_catalogo(conexao=None):
+  agora = time.monotonic()
+  if _estado['geracao'] is not None and agora - _estado['verificada_em'] < CATALOGO_REVALIDAR_SEGUNDOS:
+    return _estado['geracao']
+
+  if conexao is None:
+    conexao = conectar_db()
+  linha = conexao.execute('SELECT geracao FROM catalogo_versao WHERE id = 1').fetchone()
+  geracao = linha[0] if linha else 0
+  with _lock:
+    if geracao != _estado['geracao']:
+      _descartar(geracao)
+    _estado['verificada_em'] = agora
+  return geracao
+
+
+def invalidar_catalogo(conexao):
+  # Chamado dentro da transação que altera produtos; os outros workers
+  # percebem pela geração gravada no banco.
+  conexao.execute('UPDATE catalogo_versao SET geracao = geracao + 1 WHERE id = 1')
+
+
+def descartar_cache_local():
+  # Depois do commit: força este worker a reler a geração na próxima leitura
+  with _lock:
+    _descartar(None)
+    _estado['verificada_em'] = 0.0
+
+
+def obter_produto(conexao, produto_id):
+  chave = (geracao_catalogo(conexao), produto_id)
+  produto = _produtos.obter(chave)
+  if produto is None:
+    linha = conexao.execute(
+      'SELECT id, nome, descricao, preco, estoque FROM produtos WHERE id = ?',
+      (produto_id,)
+    ).fetchone()
+    if linha is None:
+      return None
+    produto = dict(linha)
+    _produtos.definir(chave, produto)
+  return produto
+
+
+def por_pagina_valido(valor):
+  if not valor or valor < 1:
+    return POR_PAGINA
+  return min(valor, POR_PAGINA_MAXIMO)
+
+
+def codificar_cursor(produto):
+  bruto = json.dumps([produto['nome'], produto['id']], ensure_ascii=False).encode()
+  return base64.urlsafe_b64encode(bruto).decode().rstrip('=')
+
+
+def decodificar_cursor(cursor):
+  if not cursor:
+    return None
+  try:
+    bruto = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    nome, produto_id = json.loads(bruto)
+    return str(nome), int(produto_id)
+  except (ValueError, TypeError):
+    return None
+
+
+def _pagina(linhas, por_pagina):
+  produtos = [dict(linha) for linha in linhas]
+  proximo = None
+  if len(produtos) > por_pagina:
+    produtos = produtos[:por_pagina]
+    proximo = codificar_cursor(produtos[-1])
+  return produtos, proximo
+
+
+def listar_disponiveis(conexao, apos=None, por_pagina=POR_PAGINA):
+  # Paginação por chave (nome, id): cada página custa o mesmo, seja a
+  # primeira ou a milésima, e percorre só o índice parcial.
+  chave = (geracao_catalogo(conexao), 'disponiveis', apos, por_pagina)
+  pagina = _listagens.obter(chave)
+  if pagina is None:
+    if apos is None:
+      linhas = conexao.execute(SQL_PRIMEIRA_PAGINA, (por_pagina + 1,)).fetchall()
+    else:
+      linhas = conexao.execute(SQL_PROXIMA_PAGINA, (apos[0], apos[1], por_pagina + 1)).fetchall()
+    pagina = _pagina(linhas, por_pagina)
+    _listagens.definir(chave, pagina)
+    for produto in pagina[0]:
+      _produtos.definir((chave[0], produto['id']), produto)
+  return pagina
+
+
+def termos_busca(texto):
+  # Cada palavra vira um prefixo entre aspas: a entrada do usuário nunca
+  # é interpretada como sintaxe do FTS5.
+  termos = []
+  for palavra in texto.split():
+    palavra = palavra.replace('"', '""')
+    termos.append(f'"{palavra}"*')
+  return ' '.join(termos)
+
+
+def buscar_produtos(conexao, texto, apos=None, por_pagina=POR_PAGINA):
+  consulta = termos_busca(texto)
+  if not consulta:
+    return listar_disponiveis(conexao, apos, por_pagina)
+
+  nome, produto_id = apos if apos is not None else ('', 0)
+  linhas = conexao.execute(SQL_BUSCA, (consulta, nome, produto_id, por_pagina + 1)).fetchall()
+  return _pagina(linhas, por_pagina)
+
+
+def estatisticas_catalogo():
+  return {
+    'geracao': _estado['geracao'],
+    'invalidacoes': _estado['invalidacoes'],
+    'produtos': _produtos.estatisticas(),
+    'listagens': _listagens.estatisticas(),
+  }
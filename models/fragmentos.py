@@ -0,0 +1,64 @@
+import os
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+from models.cache import CacheLRU
+
+# Templates compilados ficam em disco e valem para todos os workers e
+# reinícios; sem diretório o Jinja usa um temporário por usuário.
+TEMPLATES_BYTECODE_CACHE = os.environ.get('TEMPLATES_BYTECODE_CACHE', '1') == '1'
+TEMPLATES_BYTECODE_DIR = os.environ.get('TEMPLATES_BYTECODE_DIR') or None
+FRAGMENTOS_CACHE_TAMANHO = int(os.environ.get('FRAGMENTOS_CACHE_TAMANHO', '5000'))
+
+
+class ExtensaoCache(Extension):
+  # {% cache 'produto', produto.id, geracao %} ... {% endcache %}
+  # O HTML do bloco é guardado pela chave (template, linha, valores); quem
+  # usa escolhe valores que mudam quando o conteúdo muda.
+  tags = {'cache'}
+
+  def __init__(self, environment):
+    super().__init__(environment)
+    environment.extend(cache_fragmentos=None)
+
+  def parse(self, parser):
+    lineno = next(parser.stream).lineno
+    chave = [nodes.Const(parser.name), nodes.Const(lineno), parser.parse_expression()]
+    while parser.stream.skip_if('comma'):
+      chave.append(parser.parse_expression())
+    corpo = parser.parse_statements(('name:endcache',), drop_needle=True)
+    chamada = self.call_method('_renderizar', [nodes.Tuple(chave, 'load')])
+    return nodes.CallBlock(chamada, [], [], corpo).set_lineno(lineno)
+
+  def _renderizar(self, chave, caller):
+    cache = self.environment.cache_fragmentos
+    if cache is None:
+      return caller()
+    html = cache.obter(chave)
+    if html is None:
+      html = caller()
+      cache.definir(chave, html)
+    return html
+
+
+def configurar_templates(app, tamanho=FRAGMENTOS_CACHE_TAMANHO):
+  ambiente = app.jinja_env
+  if TEMPLATES_BYTECODE_CACHE:
+    ambiente.bytecode_cache = FileSystemBytecodeCache(TEMPLATES_BYTECODE_DIR)
+  ambiente.add_extension(ExtensaoCache)
+  # Cache por worker: o HTML não passa entre processos
+  ambiente.cache_fragmentos = CacheLRU(tamanho) if tamanho > 0 else None
+
+
+def carregar_templates(app):
+  # No início do worker: com o bytecode em disco nada é compilado, e a
+  # primeira requisição já encontra os templates carregados.
+  ambiente = app.jinja_env
+  for nome in ambiente.list_templates():
+    ambiente.get_template(nome)
+
+
+def estatisticas_fragmentos(app):
+  cache = app.jinja_env.cache_fragmentos
+  return cache.estatisticas() if cache is not None else None
@@ -0,0 +1,54 @@
+import os
+import random
+import threading
+import time
+import uuid
+
+# Gateway de pagamento de mentira para desenvolvimento e testes da fila:
+# demora, às vezes fica indisponível e às vezes recusa a cobrança.
+GATEWAY_LATENCIA_MS = float(os.environ.get('GATEWAY_LATENCIA_MS', '200'))
+GATEWAY_FALHA_TAXA = float(os.environ.get('GATEWAY_FALHA_TAXA', '0.1'))
+GATEWAY_RECUSA_TAXA = float(os.environ.get('GATEWAY_RECUSA_TAXA', '0.05'))
+
+
+class GatewayIndisponivel(Exception):
+  pass
+
+
+class GatewayFalso:
+  def __init__(self, latencia_ms=GATEWAY_LATENCIA_MS, falha_taxa=GATEWAY_FALHA_TAXA, recusa_taxa=GATEWAY_RECUSA_TAXA):
+    self.latencia_ms = latencia_ms
+    self.falha_taxa = falha_taxa
+    self.recusa_taxa = recusa_taxa
+    self._cobrancas = {}
+    self._lock = threading.Lock()
+
+  def cobrar(self, chave, valor, tipo):
+    # Como nos gateways reais, a mesma chave de idempotência devolve o
+    # resultado da primeira cobrança em vez de cobrar de novo.
+    with self._lock:
+      if chave in self._cobrancas:
+        return self._cobrancas[chave]
+
+    time.sleep(self.latencia_ms * (0.5 + random.random()) / 1000)
+    if random.random() < self.falha_taxa:
+      raise GatewayIndisponivel('Gateway de pagamento indisponível')
+
+    resultado = {
+      'transacao': uuid.uuid4().hex,
+      'status': 'recusado' if random.random() < self.recusa_taxa else 'aprovado',
+      'valor': valor,
+      'tipo': tipo,
+    }
+    with self._lock:
+      return self._cobrancas.setdefault(chave, resultado)
+
+
+_gateway = {}
+
+
+def obter_gateway():
+  if os.getpid() not in _gateway:
+    _gateway.clear()
+    _gateway[os.getpid()] = GatewayFalso()
+  return _gateway[os.getpid()]
@@ -0,0 +1,192 @@
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+
+import click
+from flask.cli import AppGroup
+
+from models.catalogo import invalidar_catalogo
+from models.model import conexao_dedicada, repetir_se_ocupado, transacao_imediata
+
+# Linhas por transação: lotes grandes amortizam o commit, mas seguram o
+# lock de escrita; os checkouts esperam no máximo um lote.
+CATALOGO_IMPORTAR_LOTE = int(os.environ.get('CATALOGO_IMPORTAR_LOTE', '5000'))
+CATALOGO_IMPORTAR_CACHE_MB = int(os.environ.get('CATALOGO_IMPORTAR_CACHE_MB', '64'))
+
+FORMATOS_FEED = ('csv', 'jsonl')
+ERROS_EXIBIDOS = 10
+
+# Só grava quem mudou: linhas iguais não tocam a tabela, os índices nem o
+# FTS, e não contam como alteradas.
+SQL_IMPORTAR = '''
+  INSERT INTO produtos (sku, nome, descricao, preco, estoque)
+  VALUES (:sku, :nome, :descricao, :preco, :estoque)
+  ON CONFLICT (sku) WHERE sku IS NOT NULL DO UPDATE SET
+    nome = excluded.nome, descricao = excluded.descricao,
+    preco = excluded.preco, estoque = excluded.estoque
+  WHERE produtos.nome IS NOT excluded.nome OR produtos.descricao IS NOT excluded.descricao
+     OR produtos.preco IS NOT excluded.preco OR produtos.estoque IS NOT excluded.estoque
+'''
+
+# Delta: só preço e/ou estoque de produtos que já existem
+SQL_ATUALIZAR_DELTA = '''
+  UPDATE produtos SET preco = COALESCE(:preco, preco), estoque = COALESCE(:estoque, estoque)
+  WHERE sku = :sku
+    AND ((:preco IS NOT NULL AND preco IS NOT :preco) OR (:estoque IS NOT NULL AND estoque IS NOT :estoque))
+'''
+
+
+class LinhaInvalida(ValueError):
+  pass
+
+
+def ler_feed(arquivo, formato):
+  # Gerador: o feed nunca é carregado inteiro na memória
+  if formato == 'csv':
+    for numero, registro in enumerate(csv.DictReader(arquivo), start=2):
+      yield numero, registro
+    return
+
+  for numero, linha in enumerate(arquivo, start=1):
+    if not linha.strip():
+      continue
+    try:
+      registro = json.loads(linha)
+    except ValueError as e:
+      yield numero, LinhaInvalida(f'JSON inválido: {e}')
+      continue
+    yield numero, registro
+
+
+def _numero(registro, campo, tipo, obrigatorio):
+  valor = registro.get(campo)
+  if valor is None or valor == '':
+    if obrigatorio:
+      raise LinhaInvalida(f'{campo} ausente')
+    return None
+  try:
+    valor = tipo(valor)
+  except (TypeError, ValueError):
+    raise LinhaInvalida(f'{campo} inválido: {valor!r}')
+  if valor < 0:
+    raise LinhaInvalida(f'{campo} negativo: {valor!r}')
+  return valor
+
+
+def converter(registro, delta=False):
+  if isinstance(registro, Exception):
+    raise registro
+  if not isinstance(registro, dict):
+    raise LinhaInvalida('linha não é um objeto')
+
+  sku = str(registro.get('sku') or '').strip()
+  if not sku:
+    raise LinhaInvalida('sku ausente')
+
+  preco = _numero(registro, 'preco', float, not delta)
+  estoque = _numero(registro, 'estoque', int, not delta)
+  if preco is not None:
+    preco = round(preco, 2)
+  if delta:
+    if preco is None and estoque is None:
+      raise LinhaInvalida('sem preco nem estoque')
+    return {'sku': sku, 'preco': preco, 'estoque': estoque}
+
+  nome = str(registro.get('nome') or '').strip()
+  if not nome:
+    raise LinhaInvalida('nome ausente')
+  return {'sku': sku, 'nome': nome, 'descricao': registro.get('descricao') or None, 'preco': preco, 'estoque': estoque}
+
+
+def _gravar_lote(conexao, sql, lote):
+  def gravar():
+    with transacao_imediata(conexao):
+      alteradas = conexao.executemany(sql, lote).rowcount
+      # Uma geração por lote: os workers descartam o cache uma vez por
+      # lote, não por linha, e já enxergam o que foi importado até aqui.
+      if alteradas:
+        invalidar_catalogo(conexao)
+      return alteradas
+  return repetir_se_ocupado(gravar)
+
+
+def importar_catalogo(linhas, delta=False, lote=CATALOGO_IMPORTAR_LOTE, erro=None):
+  # linhas: (número, registro) como em ler_feed. Devolve o resumo da importação.
+  sql = SQL_ATUALIZAR_DELTA if delta else SQL_IMPORTAR
+  resumo = {'lidas': 0, 'alteradas': 0, 'invalidas': 0, 'lotes': 0}
+  inicio = time.perf_counter()
+
+  def validas():
+    for numero, registro in linhas:
+      resumo['lidas'] += 1
+      try:
+        yield converter(registro, delta)
+      except LinhaInvalida as e:
+        resumo['invalidas'] += 1
+        if erro:
+          erro(numero, e)
+
+  with conexao_dedicada() as conexao:
+    # Cache maior só durante a importação: as páginas do índice de sku e
+    # do FTS ficam em memória entre um lote e outro. A conexão volta ao
+    # pool com o cache que tinha.
+    cache_original = conexao.execute('PRAGMA cache_size').fetchone()[0]
+    conexao.execute(f'PRAGMA cache_size = {-CATALOGO_IMPORTAR_CACHE_MB * 1024}')
+    try:
+      fonte = validas()
+      while True:
+        pedaco = list(itertools.islice(fonte, lote))
+        if not pedaco:
+          break
+        resumo['alteradas'] += _gravar_lote(conexao, sql, pedaco)
+        resumo['lotes'] += 1
+      conexao.execute('PRAGMA optimize')
+    finally:
+      conexao.execute(f'PRAGMA cache_size = {int(cache_original)}')
+
+  resumo['segundos'] = time.perf_counter() - inicio
+  resumo['iguais'] = resumo['lidas'] - resumo['invalidas'] - resumo['alteradas']
+  return resumo
+
+
+cli = AppGroup('catalogo', help='Manutenção do catálogo de produtos.')
+
+
+@cli.command('importar')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--formato', type=click.Choice(FORMATOS_FEED), help='Padrão: pela extensão do arquivo.')
+@click.option('--delta', is_flag=True, help='Só atualiza preco/estoque de produtos já cadastrados.')
+@click.option('--lote', type=int, default=CATALOGO_IMPORTAR_LOTE, show_default=True, help='Linhas por transação.')
+def importar_comando(arquivo, formato, delta, lote):
+  """Importa um feed CSV ou JSONL de produtos identificados por sku.
+
+  Colunas: sku, nome, descricao, preco, estoque. No modo --delta bastam
+  sku e preco e/ou estoque; skus desconhecidos são ignorados.
+  """
+  if formato is None:
+    formato = 'jsonl' if arquivo.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+  erros = []
+
+  def erro(numero, e):
+    erros.append(numero)
+    if len(erros) <= ERROS_EXIBIDOS:
+      click.echo(f'linha {numero}: {e}', err=True)
+
+  if arquivo == '-':
+    resumo = importar_catalogo(ler_feed(sys.stdin, formato), delta, lote, erro)
+  else:
+    with open(arquivo, encoding='utf-8', newline='') as entrada:
+      resumo = importar_catalogo(ler_feed(entrada, formato), delta, lote, erro)
+
+  if len(erros) > ERROS_EXIBIDOS:
+    click.echo(f'... e mais {len(erros) - ERROS_EXIBIDOS} linhas inválidas', err=True)
+  segundos = resumo['segundos']
+  click.echo(
+    f'{resumo["lidas"]} linhas lidas, {resumo["alteradas"]} gravadas, {resumo["iguais"]} sem mudança, '
+    f'{resumo["invalidas"]} inválidas em {resumo["lotes"]} lotes; '
+    f'{segundos:.1f}s ({resumo["lidas"] / segundos if segundos else 0:.0f} linhas/s)'
+  )
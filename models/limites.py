@@ -0,0 +1,273 @@
+import fcntl
+import hashlib
+import itertools
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from models.metricas import incrementar
+from models.model import DB_PATH
+
+LIMITES_ATIVOS = os.environ.get('LIMITES_ATIVOS', '1') == '1'
+# Estado compartilhado pelos workers: um arquivo mapeado em memória, com
+# flock em volta de cada decisão. Fica ao lado do banco por padrão.
+LIMITES_ARQUIVO = os.environ.get('LIMITES_ARQUIVO', os.path.join(os.path.dirname(DB_PATH), 'limites.bin'))
+LIMITES_BALDES = int(os.environ.get('LIMITES_BALDES', '65536'))
+
+# "capacidade/segundos": até capacidade tentativas seguidas, repostas aos
+# poucos ao longo de segundos. Capacidade 0 desliga a regra.
+REGRAS = {
+  'login_ip': os.environ.get('LIMITE_LOGIN_IP', '20/60'),
+  'login_conta': os.environ.get('LIMITE_LOGIN_CONTA', '5/300'),
+  'registro_ip': os.environ.get('LIMITE_REGISTRO_IP', '5/300'),
+}
+
+# Checkouts simultâneos em todos os workers. O excedente é recusado na
+# hora em vez de esperar o lock de escrita do SQLite até o timeout.
+CHECKOUT_CONCORRENTES = int(os.environ.get('CHECKOUT_CONCORRENTES', '8'))
+# Vaga de um worker morto no meio do checkout volta depois deste tempo
+# (o timeout do gunicorn)
+CHECKOUT_VAGA_SEGUNDOS = float(os.environ.get('CHECKOUT_VAGA_SEGUNDOS', '120'))
+# Cálculos de hash de senha simultâneos no servidor inteiro, somando
+# workers e threads: o KDF ocupa um núcleo enquanto roda, e metade dos
+# núcleos fica para o resto do site numa rajada de logins. 0 = sem limite.
+SENHA_CONCORRENTES = int(os.environ.get('SENHA_CONCORRENTES', str(max(1, (os.cpu_count() or 1) // 2))))
+SENHA_VAGA_SEGUNDOS = 30.0
+
+# Grupos de vagas no arquivo: quantidade e validade de uma vaga esquecida
+GRUPOS_VAGAS = {
+  'checkout': (max(CHECKOUT_CONCORRENTES, 0), CHECKOUT_VAGA_SEGUNDOS),
+  'senha': (max(SENHA_CONCORRENTES, 0), SENHA_VAGA_SEGUNDOS),
+}
+
+# Balde: hash da chave, fichas, última atualização
+_BALDE = struct.Struct('<Qdd')
+# Vaga: pid << 32 | sequência, início
+_VAGA = struct.Struct('<Qd')
+# Posições olhadas a partir do hash antes de reaproveitar a mais antiga
+_SONDAGENS = 8
+
+
+def _regra(texto):
+  capacidade, segundos = texto.split('/')
+  capacidade = float(capacidade)
+  return capacidade, capacidade / float(segundos)
+
+
+class LimitesCompartilhados:
+  def __init__(self, caminho, baldes, grupos):
+    self.caminho = caminho
+    self.baldes = baldes
+    # grupo -> (primeira vaga, quantidade, validade); os baldes vêm depois
+    self.grupos = {}
+    vagas = 0
+    for nome, (quantidade, validade) in grupos.items():
+      self.grupos[nome] = (vagas, quantidade, validade)
+      vagas += quantidade
+    self.vagas = vagas
+    self.tamanho = vagas * _VAGA.size + baldes * _BALDE.size
+    self.regras = {nome: _regra(texto) for nome, texto in REGRAS.items()}
+    self._pid = None
+    self._lock = threading.Lock()
+    self._sequencia = itertools.count(1)
+
+  def _abrir(self):
+    # flock vale por arquivo aberto e o descritor herdado do fork é o
+    # mesmo: cada processo abre o seu
+    fd = os.open(self.caminho, os.O_RDWR | os.O_CREAT, 0o600)
+    if os.fstat(fd).st_size < self.tamanho:
+      os.ftruncate(fd, self.tamanho)
+    self._fd = fd
+    self._mapa = mmap.mmap(fd, self.tamanho)
+    self._pid = os.getpid()
+
+  @contextmanager
+  def _travado(self):
+    # O lock da thread vem antes: threads do mesmo worker dividem o flock
+    with self._lock:
+      if self._pid != os.getpid():
+        self._abrir()
+      fcntl.flock(self._fd, fcntl.LOCK_EX)
+      try:
+        yield self._mapa
+      finally:
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  def reiniciar(self):
+    with self._travado() as mapa:
+      mapa[:] = bytes(self.tamanho)
+
+  def _posicao(self, mapa, chave, agora):
+    inicio = self.vagas * _VAGA.size
+    indice = chave % self.baldes
+    antiga = None
+    for sondagem in range(_SONDAGENS):
+      posicao = inicio + ((indice + sondagem) % self.baldes) * _BALDE.size
+      dono, fichas, atualizado_em = _BALDE.unpack_from(mapa, posicao)
+      if dono == chave:
+        return posicao, fichas, atualizado_em
+      if dono == 0:
+        return posicao, None, agora
+      if antiga is None or atualizado_em < antiga[1]:
+        antiga = (posicao, atualizado_em)
+    # Tabela cheia nesta região: o balde parado há mais tempo é trocado
+    return antiga[0], None, agora
+
+  def consumir(self, regra, chave, custo=1):
+    # Devolve 0 se a tentativa pode seguir, senão os segundos até a
+    # próxima ficha. Com custo 0 só consulta.
+    capacidade, taxa = self.regras[regra]
+    if not capacidade:
+      return 0.0
+    resumo = hashlib.blake2b(f'{regra}:{chave}'.encode(), digest_size=8).digest()
+    chave = int.from_bytes(resumo, 'little') or 1
+    agora = time.time()
+    with self._travado() as mapa:
+      posicao, fichas, atualizado_em = self._posicao(mapa, chave, agora)
+      if fichas is None:
+        fichas = capacidade
+      else:
+        fichas = min(capacidade, fichas + (agora - atualizado_em) * taxa)
+      espera = 0.0
+      if fichas >= 1:
+        fichas -= custo
+      else:
+        espera = (1 - fichas) / taxa
+      _BALDE.pack_into(mapa, posicao, chave, fichas, agora)
+    return espera
+
+  def ocupar_vaga(self, grupo):
+    inicio_grupo, quantidade, validade = self.grupos[grupo]
+    identificador = (os.getpid() << 32) | (next(self._sequencia) & 0xffffffff)
+    agora = time.time()
+    with self._travado() as mapa:
+      livre = None
+      ocupadas = []
+      for vaga in range(inicio_grupo, inicio_grupo + quantidade):
+        dono, inicio = _VAGA.unpack_from(mapa, vaga * _VAGA.size)
+        if dono == 0 or agora - inicio > validade:
+          livre = vaga
+          break
+        ocupadas.append((vaga, dono >> 32))
+      else:
+        # Todas ocupadas: alguma pode ser de um worker que já morreu
+        for vaga, pid in ocupadas:
+          if not _processo_vivo(pid):
+            livre = vaga
+            break
+      if livre is None:
+        return None
+      _VAGA.pack_into(mapa, livre * _VAGA.size, identificador, agora)
+    return livre, identificador
+
+  def liberar_vaga(self, vaga):
+    posicao, identificador = vaga
+    with self._travado() as mapa:
+      if _VAGA.unpack_from(mapa, posicao * _VAGA.size)[0] == identificador:
+        _VAGA.pack_into(mapa, posicao * _VAGA.size, 0, 0.0)
+
+  def vagas_ocupadas(self, grupo):
+    inicio_grupo, quantidade, validade = self.grupos[grupo]
+    agora = time.time()
+    with self._travado() as mapa:
+      vagas = [_VAGA.unpack_from(mapa, vaga * _VAGA.size) for vaga in range(inicio_grupo, inicio_grupo + quantidade)]
+    return sum(1 for dono, inicio in vagas if dono and agora - inicio <= validade)
+
+
+def _processo_vivo(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+_limites = LimitesCompartilhados(LIMITES_ARQUIVO, LIMITES_BALDES, GRUPOS_VAGAS)
+
+
+def reiniciar_limites():
+  # No master do gunicorn: os workers começam com todos os baldes cheios
+  # e nenhuma vaga presa
+  _limites.reiniciar()
+
+
+def _recusado(regra):
+  incrementar('ecommerce_limites_recusados_total', (('regra', regra),))
+
+
+def _decidir(regra, chave, custo):
+  espera = _limites.consumir(regra, chave, custo)
+  if espera:
+    _recusado(regra)
+  return espera
+
+
+def admitir(regra, chave):
+  # Consome uma ficha; devolve os segundos a esperar quando não há
+  if not LIMITES_ATIVOS:
+    return 0.0
+  return _decidir(regra, chave, 1)
+
+
+def verificar(regra, chave):
+  # Só consulta: para regras que cobram apenas as tentativas que falham
+  if not LIMITES_ATIVOS:
+    return 0.0
+  return _decidir(regra, chave, 0)
+
+
+def penalizar(regra, chave):
+  if LIMITES_ATIVOS:
+    _limites.consumir(regra, chave)
+
+
+@contextmanager
+def vaga(grupo, espera=0.0):
+  # with vaga('senha', espera=2) as admitido: tenta por até espera
+  # segundos; sem vaga, admitido é False e quem chama responde na hora.
+  # A vaga só é devolvida quando o bloco termina.
+  if not _limites.grupos[grupo][1]:
+    yield True
+    return
+  limite = time.monotonic() + espera
+  ocupada = _limites.ocupar_vaga(grupo)
+  pausa = 0.005
+  while ocupada is None and time.monotonic() < limite:
+    # Espera crescente: quem está na fila não disputa o flock a cada poucos ms
+    time.sleep(min(pausa * (0.5 + random.random()), max(limite - time.monotonic(), 0)))
+    pausa = min(pausa * 2, 0.1)
+    ocupada = _limites.ocupar_vaga(grupo)
+  if ocupada is None:
+    _recusado(grupo)
+    yield False
+    return
+  try:
+    yield True
+  finally:
+    _limites.liberar_vaga(ocupada)
+
+
+@contextmanager
+def vaga_checkout():
+  if not LIMITES_ATIVOS:
+    yield True
+    return
+  with vaga('checkout') as admitido:
+    yield admitido
+
+
+def estatisticas_limites():
+  return {
+    'ativos': LIMITES_ATIVOS,
+    'regras': REGRAS,
+    'checkout_concorrentes': CHECKOUT_CONCORRENTES,
+    'checkout_em_andamento': _limites.vagas_ocupadas('checkout'),
+    'senha_concorrentes': SENHA_CONCORRENTES,
+    'senha_em_andamento': _limites.vagas_ocupadas('senha'),
+  }
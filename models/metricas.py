@@ -0,0 +1,450 @@
+import atexit
+import bisect
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from flask import before_render_template, g, request, template_rendered
+
+from models.cache import CacheLRU
+from models.planos import COMANDOS_VERIFICADOS, parametros_nulos
+from models.pool import ConexaoPool
+
+METRICAS_ATIVAS = os.environ.get('METRICAS_ATIVAS', '1') == '1'
+# Com vários workers cada processo grava um arquivo neste diretório e o
+# /metrics soma todos; sem ele o /metrics mostra só o processo atual.
+METRICAS_DIR = os.environ.get('METRICAS_DIR')
+METRICAS_INTERVALO = float(os.environ.get('METRICAS_INTERVALO', '2'))
+# 0 desliga o log de consultas lentas
+CONSULTA_LENTA_MS = float(os.environ.get('METRICAS_CONSULTA_LENTA_MS', '0'))
+
+FAIXAS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAIXAS_BYTES = (32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+METRICAS = {
+  'ecommerce_requisicao_segundos': ('histogram', 'Duração das requisições por endpoint, método e status.'),
+  'ecommerce_template_segundos': ('histogram', 'Tempo de render_template por template.'),
+  'ecommerce_sql_segundos': ('histogram', 'Duração de cada comando SQL, incluindo a leitura das linhas.'),
+  'ecommerce_sql_linhas_total': ('counter', 'Linhas lidas ou alteradas por comando SQL.'),
+  'ecommerce_sql_info': ('gauge', 'Texto normalizado de cada impressão usada no rótulo consulta.'),
+  'ecommerce_consultas_lentas_total': ('counter', 'Comandos SQL acima de METRICAS_CONSULTA_LENTA_MS.'),
+  'ecommerce_sessao_segundos': ('histogram', 'Tempo para abrir e salvar a sessão, por backend.'),
+  'ecommerce_sessao_cookie_bytes': ('histogram', 'Tamanho do cookie de sessão recebido e enviado.', FAIXAS_BYTES),
+  'ecommerce_limites_recusados_total': ('counter', 'Requisições recusadas pelo controle de admissão, por regra.'),
+}
+
+
+def _faixas(nome):
+  definicao = METRICAS.get(nome, ())
+  return definicao[2] if len(definicao) > 2 else FAIXAS
+
+ARQUIVO_ENCERRADOS = 'metricas-encerrados.json'
+
+logger = logging.getLogger(__name__)
+
+_COMENTARIOS = re.compile(r'--[^\n]*')
+_LITERAIS = re.compile(r"'(?:[^']|'')*'")
+_NUMEROS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LISTAS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+
+
+@lru_cache(maxsize=1024)
+def normalizar(sql):
+  # Literais viram ? e listas de parâmetros colapsam: o rótulo identifica
+  # o comando, não os valores.
+  texto = ' '.join(_COMENTARIOS.sub('', sql).split())
+  texto = _LITERAIS.sub('?', texto)
+  texto = _NUMEROS.sub('?', texto)
+  return _LISTAS.sub('(?, ...)', texto)
+
+
+@lru_cache(maxsize=1024)
+def impressao(sql):
+  # Rótulo das métricas de SQL: o texto inteiro em cada série deixava o
+  # /metrics com centenas de KB. O texto de cada impressão aparece no log
+  # de consultas lentas, em flask db planos -v e na série ecommerce_sql_info.
+  return hashlib.blake2b(normalizar(sql).encode(), digest_size=6).hexdigest()
+
+
+class Registro:
+  def __init__(self):
+    self.pid = os.getpid()
+    self._lock = threading.Lock()
+    # (nome, rótulos) -> contagem por faixa (a última é +Inf) seguida da soma
+    self.histogramas = {}
+    self.contadores = {}
+    # impressão -> texto normalizado, para a série ecommerce_sql_info
+    self.textos = {}
+
+  def observar(self, nome, rotulos, valor):
+    faixas = _faixas(nome)
+    indice = bisect.bisect_left(faixas, valor)
+    chave = (nome, rotulos)
+    with self._lock:
+      histograma = self.histogramas.get(chave)
+      if histograma is None:
+        histograma = self.histogramas[chave] = [0] * (len(faixas) + 1) + [0.0]
+      histograma[indice] += 1
+      histograma[-1] += valor
+
+  def incrementar(self, nome, rotulos, valor=1):
+    chave = (nome, rotulos)
+    with self._lock:
+      self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+  def exportar(self):
+    with self._lock:
+      return {
+        'histogramas': [[nome, list(rotulos), list(valores)] for (nome, rotulos), valores in self.histogramas.items()],
+        'contadores': [[nome, list(rotulos), valor] for (nome, rotulos), valor in self.contadores.items()],
+        'textos': dict(self.textos),
+      }
+
+  def mesclar(self, dados):
+    with self._lock:
+      for nome, rotulos, valores in dados.get('histogramas', ()):
+        chave = (nome, tuple(tuple(par) for par in rotulos))
+        atual = self.histogramas.get(chave)
+        if atual is None:
+          self.histogramas[chave] = list(valores)
+        else:
+          for i, valor in enumerate(valores):
+            atual[i] += valor
+      for nome, rotulos, valor in dados.get('contadores', ()):
+        chave = (nome, tuple(tuple(par) for par in rotulos))
+        self.contadores[chave] = self.contadores.get(chave, 0) + valor
+      self.textos.update(dados.get('textos', {}))
+
+
+_registros = {}
+_gravacao = {'pid': None}
+_lock = threading.Lock()
+
+
+def _registro():
+  # Um registro por processo: o que o master mediu antes do fork (as
+  # migrações) não é contado de novo em cada worker.
+  registro = _registros.get('atual')
+  if registro is not None and registro.pid == os.getpid():
+    return registro
+  with _lock:
+    registro = _registros.get('atual')
+    if registro is None or registro.pid != os.getpid():
+      registro = _registros['atual'] = Registro()
+    return registro
+
+
+def observar(nome, rotulos, valor):
+  if METRICAS_ATIVAS:
+    _registro().observar(nome, rotulos, valor)
+
+
+def incrementar(nome, rotulos, valor=1):
+  if METRICAS_ATIVAS:
+    _registro().incrementar(nome, rotulos, valor)
+
+
+_planos = CacheLRU(256)
+
+
+def _plano(conexao, sql, parametros):
+  if not sql.strip().upper().startswith(COMANDOS_VERIFICADOS):
+    return []
+  plano = _planos.obter(normalizar(sql))
+  if plano is None:
+    try:
+      # Cursor comum: o próprio EXPLAIN não entra nas métricas
+      cursor = sqlite3.Cursor(conexao)
+      linhas = cursor.execute('EXPLAIN QUERY PLAN ' + sql, parametros).fetchall()
+      plano = [linha[3] for linha in linhas]
+    except sqlite3.Error as e:
+      plano = [f'EXPLAIN falhou: {e}']
+    _planos.definir(normalizar(sql), plano)
+  return plano
+
+
+def registrar_consulta(conexao, sql, parametros, duracao, linhas):
+  registro = _registro()
+  rotulos = (('consulta', impressao(sql)),)
+  if rotulos[0][1] not in registro.textos:
+    registro.textos[rotulos[0][1]] = normalizar(sql)
+  registro.observar('ecommerce_sql_segundos', rotulos, duracao)
+  if linhas:
+    registro.incrementar('ecommerce_sql_linhas_total', rotulos, linhas)
+
+  if CONSULTA_LENTA_MS and duracao * 1000 >= CONSULTA_LENTA_MS:
+    registro.incrementar('ecommerce_consultas_lentas_total', rotulos)
+    if parametros is None:
+      parametros = parametros_nulos(sql)
+    plano = _plano(conexao, sql, parametros)
+    logger.warning(
+      'Consulta lenta %s (%.1f ms, %s linhas): %s%s',
+      rotulos[0][1], duracao * 1000, linhas, normalizar(sql), ''.join(f'\n    {detalhe}' for detalhe in plano)
+    )
+
+
+class CursorMedido(sqlite3.Cursor):
+  # Mede do execute até a última linha lida: num SELECT quase todo o
+  # trabalho acontece no fetch, não no execute.
+  _sql = None
+
+  def _iniciar(self, sql, parametros, duracao):
+    self._sql = sql
+    self._parametros = parametros
+    self._duracao = duracao
+    self._linhas = max(self.rowcount, 0)
+
+  def _registrar(self):
+    sql = self._sql
+    if sql is None:
+      return
+    self._sql = None
+    try:
+      registrar_consulta(self.connection, sql, self._parametros, self._duracao, self._linhas)
+    except Exception:
+      logger.exception('Falha ao registrar métricas de SQL')
+
+  def execute(self, sql, parametros=()):
+    self._registrar()
+    inicio = time.perf_counter()
+    super().execute(sql, parametros)
+    self._iniciar(sql, parametros, time.perf_counter() - inicio)
+    return self
+
+  def executemany(self, sql, parametros):
+    self._registrar()
+    inicio = time.perf_counter()
+    super().executemany(sql, parametros)
+    self._iniciar(sql, None, time.perf_counter() - inicio)
+    return self
+
+  def fetchone(self):
+    inicio = time.perf_counter()
+    linha = super().fetchone()
+    if self._sql is not None:
+      self._duracao += time.perf_counter() - inicio
+      if linha is None:
+        self._registrar()
+      else:
+        self._linhas += 1
+    return linha
+
+  def fetchmany(self, size=None):
+    tamanho = self.arraysize if size is None else size
+    inicio = time.perf_counter()
+    linhas = super().fetchmany(tamanho)
+    if self._sql is not None:
+      self._duracao += time.perf_counter() - inicio
+      self._linhas += len(linhas)
+      if len(linhas) < tamanho:
+        self._registrar()
+    return linhas
+
+  def fetchall(self):
+    inicio = time.perf_counter()
+    linhas = super().fetchall()
+    if self._sql is not None:
+      self._duracao += time.perf_counter() - inicio
+      self._linhas += len(linhas)
+      self._registrar()
+    return linhas
+
+  def __next__(self):
+    inicio = time.perf_counter()
+    try:
+      linha = super().__next__()
+    except StopIteration:
+      if self._sql is not None:
+        self._duracao += time.perf_counter() - inicio
+        self._registrar()
+      raise
+    if self._sql is not None:
+      self._duracao += time.perf_counter() - inicio
+      self._linhas += 1
+    return linha
+
+  def close(self):
+    self._registrar()
+    super().close()
+
+  def __del__(self):
+    # fetchone() de uma linha só nunca chega ao fim do resultado
+    self._registrar()
+
+
+class ConexaoMedida(ConexaoPool):
+  def cursor(self, factory=CursorMedido):
+    return super().cursor(factory)
+
+  def execute(self, sql, parametros=()):
+    return self.cursor().execute(sql, parametros)
+
+  def executemany(self, sql, parametros):
+    return self.cursor().executemany(sql, parametros)
+
+
+def _arquivo(pid):
+  return os.path.join(METRICAS_DIR, f'metricas-{pid}.json')
+
+
+def _gravar(caminho, dados):
+  temporario = f'{caminho}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(temporario, 'w', encoding='utf-8') as arquivo:
+    json.dump(dados, arquivo)
+  os.replace(temporario, caminho)
+
+
+def _ler(caminho):
+  try:
+    with open(caminho, 'r', encoding='utf-8') as arquivo:
+      return json.load(arquivo)
+  except (OSError, ValueError):
+    return None
+
+
+def salvar():
+  if not METRICAS_DIR:
+    return
+  registro = _registro()
+  try:
+    _gravar(_arquivo(registro.pid), registro.exportar())
+  except OSError:
+    logger.exception('Falha ao gravar métricas em %s', METRICAS_DIR)
+
+
+def _laco_gravacao():
+  while True:
+    time.sleep(METRICAS_INTERVALO)
+    salvar()
+
+
+def iniciar_gravacao():
+  # Uma thread por worker: o arquivo fica atualizado mesmo com o worker ocioso
+  if not METRICAS_DIR or _gravacao['pid'] == os.getpid():
+    return
+  with _lock:
+    if _gravacao['pid'] == os.getpid():
+      return
+    _gravacao['pid'] = os.getpid()
+    atexit.register(salvar)
+    threading.Thread(target=_laco_gravacao, name='gravacao-metricas', daemon=True).start()
+
+
+def limpar_diretorio():
+  # No início do master: arquivos de uma execução anterior não contam
+  if not METRICAS_DIR:
+    return
+  os.makedirs(METRICAS_DIR, exist_ok=True)
+  for caminho in glob.glob(os.path.join(METRICAS_DIR, 'metricas-*.json')):
+    os.remove(caminho)
+
+
+def arquivar_worker(pid):
+  # Chamado no master quando um worker termina: os contadores dele passam
+  # para o arquivo dos encerrados e o pid pode ser reaproveitado.
+  if not METRICAS_DIR:
+    return
+  dados = _ler(_arquivo(pid))
+  if dados is None:
+    return
+  encerrados = Registro()
+  encerrados.mesclar(_ler(os.path.join(METRICAS_DIR, ARQUIVO_ENCERRADOS)) or {})
+  encerrados.mesclar(dados)
+  try:
+    _gravar(os.path.join(METRICAS_DIR, ARQUIVO_ENCERRADOS), encerrados.exportar())
+    os.remove(_arquivo(pid))
+  except OSError:
+    logger.exception('Falha ao arquivar as métricas do worker %s', pid)
+
+
+def coletar():
+  registro = _registro()
+  total = Registro()
+  total.mesclar(registro.exportar())
+  if METRICAS_DIR:
+    proprio = _arquivo(registro.pid)
+    for caminho in glob.glob(os.path.join(METRICAS_DIR, 'metricas-*.json')):
+      if caminho != proprio:
+        total.mesclar(_ler(caminho) or {})
+  return total
+
+
+def _rotulos(pares):
+  if not pares:
+    return ''
+  texto = ','.join(
+    '{}="{}"'.format(nome, str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    for nome, valor in pares
+  )
+  return '{' + texto + '}'
+
+
+def texto_metricas():
+  total = coletar()
+  linhas = []
+  for nome, (tipo, descricao, *_) in METRICAS.items():
+    linhas.append(f'# HELP {nome} {descricao}')
+    linhas.append(f'# TYPE {nome} {tipo}')
+    if tipo == 'histogram':
+      for (metrica, rotulos), valores in sorted(total.histogramas.items()):
+        if metrica != nome:
+          continue
+        acumulado = 0
+        for limite, quantidade in zip(_faixas(nome) + ('+Inf',), valores):
+          acumulado += quantidade
+          linhas.append(f'{nome}_bucket{_rotulos(rotulos + (("le", limite),))} {acumulado}')
+        linhas.append(f'{nome}_sum{_rotulos(rotulos)} {valores[-1]}')
+        linhas.append(f'{nome}_count{_rotulos(rotulos)} {acumulado}')
+    elif nome == 'ecommerce_sql_info':
+      for consulta, texto in sorted(total.textos.items()):
+        linhas.append(f'{nome}{_rotulos((("consulta", consulta), ("sql", texto)))} 1')
+    else:
+      for (metrica, rotulos), valor in sorted(total.contadores.items()):
+        if metrica == nome:
+          linhas.append(f'{nome}{_rotulos(rotulos)} {valor}')
+  return '\n'.join(linhas) + '\n'
+
+
+def _iniciar_requisicao():
+  iniciar_gravacao()
+  g.inicio_requisicao = time.perf_counter()
+
+
+def _finalizar_requisicao(resposta):
+  inicio = g.pop('inicio_requisicao', None)
+  if inicio is not None:
+    rotulos = (
+      ('endpoint', request.endpoint or 'desconhecido'),
+      ('metodo', request.method),
+      ('status', str(resposta.status_code)),
+    )
+    _registro().observar('ecommerce_requisicao_segundos', rotulos, time.perf_counter() - inicio)
+  return resposta
+
+
+def _antes_template(sender, template, context, **extra):
+  g.setdefault('inicio_templates', []).append(time.perf_counter())
+
+
+def _depois_template(sender, template, context, **extra):
+  inicios = g.get('inicio_templates')
+  if inicios:
+    rotulos = (('template', template.name or 'inline'),)
+    _registro().observar('ecommerce_template_segundos', rotulos, time.perf_counter() - inicios.pop())
+
+
+def instrumentar(app):
+  if not METRICAS_ATIVAS:
+    return
+  # Registrado antes dos outros hooks: o tempo inclui todos eles
+  app.before_request(_iniciar_requisicao)
+  app.after_request(_finalizar_requisicao)
+  before_render_template.connect(_antes_template, app)
+  template_rendered.connect(_depois_template, app)
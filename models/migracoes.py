@@ -0,0 +1,421 @@
+import os
+import sqlite3
+import time
+
+import click
+from flask.cli import AppGroup
+
+from models.model import DB_SCHEMA, conexao_dedicada, popular_produtos
+
+MIGRACOES = []
+
+
+def migracao(versao, descricao):
+  def registrar(funcao):
+    MIGRACOES.append((versao, descricao, funcao))
+    MIGRACOES.sort(key=lambda m: m[0])
+    return funcao
+  return registrar
+
+
+def executar_script(conexao, script_sql):
+  # executescript() faz COMMIT antes de rodar; aqui cada comando roda
+  # dentro da transação da migração.
+  comando = ''
+  for linha in script_sql.splitlines(keepends=True):
+    comando += linha
+    if sqlite3.complete_statement(comando):
+      conexao.execute(comando)
+      comando = ''
+  if comando.strip() and not comando.strip().startswith('--'):
+    conexao.execute(comando)
+
+
+@migracao(1, 'schema inicial')
+def _schema_inicial(conexao):
+  if not os.path.exists(DB_SCHEMA):
+    raise FileNotFoundError(f"Arquivo SQL não encontrado: {DB_SCHEMA}")
+
+  with open(DB_SCHEMA, 'r', encoding='utf-8') as arquivo:
+    script_sql = arquivo.read()
+
+  # Bancos criados antes do controle de versão já têm as tabelas
+  script_sql = script_sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS')
+  executar_script(conexao, script_sql)
+
+
+@migracao(2, 'produtos iniciais')
+def _produtos_iniciais(conexao):
+  popular_produtos(conexao)
+
+
+@migracao(3, 'índices das consultas frequentes')
+def _indices_consultas(conexao):
+  executar_script(conexao, '''
+    CREATE INDEX IF NOT EXISTS idx_carrinho_cliente_produto
+      ON carrinho_compras (cliente_id, produto_id);
+
+    -- cobre o SELECT do login sem ir à tabela (id é o rowid)
+    CREATE INDEX IF NOT EXISTS idx_clientes_email_login
+      ON clientes (email, nome, senha_hash);
+
+    -- só produtos em estoque, já na ordem do catálogo
+    CREATE INDEX IF NOT EXISTS idx_produtos_disponiveis_nome
+      ON produtos (nome) WHERE estoque > 0;
+
+    CREATE INDEX IF NOT EXISTS idx_itens_pedido_pedido
+      ON itens_pedido (pedido_id, produto_id, quantidade, preco_unitario);
+
+    CREATE INDEX IF NOT EXISTS idx_pagamentos_pedido
+      ON pagamentos (pedido_id);
+  ''')
+
+
+@migracao(4, 'geração do catálogo')
+def _geracao_catalogo(conexao):
+  executar_script(conexao, '''
+    CREATE TABLE IF NOT EXISTS catalogo_versao (
+      id INTEGER PRIMARY KEY CHECK (id = 1),
+      geracao INTEGER NOT NULL
+    );
+
+    INSERT OR IGNORE INTO catalogo_versao (id, geracao) VALUES (1, 1);
+  ''')
+
+
+@migracao(5, 'busca textual de produtos (FTS5)')
+def _busca_produtos(conexao):
+  executar_script(conexao, '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS produtos_fts USING fts5(
+      nome, descricao,
+      content='produtos', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS produtos_fts_insert AFTER INSERT ON produtos BEGIN
+      INSERT INTO produtos_fts (rowid, nome, descricao) VALUES (new.id, new.nome, new.descricao);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS produtos_fts_delete AFTER DELETE ON produtos BEGIN
+      INSERT INTO produtos_fts (produtos_fts, rowid, nome, descricao) VALUES ('delete', old.id, old.nome, old.descricao);
+    END;
+
+    -- só nome/descrição: mudanças de preço e estoque não mexem no índice
+    CREATE TRIGGER IF NOT EXISTS produtos_fts_update AFTER UPDATE OF nome, descricao ON produtos BEGIN
+      INSERT INTO produtos_fts (produtos_fts, rowid, nome, descricao) VALUES ('delete', old.id, old.nome, old.descricao);
+      INSERT INTO produtos_fts (rowid, nome, descricao) VALUES (new.id, new.nome, new.descricao);
+    END;
+
+    INSERT INTO produtos_fts (produtos_fts) VALUES ('rebuild');
+  ''')
+
+
+@migracao(6, 'item único por cliente no carrinho')
+def _carrinho_item_unico(conexao):
+  executar_script(conexao, '''
+    UPDATE carrinho_compras
+    SET quantidade = (
+      SELECT SUM(d.quantidade) FROM carrinho_compras d
+      WHERE d.cliente_id = carrinho_compras.cliente_id AND d.produto_id = carrinho_compras.produto_id
+    )
+    WHERE id IN (
+      SELECT MIN(id) FROM carrinho_compras
+      WHERE cliente_id IS NOT NULL
+      GROUP BY cliente_id, produto_id HAVING COUNT(*) > 1
+    );
+
+    DELETE FROM carrinho_compras
+    WHERE cliente_id IS NOT NULL AND id NOT IN (
+      SELECT MIN(id) FROM carrinho_compras
+      WHERE cliente_id IS NOT NULL
+      GROUP BY cliente_id, produto_id
+    );
+
+    DROP INDEX IF EXISTS idx_carrinho_cliente_produto;
+
+    -- visitantes (cliente_id NULL) não colidem: NULLs são distintos
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_carrinho_cliente_produto
+      ON carrinho_compras (cliente_id, produto_id);
+  ''')
+
+
+@migracao(7, 'carrinho de visitante por sessão')
+def _carrinho_por_sessao(conexao):
+  executar_script(conexao, '''
+    ALTER TABLE carrinho_compras ADD COLUMN sessao_id TEXT;
+
+    -- o carrinho compartilhado por todos os visitantes não tem dono
+    DELETE FROM carrinho_compras WHERE cliente_id IS NULL;
+
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_carrinho_sessao_produto
+      ON carrinho_compras (sessao_id, produto_id) WHERE cliente_id IS NULL;
+
+    CREATE INDEX IF NOT EXISTS idx_carrinho_visitante_criado
+      ON carrinho_compras (criado_em) WHERE cliente_id IS NULL;
+  ''')
+
+
+@migracao(8, 'total gravado no pedido')
+def _total_do_pedido(conexao):
+  executar_script(conexao, '''
+    ALTER TABLE pedidos ADD COLUMN total NUMERIC(10,2);
+
+    UPDATE pedidos SET total = (
+      SELECT COALESCE(SUM(ip.quantidade * ip.preco_unitario), 0)
+      FROM itens_pedido ip WHERE ip.pedido_id = pedidos.id
+    );
+
+    -- histórico do cliente do mais novo para o mais antigo
+    CREATE INDEX IF NOT EXISTS idx_pedidos_cliente
+      ON pedidos (cliente_id, id);
+  ''')
+
+
+@migracao(9, 'fila de tarefas')
+def _fila_de_tarefas(conexao):
+  executar_script(conexao, '''
+    CREATE TABLE IF NOT EXISTS tarefas (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      tipo TEXT NOT NULL,
+      dados TEXT NOT NULL,
+      chave TEXT UNIQUE,
+      status TEXT NOT NULL DEFAULT 'pendente',
+      tentativas INTEGER NOT NULL DEFAULT 0,
+      max_tentativas INTEGER NOT NULL,
+      executar_em REAL NOT NULL,
+      travada_ate REAL,
+      erro TEXT,
+      criada_em DATETIME DEFAULT CURRENT_TIMESTAMP,
+      concluida_em DATETIME
+    );
+
+    -- só as pendentes, na ordem em que vencem
+    CREATE INDEX IF NOT EXISTS idx_tarefas_pendentes
+      ON tarefas (executar_em) WHERE status = 'pendente';
+
+    CREATE INDEX IF NOT EXISTS idx_tarefas_executando
+      ON tarefas (travada_ate) WHERE status = 'executando';
+  ''')
+
+
+@migracao(10, 'sessões no servidor')
+def _sessoes_servidor(conexao):
+  executar_script(conexao, '''
+    -- id é o hash do token do cookie: o banco não guarda tokens válidos
+    CREATE TABLE IF NOT EXISTS sessoes (
+      id TEXT PRIMARY KEY,
+      versao INTEGER NOT NULL,
+      dados TEXT NOT NULL,
+      cliente_id INTEGER,
+      expira_em REAL NOT NULL
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_sessoes_expira
+      ON sessoes (expira_em);
+
+    CREATE INDEX IF NOT EXISTS idx_sessoes_cliente
+      ON sessoes (cliente_id) WHERE cliente_id IS NOT NULL;
+  ''')
+
+
+@migracao(11, 'sku dos produtos para importação')
+def _sku_produtos(conexao):
+  executar_script(conexao, '''
+    ALTER TABLE produtos ADD COLUMN sku TEXT;
+
+    -- produtos cadastrados antes dos feeds não têm sku
+    CREATE UNIQUE INDEX IF NOT EXISTS uq_produtos_sku
+      ON produtos (sku) WHERE sku IS NOT NULL;
+
+    -- o upsert da importação reescreve nome/descrição iguais: sem o WHEN
+    -- cada linha do feed custaria um delete + insert no índice FTS
+    DROP TRIGGER IF EXISTS produtos_fts_update;
+    CREATE TRIGGER produtos_fts_update AFTER UPDATE OF nome, descricao ON produtos
+    WHEN old.nome IS NOT new.nome OR old.descricao IS NOT new.descricao BEGIN
+      INSERT INTO produtos_fts (produtos_fts, rowid, nome, descricao) VALUES ('delete', old.id, old.nome, old.descricao);
+      INSERT INTO produtos_fts (rowid, nome, descricao) VALUES (new.id, new.nome, new.descricao);
+    END;
+  ''')
+
+
+@migracao(12, 'reservas de estoque')
+def _reservas_estoque(conexao):
+  executar_script(conexao, '''
+    -- estoque_disponivel = estoque - reservas; os gatilhos mantêm a conta
+    -- em qualquer caminho que mexa em estoque ou em reservas
+    ALTER TABLE produtos ADD COLUMN estoque_disponivel INTEGER NOT NULL DEFAULT 0;
+    UPDATE produtos SET estoque_disponivel = estoque;
+
+    -- dono: 'cliente:<id>' ou 'sessao:<token>', como as chaves do carrinho
+    CREATE TABLE IF NOT EXISTS reservas (
+      id INTEGER PRIMARY KEY,
+      dono TEXT NOT NULL,
+      produto_id INTEGER NOT NULL,
+      quantidade INTEGER NOT NULL CHECK (quantidade > 0),
+      expira_em REAL NOT NULL,
+      UNIQUE (dono, produto_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_reservas_expira
+      ON reservas (expira_em);
+
+    -- reservas vencidas de um produto esgotado, liberadas na hora
+    CREATE INDEX IF NOT EXISTS idx_reservas_produto_expira
+      ON reservas (produto_id, expira_em);
+
+    CREATE TRIGGER IF NOT EXISTS reservas_insert AFTER INSERT ON reservas BEGIN
+      UPDATE produtos SET estoque_disponivel = estoque_disponivel - new.quantidade WHERE id = new.produto_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reservas_update AFTER UPDATE OF quantidade ON reservas BEGIN
+      UPDATE produtos SET estoque_disponivel = estoque_disponivel - new.quantidade + old.quantidade WHERE id = new.produto_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS reservas_delete AFTER DELETE ON reservas BEGIN
+      UPDATE produtos SET estoque_disponivel = estoque_disponivel + old.quantidade WHERE id = old.produto_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS produtos_estoque_insert AFTER INSERT ON produtos BEGIN
+      UPDATE produtos SET estoque_disponivel = new.estoque WHERE id = new.id;
+    END;
+
+    -- checkout, cancelamento e importação mexem só no estoque
+    CREATE TRIGGER IF NOT EXISTS produtos_estoque_update AFTER UPDATE OF estoque ON produtos
+    WHEN old.estoque IS NOT new.estoque BEGIN
+      UPDATE produtos SET estoque_disponivel = estoque_disponivel + new.estoque - old.estoque WHERE id = new.id;
+    END;
+  ''')
+
+
+@migracao(13, 'índices da fila de tarefas para reprocessar e limpar')
+def _indices_tarefas_encerradas(conexao):
+  executar_script(conexao, '''
+    -- reprocessar: só as que esgotaram as tentativas, por tipo
+    CREATE INDEX IF NOT EXISTS idx_tarefas_falhou
+      ON tarefas (tipo) WHERE status = 'falhou';
+
+    -- retenção: concluídas mais antigas primeiro
+    CREATE INDEX IF NOT EXISTS idx_tarefas_concluidas
+      ON tarefas (concluida_em) WHERE status = 'concluida';
+  ''')
+
+
+def _criar_tabela_versao(conexao):
+  conexao.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+      versao INTEGER PRIMARY KEY,
+      descricao TEXT NOT NULL,
+      aplicada_em DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+  ''')
+  conexao.commit()
+
+
+def versao_atual(conexao):
+  try:
+    linha = conexao.execute('SELECT MAX(versao) FROM schema_version').fetchone()
+  except sqlite3.OperationalError:
+    return 0
+  return linha[0] or 0
+
+
+def versao_esperada():
+  return MIGRACOES[-1][0] if MIGRACOES else 0
+
+
+def migrar(conexao, eco=None):
+  aplicadas = []
+  _criar_tabela_versao(conexao)
+
+  for versao, descricao, funcao in MIGRACOES:
+    # BEGIN IMMEDIATE serializa workers/processos concorrentes: quem
+    # chegar depois relê a versão e pula o que já foi aplicado.
+    conexao.execute('BEGIN IMMEDIATE')
+    try:
+      if versao_atual(conexao) >= versao:
+        conexao.rollback()
+        continue
+
+      inicio = time.perf_counter()
+      funcao(conexao)
+      conexao.execute(
+        'INSERT INTO schema_version (versao, descricao) VALUES (?, ?)',
+        (versao, descricao)
+      )
+      conexao.commit()
+    except Exception:
+      conexao.rollback()
+      raise
+
+    aplicadas.append(versao)
+    if eco:
+      eco(f'{versao:04d} {descricao} ({time.perf_counter() - inicio:.3f}s)')
+
+  return aplicadas
+
+
+def aplicar_migracoes(eco=None):
+  with conexao_dedicada() as conexao:
+    return migrar(conexao, eco)
+
+
+def verificar_versao():
+  with conexao_dedicada() as conexao:
+    atual = versao_atual(conexao)
+  return atual, versao_esperada()
+
+
+cli = AppGroup('db', help='Migrações do banco de dados.')
+
+
+@cli.command('upgrade')
+def upgrade_comando():
+  """Aplica as migrações pendentes."""
+  aplicadas = aplicar_migracoes(eco=click.echo)
+  if not aplicadas:
+    click.echo(f'Banco já está na versão {versao_esperada()}.')
+
+
+@cli.command('status')
+def status_comando():
+  """Mostra a versão atual do schema."""
+  atual, esperada = verificar_versao()
+  click.echo(f'Versão atual: {atual} / esperada: {esperada}')
+  if atual < esperada:
+    for versao, descricao, _ in MIGRACOES:
+      if versao > atual:
+        click.echo(f'  pendente: {versao:04d} {descricao}')
+
+
+@cli.command('planos')
+@click.argument('arquivos', nargs=-1)
+@click.option('-v', '--verbose', is_flag=True, help='Mostra o plano de todas as consultas.')
+def planos_comando(arquivos, verbose):
+  """Roda EXPLAIN QUERY PLAN nas consultas do código e falha se alguma varrer uma tabela."""
+  from models.metricas import impressao
+  from models.planos import analisar, arquivos_padrao, extrair_consultas
+
+  # Banco em memória com o schema atual: não depende dos dados locais
+  conexao = sqlite3.connect(':memory:')
+  try:
+    migrar(conexao)
+    consultas = []
+    for caminho in arquivos or arquivos_padrao():
+      consultas.extend(extrair_consultas(caminho))
+    resultados = analisar(conexao, consultas)
+  finally:
+    conexao.close()
+
+  falhas = 0
+  for caminho, linha, sql, plano, falhou in resultados:
+    if falhou:
+      falhas += 1
+    if falhou or verbose:
+      click.echo(f'{"VARREDURA" if falhou else "ok"} {caminho}:{linha} [{impressao(sql)}]')
+      click.echo('  ' + ' '.join(sql.split()))
+      for detalhe in plano:
+        click.echo(f'    {detalhe}')
+
+  click.echo(f'{len(resultados)} consultas verificadas, {falhas} com varredura de tabela.')
+  if falhas:
+    raise SystemExit(1)
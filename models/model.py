@@ -1,44 +1,152 @@
 import sqlite3
 import os
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
 
-DB_PATH = os.path.join('database', 'ecommerce.db')
+from flask import g, has_app_context, request
+
+from models.metricas import METRICAS_ATIVAS, ConexaoMedida
+from models.pool import ConexaoPool, obter_pool
+
+DB_PATH = os.environ.get('DB_PATH', os.path.join('database', 'ecommerce.db'))
 DB_SCHEMA = os.path.join('database', 'script-database.sql')
 
-def conectar_db():
+# Com as métricas ligadas cada comando SQL é cronometrado
+FABRICA_CONEXAO = ConexaoMedida if METRICAS_ATIVAS else ConexaoPool
+
+# Leituras das rotas marcadas como somente leitura:
+#   primario: mesma conexão das escritas
+#   ro: conexão mode=ro no arquivo principal (padrão)
+#   replica: rotas que aceitam atraso leem de uma cópia atualizada a cada
+#            DB_REPLICA_INTERVALO segundos pela API de backup do SQLite
+DB_LEITURA = os.environ.get('DB_LEITURA', 'ro')
+DB_REPLICA_PATH = os.environ.get('DB_REPLICA_PATH', os.path.join('database', 'ecommerce-replica.db'))
+DB_REPLICA_INTERVALO = float(os.environ.get('DB_REPLICA_INTERVALO', '5'))
+
+if DB_LEITURA not in ('primario', 'ro', 'replica'):
+  raise RuntimeError(f'DB_LEITURA inválido: {DB_LEITURA}')
+
+DB_TENTATIVAS_OCUPADO = int(os.environ.get('DB_TENTATIVAS_OCUPADO', '5'))
+DB_ESPERA_OCUPADO_MS = float(os.environ.get('DB_ESPERA_OCUPADO_MS', '20'))
+
+_replica = {'pronta': False}
+
+
+def replica_pronta():
+  if not _replica['pronta']:
+    _replica['pronta'] = os.path.exists(DB_REPLICA_PATH)
+  return _replica['pronta']
+
+
+def _pool_leitura(leitura):
+  if leitura == 'replica' and DB_LEITURA == 'replica' and replica_pronta():
+    return 'conexao_replica', obter_pool(DB_REPLICA_PATH, FABRICA_CONEXAO, somente_leitura=True)
+  return 'conexao_leitura', obter_pool(DB_PATH, FABRICA_CONEXAO, somente_leitura=True)
+
+
+def conectar_db(escrita=False):
+  # Dentro de uma requisição a conexão é emprestada do pool uma única vez
+  # e devolvida no teardown; fora dela, close() devolve ao pool. Rotas
+  # marcadas com g.leitura recebem uma conexão que não grava, a menos que
+  # quem chama precise gravar (a sessão, por exemplo).
   try:
-    conexao = sqlite3.connect(DB_PATH)
-    conexao.row_factory = sqlite3.Row
-    return conexao
+    if has_app_context():
+      leitura = None if escrita else g.get('leitura')
+      if leitura is not None and DB_LEITURA != 'primario':
+        nome, pool = _pool_leitura(leitura)
+      else:
+        nome, pool = 'conexao', obter_pool(DB_PATH, FABRICA_CONEXAO)
+      if nome not in g:
+        setattr(g, nome, pool.obter())
+      return getattr(g, nome)
+    return obter_pool(DB_PATH, FABRICA_CONEXAO).obter()
   except sqlite3.Error as e:
     raise sqlite3.Error(f"Erro ao conectar ao banco de dados: {e}")
 
 
-def criar_banco():
-  if not os.path.exists(DB_SCHEMA):
-    raise FileNotFoundError(f"Arquivo SQL não encontrado: {DB_SCHEMA}")
-  
-  conexao = conectar_db()
-  
+def lendo_da_replica():
+  return has_app_context() and 'conexao_replica' in g
+
+
+def somente_leitura(replica=False):
+  # GETs que não gravam usam uma conexão mode=ro; com replica=True a rota
+  # aceita ler dados com até DB_REPLICA_INTERVALO segundos de atraso.
+  def decorador(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+      if request.method == 'GET':
+        g.leitura = 'replica' if replica else 'ro'
+      return f(*args, **kwargs)
+    return decorated_function
+  return decorador
+
+
+@contextmanager
+def conexao_dedicada(somente_leitura=False):
+  # Conexão fora do escopo da requisição (CLI, threads, geradores)
+  somente_leitura = somente_leitura and DB_LEITURA != 'primario'
+  conexao = obter_pool(DB_PATH, FABRICA_CONEXAO, somente_leitura=somente_leitura).obter()
   try:
-    with open(DB_SCHEMA, 'r', encoding='utf-8') as arquivo:
-      script_sql = arquivo.read()
-    
-    script_sql = script_sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS')
-    
-    conexao.executescript(script_sql)
-    conexao.commit()
-    
-    popular_produtos()
-    
-  except sqlite3.Error as e:
-    conexao.rollback()
-    raise
+    yield conexao
   finally:
     conexao.close()
 
 
-def popular_produtos():
-  conexao = conectar_db()
+@contextmanager
+def transacao_imediata(conexao):
+  # Pega o lock de escrita já no BEGIN: leituras e escritas da transação
+  # enxergam o mesmo estado e não há upgrade de lock no meio do caminho.
+  conexao.execute('BEGIN IMMEDIATE')
+  try:
+    yield conexao
+  except BaseException:
+    conexao.rollback()
+    raise
+  conexao.commit()
+
+
+def banco_ocupado(erro):
+  codigo = getattr(erro, 'sqlite_errorcode', None)
+  if codigo is not None:
+    return codigo & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+  return 'locked' in str(erro) or 'busy' in str(erro)
+
+
+def repetir_se_ocupado(funcao, tentativas=DB_TENTATIVAS_OCUPADO, espera_ms=DB_ESPERA_OCUPADO_MS, conexao=None):
+  # Sem conexao explícita, desfaz o que ficou pendente na conexão de
+  # escrita da requisição antes de tentar de novo
+  for tentativa in range(tentativas):
+    try:
+      return funcao()
+    except sqlite3.OperationalError as e:
+      if not banco_ocupado(e) or tentativa == tentativas - 1:
+        raise
+      pendente = conexao if conexao is not None else (g.get('conexao') if has_app_context() else None)
+      if pendente is not None and pendente.in_transaction:
+        pendente.rollback()
+      # backoff exponencial com jitter para os workers não colidirem de novo
+      atraso = espera_ms * (2 ** tentativa) * (0.5 + random.random())
+      time.sleep(atraso / 1000)
+
+
+def liberar_conexao(exc=None):
+  for nome in ('conexao', 'conexao_leitura', 'conexao_replica'):
+    conexao = g.pop(nome, None)
+    if conexao is not None:
+      conexao.close()
+
+
+def estatisticas_pool():
+  estatisticas = obter_pool(DB_PATH, FABRICA_CONEXAO).estatisticas()
+  estatisticas['leitura'] = obter_pool(DB_PATH, FABRICA_CONEXAO, somente_leitura=True).estatisticas()
+  if DB_LEITURA == 'replica':
+    estatisticas['replica'] = obter_pool(DB_REPLICA_PATH, FABRICA_CONEXAO, somente_leitura=True).estatisticas()
+  return estatisticas
+
+
+def popular_produtos(conexao):
   cursor = conexao.cursor()
   
   produtos = [
@@ -64,18 +172,12 @@ def popular_produtos():
     ('Hub USB-C 7 em 1', 'Hub USB-C com HDMI, USB 3.0, leitor de cartão SD, carregamento pass-through', 249.90, 22),
   ]
   
-  try:
-    cursor.execute('SELECT COUNT(*) FROM produtos')
-    count = cursor.fetchone()[0]
-    
-    if count == 0:
-      cursor.executemany(
-        'INSERT INTO produtos (nome, descricao, preco, estoque) VALUES (?, ?, ?, ?)',
-        produtos
-      )
-      conexao.commit()
-  except sqlite3.Error as e:
-    conexao.rollback()
-  finally:
-    conexao.close()
+  cursor.execute('SELECT COUNT(*) FROM produtos')
+  count = cursor.fetchone()[0]
+  
+  if count == 0:
+    cursor.executemany(
+      'INSERT INTO produtos (nome, descricao, preco, estoque) VALUES (?, ?, ?, ?)',
+      produtos
+    )
 
@@ -0,0 +1,186 @@
+import csv
+import io
+import json
+import os
+
+import click
+from flask.cli import AppGroup
+
+from models.carrinho import Dono, EstoqueIndisponivel, chave_dono
+from models.catalogo import invalidar_catalogo
+from models.model import conexao_dedicada, transacao_imediata
+from models.reservas import liberar, reservar
+from models.tarefas import enfileirar
+
+PEDIDOS_POR_PAGINA = int(os.environ.get('PEDIDOS_POR_PAGINA', '20'))
+PEDIDOS_EXPORTAR_LOTE = int(os.environ.get('PEDIDOS_EXPORTAR_LOTE', '1000'))
+
+
+class CarrinhoVazio(Exception):
+  pass
+
+
+class EstoqueInsuficiente(Exception):
+  def __init__(self, nome_produto):
+    super().__init__(f'Produto "{nome_produto}" sem estoque suficiente.')
+    self.nome_produto = nome_produto
+
+
+# Os itens já chegam com o estoque reservado pelo carrinho; só quem não
+# tem reserva (vencida e liberada) disputa o estoque disponível aqui.
+SQL_ITENS_CARRINHO = '''
+  SELECT c.produto_id, c.nome_produto, c.preco_unitario, c.quantidade, r.quantidade AS reservada
+  FROM carrinho_compras c
+  LEFT JOIN reservas r ON r.dono = ? AND r.produto_id = c.produto_id
+  WHERE c.cliente_id = ?
+'''
+
+# A condição no WHERE é só uma proteção: a reserva já garante o estoque,
+# a menos que uma importação o tenha reduzido abaixo do reservado.
+SQL_BAIXAR_ESTOQUE = 'UPDATE produtos SET estoque = estoque - ? WHERE id = ? AND estoque >= ?'
+
+# Paginação por id decrescente: cada página é uma busca no índice
+# (cliente_id, id), por mais antigo que seja o pedido.
+SQL_HISTORICO = '''
+  SELECT p.id, p.data, p.status, p.total, pg.tipo AS pagamento_tipo, pg.status AS pagamento_status
+  FROM pedidos p
+  LEFT JOIN pagamentos pg ON pg.pedido_id = p.id
+  WHERE p.cliente_id = ? AND p.id < ?
+  ORDER BY p.id DESC LIMIT ?
+'''
+
+SQL_EXPORTAR_CLIENTE = '''
+  SELECT p.id, p.cliente_id, c.email AS cliente_email, p.data, p.status, p.total,
+         pg.tipo AS pagamento_tipo, pg.status AS pagamento_status
+  FROM pedidos p
+  JOIN clientes c ON c.id = p.cliente_id
+  LEFT JOIN pagamentos pg ON pg.pedido_id = p.id
+  WHERE p.cliente_id = ?
+  ORDER BY p.id
+'''
+
+SQL_EXPORTAR_TODOS = '''
+  SELECT p.id, p.cliente_id, c.email AS cliente_email, p.data, p.status, p.total,
+         pg.tipo AS pagamento_tipo, pg.status AS pagamento_status
+  FROM pedidos p
+  JOIN clientes c ON c.id = p.cliente_id
+  LEFT JOIN pagamentos pg ON pg.pedido_id = p.id
+  ORDER BY p.id
+  -- varredura intencional: exportação de todos os pedidos
+'''
+
+CAMPOS_EXPORTACAO = ('id', 'cliente_id', 'cliente_email', 'data', 'status', 'total', 'pagamento_tipo', 'pagamento_status')
+FORMATOS_EXPORTACAO = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def finalizar_pedido(conexao, cliente_id, tipo_pagamento, carrinho=None):
+  with transacao_imediata(conexao):
+    if carrinho is not None:
+      try:
+        carrinho.persistir(conexao, cliente_id)
+      except EstoqueIndisponivel as e:
+        produto = conexao.execute('SELECT nome FROM produtos WHERE id = ?', (e.produto_id,)).fetchone()
+        raise EstoqueInsuficiente(produto['nome'] if produto else e.produto_id)
+
+    dono = chave_dono(Dono(cliente_id, None))
+    cursor = conexao.cursor()
+    itens = cursor.execute(SQL_ITENS_CARRINHO, (dono, cliente_id)).fetchall()
+
+    if not itens:
+      raise CarrinhoVazio()
+
+    for item in itens:
+      if (item['reservada'] or 0) < item['quantidade'] and not reservar(conexao, dono, item['produto_id'], item['quantidade']):
+        raise EstoqueInsuficiente(item['nome_produto'])
+
+    # Converte as reservas em baixa: o estoque cai e as reservas somem, o
+    # disponível (estoque - reservas) fica como estava. Um item por vez:
+    # se faltar estoque, o erro nomeia o produto que faltou.
+    for item in itens:
+      cursor.execute(SQL_BAIXAR_ESTOQUE, (item['quantidade'], item['produto_id'], item['quantidade']))
+      if cursor.rowcount != 1:
+        raise EstoqueInsuficiente(item['nome_produto'])
+
+    total = sum(item['preco_unitario'] * item['quantidade'] for item in itens)
+
+    cursor.execute(
+      'INSERT INTO pedidos (cliente_id, status, total) VALUES (?, ?, ?)',
+      (cliente_id, 'pendente', round(total, 2))
+    )
+    pedido_id = cursor.lastrowid
+
+    cursor.executemany(
+      'INSERT INTO itens_pedido (pedido_id, produto_id, quantidade, preco_unitario) VALUES (?, ?, ?, ?)',
+      [(pedido_id, item['produto_id'], item['quantidade'], item['preco_unitario']) for item in itens]
+    )
+
+    cursor.execute(
+      'INSERT INTO pagamentos (pedido_id, tipo, valor, status) VALUES (?, ?, ?, ?)',
+      (pedido_id, tipo_pagamento, total, 'aguardando')
+    )
+
+    cursor.execute('DELETE FROM carrinho_compras WHERE cliente_id = ?', (cliente_id,))
+    liberar(conexao, dono)
+
+    # Cobrança e e-mail ficam para a fila: o checkout não espera o gateway
+    enfileirar(conexao, 'confirmar_pagamento', {'pedido_id': pedido_id}, chave=f'pagamento:{pedido_id}')
+
+    invalidar_catalogo(conexao)
+
+  return pedido_id
+
+
+def listar_pedidos(conexao, cliente_id, antes=None, por_pagina=PEDIDOS_POR_PAGINA):
+  limite = antes if antes else 2 ** 63 - 1
+  linhas = conexao.execute(SQL_HISTORICO, (cliente_id, limite, por_pagina + 1)).fetchall()
+  pedidos = [dict(linha) for linha in linhas[:por_pagina]]
+  proximo = pedidos[-1]['id'] if len(linhas) > por_pagina else None
+  return pedidos, proximo
+
+
+def _formatar(linhas, formato):
+  if formato == 'jsonl':
+    return ''.join(json.dumps(dict(linha), ensure_ascii=False) + '\n' for linha in linhas)
+  saida = io.StringIO()
+  csv.writer(saida).writerows(linhas)
+  return saida.getvalue()
+
+
+def exportar_pedidos(cliente_id=None, formato='csv', lote=PEDIDOS_EXPORTAR_LOTE):
+  # Gerador: a conexão só é aberta quando a resposta começa a ser enviada e
+  # o cursor é lido em lotes, então a memória não cresce com o histórico.
+  if formato not in FORMATOS_EXPORTACAO:
+    raise ValueError(f'Formato de exportação inválido: {formato}')
+
+  with conexao_dedicada(somente_leitura=True) as conexao:
+    cursor = conexao.cursor()
+    if cliente_id is None:
+      cursor.execute(SQL_EXPORTAR_TODOS)
+    else:
+      cursor.execute(SQL_EXPORTAR_CLIENTE, (cliente_id,))
+
+    if formato == 'csv':
+      yield _formatar([CAMPOS_EXPORTACAO], formato)
+    while True:
+      linhas = cursor.fetchmany(lote)
+      if not linhas:
+        break
+      yield _formatar(linhas, formato)
+
+
+cli = AppGroup('pedidos', help='Relatórios de pedidos.')
+
+
+@cli.command('exportar')
+@click.option('--cliente', 'cliente_id', type=int, help='Só os pedidos deste cliente (padrão: todos).')
+@click.option('--formato', type=click.Choice(sorted(FORMATOS_EXPORTACAO)), default='csv', show_default=True)
+@click.option('--saida', type=click.Path(dir_okay=False), help='Arquivo de saída (padrão: stdout).')
+def exportar_comando(cliente_id, formato, saida):
+  """Exporta o histórico de pedidos em CSV ou JSON lines."""
+  if saida:
+    with open(saida, 'w', encoding='utf-8', newline='') as arquivo:
+      for trecho in exportar_pedidos(cliente_id, formato):
+        arquivo.write(trecho)
+  else:
+    for trecho in exportar_pedidos(cliente_id, formato):
+      click.echo(trecho, nl=False)
@@ -0,0 +1,107 @@
+import ast
+import glob
+import os
+import re
+import sqlite3
+
+# Consultas do caminho quente; migrações e o seed ficam de fora
+ARQUIVOS = ('app.py', os.path.join('routes', '*.py'), os.path.join('models', '*.py'))
+IGNORADOS = ('model.py', 'migracoes.py', 'planos.py', 'pool.py')
+
+# Comando que precisa mesmo percorrer a tabela inteira deve dizer isso no SQL
+VARREDURA_INTENCIONAL = '-- varredura intencional'
+
+COMANDOS_VERIFICADOS = ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE', 'WITH')
+METODOS_SQL = ('execute', 'executemany')
+
+_LITERAIS = re.compile(r"'(?:[^']|'')*'")
+_TABELAS = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_VARREDURA = re.compile(r'^SCAN (\w+)$')
+
+
+def _constantes_modulo(arvore):
+  constantes = {}
+  for no in arvore.body:
+    if isinstance(no, ast.Assign) and isinstance(no.value, ast.Constant) and isinstance(no.value.value, str):
+      for alvo in no.targets:
+        if isinstance(alvo, ast.Name):
+          constantes[alvo.id] = no.value.value
+  return constantes
+
+
+def extrair_consultas(caminho):
+  with open(caminho, 'r', encoding='utf-8') as arquivo:
+    arvore = ast.parse(arquivo.read(), filename=caminho)
+
+  constantes = _constantes_modulo(arvore)
+  consultas = []
+  for no in ast.walk(arvore):
+    if not (isinstance(no, ast.Call) and isinstance(no.func, ast.Attribute)):
+      continue
+    if no.func.attr not in METODOS_SQL or not no.args:
+      continue
+
+    argumento = no.args[0]
+    if isinstance(argumento, ast.Constant) and isinstance(argumento.value, str):
+      sql = argumento.value
+    elif isinstance(argumento, ast.Name) and argumento.id in constantes:
+      sql = constantes[argumento.id]
+    else:
+      continue
+
+    if sql.strip().upper().startswith(COMANDOS_VERIFICADOS):
+      consultas.append((caminho, no.lineno, sql))
+  return consultas
+
+
+def parametros_nulos(sql):
+  # NULL em cada parâmetro: basta para o EXPLAIN QUERY PLAN
+  sem_literais = _LITERAIS.sub('', sql)
+  nomeados = re.findall(r'(?<!:):(\w+)', sem_literais)
+  if nomeados:
+    return {nome: None for nome in nomeados}
+  return [None] * sem_literais.count('?')
+
+
+def _tabelas_da_consulta(sql, tabelas):
+  apelidos = {}
+  for tabela, apelido in _TABELAS.findall(sql):
+    if tabela.lower() in tabelas:
+      apelidos[tabela.lower()] = tabela.lower()
+      if apelido and apelido.upper() not in ('WHERE', 'SET', 'ON', 'JOIN', 'LEFT', 'INNER', 'ORDER', 'GROUP', 'VALUES', 'SELECT', 'LIMIT', 'USING'):
+        apelidos[apelido.lower()] = tabela.lower()
+  return apelidos
+
+
+def analisar(conexao, consultas):
+  tabelas = {
+    linha[0].lower()
+    for linha in conexao.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+  }
+  resultados = []
+  for caminho, linha, sql in consultas:
+    try:
+      plano = [r[3] for r in conexao.execute('EXPLAIN QUERY PLAN ' + sql, parametros_nulos(sql))]
+    except sqlite3.Error as e:
+      resultados.append((caminho, linha, sql, [f'ERRO: {e}'], True))
+      continue
+
+    apelidos = _tabelas_da_consulta(sql, tabelas)
+    varreduras = []
+    for detalhe in plano:
+      encontrado = _VARREDURA.match(detalhe)
+      if encontrado and encontrado.group(1).lower() in apelidos:
+        varreduras.append(detalhe)
+
+    falhou = bool(varreduras) and VARREDURA_INTENCIONAL not in sql
+    resultados.append((caminho, linha, sql, plano, falhou))
+  return resultados
+
+
+def arquivos_padrao(raiz='.'):
+  caminhos = []
+  for padrao in ARQUIVOS:
+    for caminho in sorted(glob.glob(os.path.join(raiz, padrao))):
+      if os.path.basename(caminho) not in IGNORADOS:
+        caminhos.append(caminho)
+  return caminhos
@@ -0,0 +1,204 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+POOL_TAMANHO = int(os.environ.get('DB_POOL_TAMANHO', '8'))
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '5'))
+POOL_VERIFICAR_APOS = float(os.environ.get('DB_POOL_VERIFICAR_APOS', '30'))
+
+PRAGMAS = (
+  ('journal_mode', 'WAL'),
+  ('synchronous', 'NORMAL'),
+  ('busy_timeout', os.environ.get('DB_BUSY_TIMEOUT_MS', '5000')),
+  ('cache_size', os.environ.get('DB_CACHE_SIZE', '-16000')),
+  ('mmap_size', os.environ.get('DB_MMAP_SIZE', '268435456')),
+  ('temp_store', 'MEMORY'),
+)
+
+# mode=ro não grava: journal_mode e synchronous ficam com quem escreve
+PRAGMAS_LEITURA = tuple((nome, valor) for nome, valor in PRAGMAS if nome not in ('journal_mode', 'synchronous'))
+
+
+class ConexaoPool(sqlite3.Connection):
+  # close() devolve a conexão ao pool em vez de fechá-la
+  pool = None
+  devolvida_em = 0.0
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.devolver(self)
+    else:
+      super().close()
+
+  def fechar(self):
+    self.pool = None
+    super().close()
+
+
+class PoolConexoes:
+  def __init__(self, caminho, tamanho=POOL_TAMANHO, timeout=POOL_TIMEOUT, verificar_apos=POOL_VERIFICAR_APOS, fabrica=ConexaoPool, somente_leitura=False):
+    self.caminho = caminho
+    self.fabrica = fabrica
+    self.somente_leitura = somente_leitura
+    self.tamanho = tamanho
+    self.timeout = timeout
+    self.verificar_apos = verificar_apos
+    self.pid = os.getpid()
+    self._ociosas = queue.LifoQueue()
+    self._vagas = threading.BoundedSemaphore(tamanho)
+    self._lock = threading.Lock()
+    self._em_uso = set()
+    self._fechado = False
+    self.stats = {
+      'checkouts': 0,
+      'reutilizadas': 0,
+      'criadas': 0,
+      'esperas': 0,
+      'tempo_espera_total': 0.0,
+      'timeouts': 0,
+      'descartadas': 0,
+    }
+
+  def _nova_conexao(self):
+    if self.somente_leitura:
+      alvo = 'file:' + urllib.parse.quote(os.path.abspath(self.caminho)) + '?mode=ro'
+      pragmas = PRAGMAS_LEITURA
+    else:
+      alvo = self.caminho
+      pragmas = PRAGMAS
+    conexao = sqlite3.connect(
+      alvo,
+      uri=self.somente_leitura,
+      factory=self.fabrica,
+      check_same_thread=False,
+      cached_statements=256,
+    )
+    conexao.row_factory = sqlite3.Row
+    for nome, valor in pragmas:
+      conexao.execute(f'PRAGMA {nome} = {valor}')
+    conexao.pool = self
+    with self._lock:
+      self.stats['criadas'] += 1
+    return conexao
+
+  def _saudavel(self, conexao):
+    if time.monotonic() - conexao.devolvida_em < self.verificar_apos:
+      return True
+    try:
+      conexao.execute('SELECT 1').fetchone()
+      return True
+    except sqlite3.Error:
+      return False
+
+  def obter(self):
+    if self._fechado:
+      raise sqlite3.Error('Pool de conexões encerrado')
+
+    if not self._vagas.acquire(blocking=False):
+      inicio = time.monotonic()
+      obtida = self._vagas.acquire(timeout=self.timeout)
+      with self._lock:
+        self.stats['esperas'] += 1
+        self.stats['tempo_espera_total'] += time.monotonic() - inicio
+        if not obtida:
+          self.stats['timeouts'] += 1
+      if not obtida:
+        raise sqlite3.Error('Tempo esgotado aguardando conexão do pool')
+
+    try:
+      conexao = None
+      while conexao is None:
+        try:
+          candidata = self._ociosas.get_nowait()
+        except queue.Empty:
+          conexao = self._nova_conexao()
+          break
+        if self._saudavel(candidata):
+          conexao = candidata
+          with self._lock:
+            self.stats['reutilizadas'] += 1
+        else:
+          with self._lock:
+            self.stats['descartadas'] += 1
+          try:
+            candidata.fechar()
+          except sqlite3.Error:
+            pass
+    except Exception:
+      self._vagas.release()
+      raise
+
+    with self._lock:
+      self.stats['checkouts'] += 1
+      self._em_uso.add(id(conexao))
+    return conexao
+
+  def devolver(self, conexao):
+    with self._lock:
+      if id(conexao) not in self._em_uso:
+        return
+      self._em_uso.discard(id(conexao))
+
+    try:
+      if conexao.in_transaction:
+        conexao.rollback()
+      if self._fechado:
+        conexao.fechar()
+      else:
+        conexao.devolvida_em = time.monotonic()
+        self._ociosas.put(conexao)
+    except sqlite3.Error:
+      with self._lock:
+        self.stats['descartadas'] += 1
+      try:
+        conexao.fechar()
+      except sqlite3.Error:
+        pass
+    finally:
+      self._vagas.release()
+
+  def estatisticas(self):
+    with self._lock:
+      stats = dict(self.stats)
+      em_uso = len(self._em_uso)
+    checkouts = stats['checkouts']
+    stats['tamanho'] = self.tamanho
+    stats['em_uso'] = em_uso
+    stats['ociosas'] = self._ociosas.qsize()
+    stats['taxa_reuso'] = round(stats['reutilizadas'] / checkouts, 4) if checkouts else 0.0
+    stats['pid'] = self.pid
+    stats['somente_leitura'] = self.somente_leitura
+    return stats
+
+  def fechar(self):
+    self._fechado = True
+    while True:
+      try:
+        conexao = self._ociosas.get_nowait()
+      except queue.Empty:
+        break
+      try:
+        conexao.fechar()
+      except sqlite3.Error:
+        pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def obter_pool(caminho, fabrica=ConexaoPool, somente_leitura=False):
+  # Um pool por processo: após o fork do gunicorn o pool herdado é descartado
+  chave = (caminho, somente_leitura)
+  pool = _pools.get(chave)
+  if pool is not None and pool.pid == os.getpid():
+    return pool
+  with _pools_lock:
+    pool = _pools.get(chave)
+    if pool is None or pool.pid != os.getpid():
+      pool = PoolConexoes(caminho, fabrica=fabrica, somente_leitura=somente_leitura)
+      _pools[chave] = pool
+    return pool
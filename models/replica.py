@@ -0,0 +1,60 @@
+import fcntl
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from models.model import DB_LEITURA, DB_PATH, DB_REPLICA_INTERVALO, DB_REPLICA_PATH
+
+logger = logging.getLogger(__name__)
+
+
+def atualizar_replica(origem=DB_PATH, destino=DB_REPLICA_PATH, intervalo=0):
+  # Um processo copia por vez; quem não pega a trava, ou encontra uma cópia
+  # mais nova que o intervalo, pula esta rodada.
+  with open(destino + '.lock', 'a+') as trava:
+    try:
+      fcntl.flock(trava, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return False
+    if intervalo and os.path.exists(destino) and time.time() - os.path.getmtime(trava.name) < intervalo:
+      return False
+
+    fonte = sqlite3.connect(origem, timeout=30)
+    alvo = sqlite3.connect(destino, timeout=30)
+    try:
+      # Em WAL quem está lendo a réplica continua no snapshot anterior
+      # enquanto a cópia nova é gravada.
+      alvo.execute('PRAGMA journal_mode = WAL')
+      fonte.backup(alvo)
+    finally:
+      alvo.close()
+      fonte.close()
+    os.utime(trava.name)
+    return True
+
+
+_atualizacao = {'pid': None}
+_atualizacao_lock = threading.Lock()
+
+
+def _laco_replica():
+  while True:
+    time.sleep(DB_REPLICA_INTERVALO * (0.5 + random.random() / 2))
+    try:
+      atualizar_replica(intervalo=DB_REPLICA_INTERVALO)
+    except Exception:
+      logger.exception('Falha ao atualizar a réplica de leitura')
+
+
+def iniciar_atualizacao_replica():
+  # Uma thread por processo; a trava em arquivo garante uma cópia por intervalo
+  if DB_LEITURA != 'replica' or _atualizacao['pid'] == os.getpid():
+    return
+  with _atualizacao_lock:
+    if _atualizacao['pid'] == os.getpid():
+      return
+    _atualizacao['pid'] = os.getpid()
+    threading.Thread(target=_laco_replica, name='atualizacao-replica', daemon=True).start()
@@ -0,0 +1,134 @@
+import logging
+import os
+import random
+import threading
+import time
+
+from models.model import conexao_dedicada, repetir_se_ocupado
+
+# Quanto tempo uma unidade fica presa no carrinho sem o dono mexer nele
+RESERVAS_MINUTOS = float(os.environ.get('RESERVAS_MINUTOS', '15'))
+RESERVAS_LIMPEZA_INTERVALO = float(os.environ.get('RESERVAS_LIMPEZA_INTERVALO', '60'))
+RESERVAS_LIMPEZA_LOTE = int(os.environ.get('RESERVAS_LIMPEZA_LOTE', '500'))
+
+logger = logging.getLogger(__name__)
+
+# Um único comando valida e reserva: a quantidade total do dono cabe no que
+# está disponível mais o que ele já tinha reservado. Sem linha alterada,
+# não cabe.
+SQL_RESERVAR = '''
+  INSERT INTO reservas (dono, produto_id, quantidade, expira_em)
+  SELECT :dono, p.id, :quantidade, :expira_em FROM produtos p
+  WHERE p.id = :produto_id
+    AND p.estoque_disponivel + COALESCE(
+      (SELECT r.quantidade FROM reservas r WHERE r.dono = :dono AND r.produto_id = p.id), 0
+    ) >= :quantidade
+  ON CONFLICT (dono, produto_id) DO UPDATE
+  SET quantidade = excluded.quantidade, expira_em = excluded.expira_em
+'''
+
+SQL_DISPONIVEL = '''
+  SELECT p.estoque_disponivel + COALESCE(
+    (SELECT r.quantidade FROM reservas r WHERE r.dono = ? AND r.produto_id = p.id), 0
+  ) FROM produtos p WHERE p.id = ?
+'''
+
+SQL_LIBERAR = 'DELETE FROM reservas WHERE dono = ? AND produto_id = ?'
+SQL_LIBERAR_DONO = 'DELETE FROM reservas WHERE dono = ?'
+SQL_LIBERAR_VENCIDAS_PRODUTO = 'DELETE FROM reservas WHERE produto_id = ? AND expira_em < ?'
+SQL_RENOVAR = 'UPDATE reservas SET expira_em = ? WHERE dono = ?'
+
+# Login: as reservas do visitante passam para o cliente, somando
+SQL_TRANSFERIR = '''
+  INSERT INTO reservas (dono, produto_id, quantidade, expira_em)
+  SELECT ?, v.produto_id, v.quantidade, v.expira_em FROM reservas v
+  WHERE v.dono = ?
+  ON CONFLICT (dono, produto_id) DO UPDATE
+  SET quantidade = quantidade + excluded.quantidade, expira_em = MAX(expira_em, excluded.expira_em)
+'''
+
+SQL_REMOVER_VENCIDAS = '''
+  DELETE FROM reservas
+  WHERE id IN (SELECT id FROM reservas WHERE expira_em < ? LIMIT ?)
+'''
+
+
+def reservar(conexao, dono, produto_id, quantidade):
+  # Define (não soma) a quantidade reservada pelo dono. Roda na transação
+  # de quem chama, junto com a alteração do carrinho.
+  if quantidade <= 0:
+    liberar(conexao, dono, produto_id)
+    return True
+
+  agora = time.time()
+  parametros = {'dono': dono, 'produto_id': produto_id, 'quantidade': quantidade, 'expira_em': agora + RESERVAS_MINUTOS * 60}
+  if conexao.execute(SQL_RESERVAR, parametros).rowcount:
+    return True
+  # Numa venda relâmpago o estoque "acaba" com carrinhos abandonados:
+  # as reservas vencidas do produto voltam antes da limpeza periódica.
+  if conexao.execute(SQL_LIBERAR_VENCIDAS_PRODUTO, (produto_id, agora)).rowcount:
+    return bool(conexao.execute(SQL_RESERVAR, parametros).rowcount)
+  return False
+
+
+def disponivel_para(conexao, dono, produto_id):
+  linha = conexao.execute(SQL_DISPONIVEL, (dono, produto_id)).fetchone()
+  return max(linha[0], 0) if linha else 0
+
+
+def liberar(conexao, dono, produto_id=None):
+  if produto_id is None:
+    return conexao.execute(SQL_LIBERAR_DONO, (dono,)).rowcount
+  return conexao.execute(SQL_LIBERAR, (dono, produto_id)).rowcount
+
+
+def renovar(conexao, dono):
+  conexao.execute(SQL_RENOVAR, (time.time() + RESERVAS_MINUTOS * 60, dono))
+
+
+def transferir(conexao, origem, destino):
+  conexao.execute(SQL_TRANSFERIR, (destino, origem))
+  conexao.execute(SQL_LIBERAR_DONO, (origem,))
+
+
+def remover_reservas_vencidas(conexao, lote=RESERVAS_LIMPEZA_LOTE, pausa=0.01):
+  # Mesmo esquema da limpeza de carrinhos: lotes curtos, lock solto entre eles
+  removidas = 0
+  while True:
+    def remover_lote():
+      cursor = conexao.execute(SQL_REMOVER_VENCIDAS, (time.time(), lote))
+      conexao.commit()
+      return cursor.rowcount
+
+    quantidade = repetir_se_ocupado(remover_lote, conexao=conexao)
+    removidas += quantidade
+    if quantidade < lote:
+      return removidas
+    time.sleep(pausa)
+
+
+_limpeza = {'pid': None}
+_limpeza_lock = threading.Lock()
+
+
+def _laco_limpeza():
+  while True:
+    time.sleep(RESERVAS_LIMPEZA_INTERVALO * (0.5 + random.random()))
+    try:
+      with conexao_dedicada() as conexao:
+        removidas = remover_reservas_vencidas(conexao)
+      if removidas:
+        logger.info('Limpeza de reservas: %s reservas vencidas liberadas', removidas)
+    except Exception:
+      logger.exception('Falha ao liberar reservas vencidas')
+
+
+def iniciar_limpeza_reservas():
+  # Uma thread por processo, criada depois do fork do gunicorn
+  if RESERVAS_LIMPEZA_INTERVALO <= 0 or _limpeza['pid'] == os.getpid():
+    return
+  with _limpeza_lock:
+    if _limpeza['pid'] == os.getpid():
+      return
+    _limpeza['pid'] = os.getpid()
+    threading.Thread(target=_laco_limpeza, name='limpeza-reservas', daemon=True).start()
@@ -0,0 +1,365 @@
+import atexit
+import hashlib
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import namedtuple
+
+import click
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface, SessionInterface
+
+from models.cache import CacheLRU
+from models.metricas import observar
+from models.model import conectar_db, conexao_dedicada, repetir_se_ocupado, transacao_imediata
+
+# cookie: tudo na sessão assinada do Flask (padrão)
+# sqlite: o cookie leva só um id opaco; os dados ficam na tabela sessoes
+# memoria: como sqlite, mas as alterações ficam no worker e vão para o
+#          SQLite em lote a cada SESSAO_GRAVAR_INTERVALO segundos
+SESSAO_BACKEND = os.environ.get('SESSAO_BACKEND', 'cookie')
+SESSAO_DURACAO_HORAS = float(os.environ.get('SESSAO_DURACAO_HORAS', '168'))
+SESSAO_CACHE_TAMANHO = int(os.environ.get('SESSAO_CACHE_TAMANHO', '10000'))
+# Uma sessão revogada em outro processo ainda vale neste por até este tempo
+SESSAO_CACHE_TTL = float(os.environ.get('SESSAO_CACHE_TTL', '30'))
+SESSAO_GRAVAR_INTERVALO = float(os.environ.get('SESSAO_GRAVAR_INTERVALO', '2'))
+
+if SESSAO_BACKEND not in ('cookie', 'sqlite', 'memoria'):
+  raise RuntimeError(f'SESSAO_BACKEND inválido: {SESSAO_BACKEND}')
+
+logger = logging.getLogger(__name__)
+
+RegistroSessao = namedtuple('RegistroSessao', 'versao dados cliente_id expira_em')
+
+SQL_CARREGAR = 'SELECT versao, dados, cliente_id, expira_em FROM sessoes WHERE id = ? AND expira_em > ?'
+
+SQL_GRAVAR = '''
+  INSERT INTO sessoes (id, versao, dados, cliente_id, expira_em) VALUES (?, ?, ?, ?, ?)
+  ON CONFLICT (id) DO UPDATE SET
+    versao = excluded.versao, dados = excluded.dados,
+    cliente_id = excluded.cliente_id, expira_em = excluded.expira_em
+'''
+
+# Só sessões novas são inseridas: atualizar uma que foi revogada ou removida
+# não a traz de volta, e uma versão mais antiga não sobrescreve a mais nova.
+SQL_ATUALIZAR = '''
+  UPDATE sessoes SET versao = ?, dados = ?, cliente_id = ?, expira_em = ?
+  WHERE id = ? AND versao <= ?
+'''
+
+SQL_RENOVAR = 'UPDATE sessoes SET expira_em = ? WHERE id = ?'
+SQL_REMOVER = 'DELETE FROM sessoes WHERE id = ?'
+SQL_REVOGAR = 'DELETE FROM sessoes WHERE cliente_id = ?'
+SQL_REMOVER_EXPIRADAS = 'DELETE FROM sessoes WHERE id IN (SELECT id FROM sessoes WHERE expira_em < ? LIMIT ?)'
+
+
+def _chave(sid):
+  return hashlib.sha256(sid.encode()).hexdigest()
+
+
+def _parametros_atualizar(chave, registro):
+  return (*registro, chave, registro.versao)
+
+
+class SessoesSQLite:
+  def _gravar(self, sql, parametros):
+    # Transação própria: o save_session roda depois da view e não grava o
+    # que ela deixou sem commit. Isso seria desfeito no teardown de todo
+    # jeito; desfeito aqui, não segura o lock de escrita contra a sessão.
+    conexao = conectar_db(escrita=True)
+    if conexao.in_transaction:
+      logger.warning('Alterações sem commit descartadas antes de gravar a sessão')
+      conexao.rollback()
+
+    def gravar():
+      with transacao_imediata(conexao):
+        return conexao.execute(sql, parametros).rowcount
+    return repetir_se_ocupado(gravar, conexao=conexao)
+
+  def carregar(self, chave, versao=0):
+    linha = conectar_db(escrita=True).execute(SQL_CARREGAR, (chave, time.time())).fetchone()
+    return RegistroSessao(*linha) if linha else None
+
+  def gravar(self, chave, registro, imediato=False):
+    if imediato:
+      self._gravar(SQL_GRAVAR, (chave, *registro))
+    else:
+      self._gravar(SQL_ATUALIZAR, _parametros_atualizar(chave, registro))
+
+  def renovar(self, chave, expira_em):
+    self._gravar(SQL_RENOVAR, (expira_em, chave))
+
+  def remover(self, chave):
+    self._gravar(SQL_REMOVER, (chave,))
+
+
+class SessoesMemoria(SessoesSQLite):
+  # Write-behind: gravar() só marca a sessão; uma thread grava o lote.
+  # Sessão nova vai direto ao banco, senão a próxima requisição, em outro
+  # worker, não a encontraria. Remover também é imediato, senão um logout
+  # poderia ser desfeito pelo lote; o lote só atualiza, então também não
+  # desfaz um flask sessoes revogar.
+  def __init__(self):
+    self._pendentes = {}
+    self._lock = threading.Lock()
+    self._pid = None
+
+  def _iniciar(self):
+    if self._pid == os.getpid():
+      return
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._pendentes.clear()
+      atexit.register(self.descarregar)
+      threading.Thread(target=self._laco, name='gravacao-sessoes', daemon=True).start()
+
+  def _laco(self):
+    while True:
+      time.sleep(SESSAO_GRAVAR_INTERVALO)
+      try:
+        self.descarregar()
+      except Exception:
+        logger.exception('Falha ao gravar sessões pendentes')
+
+  def descarregar(self):
+    with self._lock:
+      pendentes, self._pendentes = self._pendentes, {}
+    if not pendentes:
+      return 0
+
+    def gravar_lote():
+      with conexao_dedicada() as conexao:
+        conexao.executemany(SQL_ATUALIZAR, [_parametros_atualizar(chave, registro) for chave, registro in pendentes.items()])
+        conexao.commit()
+    try:
+      repetir_se_ocupado(gravar_lote)
+    except Exception:
+      # Devolve ao lote o que não foi sobrescrito enquanto isso
+      with self._lock:
+        for chave, registro in pendentes.items():
+          self._pendentes.setdefault(chave, registro)
+      raise
+    return len(pendentes)
+
+  def carregar(self, chave, versao=0):
+    with self._lock:
+      registro = self._pendentes.get(chave)
+    # Pendente mais antigo que o cookie: outro worker gravou depois
+    if registro is not None and registro.versao >= versao:
+      return registro
+    return super().carregar(chave, versao)
+
+  def gravar(self, chave, registro, imediato=False):
+    if imediato:
+      with self._lock:
+        self._pendentes.pop(chave, None)
+      super().gravar(chave, registro, imediato=True)
+      return
+    self._iniciar()
+    with self._lock:
+      self._pendentes[chave] = registro
+
+  def renovar(self, chave, expira_em):
+    with self._lock:
+      registro = self._pendentes.get(chave)
+      if registro is not None:
+        self._pendentes[chave] = registro._replace(expira_em=expira_em)
+        return
+    super().renovar(chave, expira_em)
+
+  def remover(self, chave):
+    with self._lock:
+      self._pendentes.pop(chave, None)
+    super().remover(chave)
+
+
+class SessaoServidor(SecureCookieSession):
+  def __init__(self, dados=None, sid=None, registro=None):
+    super().__init__(dados)
+    self.sid = sid
+    self.registro = registro
+
+
+class InterfaceSessaoServidor(SessionInterface):
+  serializador = TaggedJSONSerializer()
+
+  def __init__(self, armazenamento, duracao_horas=SESSAO_DURACAO_HORAS):
+    self.armazenamento = armazenamento
+    self.duracao = duracao_horas * 3600
+    self.cache = CacheLRU(SESSAO_CACHE_TAMANHO, SESSAO_CACHE_TTL)
+
+  def open_session(self, app, request):
+    valor = request.cookies.get(self.get_cookie_name(app))
+    if not valor:
+      return SessaoServidor()
+
+    # cookie = token.versao: a versão diz se o que está no cache do worker
+    # ainda é a última gravação, sem ir ao banco.
+    sid, _, versao = valor.rpartition('.')
+    if not versao.isdigit():
+      return SessaoServidor()
+    chave = _chave(sid)
+    registro = self.cache.obter(chave)
+    if registro is None or registro.versao < int(versao):
+      registro = self._carregar(chave, int(versao))
+
+    if registro is None or registro.expira_em <= time.time():
+      return SessaoServidor()
+    return SessaoServidor(self.serializador.loads(registro.dados), sid, registro)
+
+  def _carregar(self, chave, versao):
+    # Versão guardada menor que a do cookie: a última gravação ainda está no
+    # lote de outro worker (backend memoria). Servir a anterior mostraria de
+    # novo, por exemplo, uma mensagem flash já exibida; espera o lote.
+    limite = time.monotonic() + SESSAO_GRAVAR_INTERVALO * 2
+    pausa = 0.01
+    registro = self.armazenamento.carregar(chave, versao)
+    while registro is not None and registro.versao < versao:
+      if time.monotonic() >= limite:
+        # O lote se perdeu (worker encerrado sem gravar): segue com o que há,
+        # já na versão do cookie para não esperar de novo.
+        logger.warning('Sessão com versão %s guardada e %s no cookie', registro.versao, versao)
+        registro = registro._replace(versao=versao)
+        break
+      time.sleep(pausa)
+      pausa = min(pausa * 2, 0.2)
+      registro = self.armazenamento.carregar(chave, versao)
+    if registro is not None:
+      self.cache.definir(chave, registro)
+    return registro
+
+  def save_session(self, app, session, response):
+    nome = self.get_cookie_name(app)
+    dominio = self.get_cookie_domain(app)
+    caminho = self.get_cookie_path(app)
+
+    if session.accessed:
+      response.vary.add('Cookie')
+
+    if not session:
+      if session.modified and session.sid:
+        self._remover(session.sid)
+        response.delete_cookie(nome, domain=dominio, path=caminho)
+      return
+
+    cliente_id = session.get('cliente_id')
+    if session.sid and session.registro.cliente_id != cliente_id:
+      # Login ou troca de usuário: id novo, o antigo deixa de valer
+      self._remover(session.sid)
+      session.sid = None
+
+    agora = time.time()
+    if session.sid and not session.modified:
+      # Expiração deslizante sem gravar a cada requisição
+      if session.registro.expira_em - agora < self.duracao / 2:
+        expira_em = agora + self.duracao
+        self.armazenamento.renovar(_chave(session.sid), expira_em)
+        self.cache.definir(_chave(session.sid), session.registro._replace(expira_em=expira_em))
+      return
+
+    sid = session.sid or secrets.token_urlsafe(32)
+    versao = session.registro.versao + 1 if session.sid else 1
+    registro = RegistroSessao(versao, self.serializador.dumps(dict(session)), cliente_id, agora + self.duracao)
+    self.armazenamento.gravar(_chave(sid), registro, imediato=versao == 1)
+    self.cache.definir(_chave(sid), registro)
+
+    response.set_cookie(
+      nome,
+      f'{sid}.{versao}',
+      expires=self.get_expiration_time(app, session),
+      httponly=self.get_cookie_httponly(app),
+      domain=dominio,
+      path=caminho,
+      secure=self.get_cookie_secure(app),
+      samesite=self.get_cookie_samesite(app),
+    )
+
+  def _remover(self, sid):
+    self.armazenamento.remover(_chave(sid))
+    self.cache.remover(_chave(sid))
+
+
+class InterfaceSessaoMedida(SessionInterface):
+  # Mede qualquer backend do mesmo jeito, inclusive o cookie assinado
+  def __init__(self, interna, backend):
+    self.interna = interna
+    self.backend = backend
+
+  def make_null_session(self, app):
+    return self.interna.make_null_session(app)
+
+  def is_null_session(self, obj):
+    return self.interna.is_null_session(obj)
+
+  def open_session(self, app, request):
+    inicio = time.perf_counter()
+    sessao = self.interna.open_session(app, request)
+    observar('ecommerce_sessao_segundos', (('backend', self.backend), ('operacao', 'abrir')), time.perf_counter() - inicio)
+    cookie = request.cookies.get(self.get_cookie_name(app))
+    if cookie:
+      observar('ecommerce_sessao_cookie_bytes', (('backend', self.backend), ('sentido', 'recebido')), len(cookie))
+    return sessao
+
+  def save_session(self, app, session, response):
+    inicio = time.perf_counter()
+    self.interna.save_session(app, session, response)
+    observar('ecommerce_sessao_segundos', (('backend', self.backend), ('operacao', 'salvar')), time.perf_counter() - inicio)
+    prefixo = self.get_cookie_name(app) + '='
+    for cabecalho in response.headers.getlist('Set-Cookie'):
+      if cabecalho.startswith(prefixo):
+        valor = cabecalho[len(prefixo):].split(';', 1)[0]
+        observar('ecommerce_sessao_cookie_bytes', (('backend', self.backend), ('sentido', 'enviado')), len(valor))
+
+
+def criar_interface_sessao(backend=SESSAO_BACKEND):
+  if backend == 'cookie':
+    interna = SecureCookieSessionInterface()
+  elif backend == 'memoria':
+    interna = InterfaceSessaoServidor(SessoesMemoria())
+  else:
+    interna = InterfaceSessaoServidor(SessoesSQLite())
+  return InterfaceSessaoMedida(interna, backend)
+
+
+def revogar_sessoes(conexao, cliente_id):
+  # Os caches dos workers expiram em até SESSAO_CACHE_TTL segundos
+  return conexao.execute(SQL_REVOGAR, (cliente_id,)).rowcount
+
+
+def remover_sessoes_expiradas(conexao, lote=1000):
+  removidas = 0
+  while True:
+    def remover_lote():
+      cursor = conexao.execute(SQL_REMOVER_EXPIRADAS, (time.time(), lote))
+      conexao.commit()
+      return cursor.rowcount
+    quantidade = repetir_se_ocupado(remover_lote, conexao=conexao)
+    removidas += quantidade
+    if quantidade < lote:
+      return removidas
+
+
+cli = AppGroup('sessoes', help='Sessões guardadas no servidor.')
+
+
+@cli.command('revogar')
+@click.argument('cliente_id', type=int)
+def revogar_comando(cliente_id):
+  """Encerra todas as sessões de um cliente."""
+  with conexao_dedicada() as conexao:
+    removidas = revogar_sessoes(conexao, cliente_id)
+    conexao.commit()
+  click.echo(f'{removidas} sessões revogadas.')
+
+
+@cli.command('limpar')
+def limpar_comando():
+  """Remove as sessões expiradas."""
+  with conexao_dedicada() as conexao:
+    removidas = remover_sessoes_expiradas(conexao)
+  click.echo(f'{removidas} sessões removidas.')
@@ -0,0 +1,337 @@
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import sqlite3
+import threading
+import time
+
+import click
+from flask.cli import AppGroup
+
+from models.catalogo import invalidar_catalogo
+from models.gateway import obter_gateway
+from models.model import conexao_dedicada, repetir_se_ocupado, transacao_imediata
+
+TAREFAS_INTERVALO = float(os.environ.get('TAREFAS_INTERVALO', '1'))
+TAREFAS_LOTE = int(os.environ.get('TAREFAS_LOTE', '10'))
+TAREFAS_MAX_TENTATIVAS = int(os.environ.get('TAREFAS_MAX_TENTATIVAS', '5'))
+# Espera antes da 2ª tentativa; dobra a cada falha
+TAREFAS_ESPERA_BASE = float(os.environ.get('TAREFAS_ESPERA_BASE', '2'))
+# Tarefa em execução há mais que isso é de um worker que morreu
+TAREFAS_TIMEOUT = float(os.environ.get('TAREFAS_TIMEOUT', '60'))
+# Concluídas ficam este tempo na tabela e depois são apagadas pelo worker
+# (0 = guarda para sempre). A chave só evita duplicatas enquanto a tarefa
+# existe; os próprios handlers conferem o status do pedido.
+TAREFAS_RETENCAO_HORAS = float(os.environ.get('TAREFAS_RETENCAO_HORAS', '168'))
+TAREFAS_LIMPEZA_INTERVALO = float(os.environ.get('TAREFAS_LIMPEZA_INTERVALO', '600'))
+TAREFAS_LIMPEZA_LOTE = int(os.environ.get('TAREFAS_LIMPEZA_LOTE', '500'))
+
+logger = logging.getLogger(__name__)
+
+TIPOS = {}
+
+
+def tarefa(tipo):
+  def registrar(funcao):
+    TIPOS[tipo] = funcao
+    return funcao
+  return registrar
+
+
+class ErroDefinitivo(Exception):
+  # Falha que não se resolve tentando de novo
+  pass
+
+
+SQL_ENFILEIRAR = '''
+  INSERT INTO tarefas (tipo, dados, chave, max_tentativas, executar_em)
+  VALUES (?, ?, ?, ?, ?)
+  ON CONFLICT (chave) DO NOTHING
+'''
+
+SQL_LIBERAR_TRAVADAS = '''
+  UPDATE tarefas
+  SET status = CASE WHEN tentativas >= max_tentativas THEN 'falhou' ELSE 'pendente' END,
+      erro = 'tempo de execução esgotado', travada_ate = NULL, executar_em = ?
+  WHERE status = 'executando' AND travada_ate < ?
+'''
+
+SQL_RESERVAR = '''
+  UPDATE tarefas
+  SET status = 'executando', travada_ate = ?, tentativas = tentativas + 1
+  WHERE id IN (
+    SELECT id FROM tarefas
+    WHERE status = 'pendente' AND executar_em <= ?
+    ORDER BY executar_em LIMIT ?
+  )
+  RETURNING id, tipo, dados, tentativas, max_tentativas
+'''
+
+SQL_CONCLUIR = '''
+  UPDATE tarefas SET status = 'concluida', concluida_em = CURRENT_TIMESTAMP, travada_ate = NULL, erro = NULL
+  WHERE id = ?
+'''
+
+SQL_FALHAR = '''
+  UPDATE tarefas SET status = ?, executar_em = ?, erro = ?, travada_ate = NULL
+  WHERE id = ?
+'''
+
+SQL_REPROCESSAR = '''
+  UPDATE tarefas SET status = 'pendente', tentativas = 0, executar_em = ?, erro = NULL
+  WHERE status = 'falhou' AND (? IS NULL OR tipo = ?)
+'''
+
+SQL_REMOVER_CONCLUIDAS = '''
+  DELETE FROM tarefas
+  WHERE id IN (
+    SELECT id FROM tarefas
+    WHERE status = 'concluida' AND concluida_em < datetime('now', ?)
+    LIMIT ?
+  )
+'''
+
+
+def enfileirar(conexao, tipo, dados, chave=None, atraso=0, max_tentativas=TAREFAS_MAX_TENTATIVAS):
+  # Roda na transação de quem chama: a tarefa só existe se o que a gerou
+  # também for gravado. A mesma chave nunca é enfileirada duas vezes.
+  cursor = conexao.execute(
+    SQL_ENFILEIRAR,
+    (tipo, json.dumps(dados), chave, max_tentativas, time.time() + atraso)
+  )
+  return cursor.lastrowid if cursor.rowcount else None
+
+
+def reservar(conexao, lote=TAREFAS_LOTE):
+  def reservar_lote():
+    agora = time.time()
+    with transacao_imediata(conexao):
+      conexao.execute(SQL_LIBERAR_TRAVADAS, (agora, agora))
+      return conexao.execute(SQL_RESERVAR, (agora + TAREFAS_TIMEOUT, agora, lote)).fetchall()
+  return repetir_se_ocupado(reservar_lote)
+
+
+def _concluir(conexao, tarefa_id):
+  def concluir():
+    with transacao_imediata(conexao):
+      conexao.execute(SQL_CONCLUIR, (tarefa_id,))
+  repetir_se_ocupado(concluir)
+
+
+def _falhar(conexao, reservada, erro):
+  definitiva = isinstance(erro, ErroDefinitivo) or reservada['tentativas'] >= reservada['max_tentativas']
+  espera = TAREFAS_ESPERA_BASE * 2 ** (reservada['tentativas'] - 1) * (0.5 + random.random())
+  status = 'falhou' if definitiva else 'pendente'
+
+  def falhar():
+    with transacao_imediata(conexao):
+      conexao.execute(SQL_FALHAR, (status, time.time() + espera, f'{type(erro).__name__}: {erro}', reservada['id']))
+  repetir_se_ocupado(falhar)
+  return status
+
+
+def executar(conexao, reservada):
+  funcao = TIPOS.get(reservada['tipo'])
+  try:
+    if funcao is None:
+      raise ErroDefinitivo(f'Tipo de tarefa desconhecido: {reservada["tipo"]}')
+    funcao(conexao, json.loads(reservada['dados']))
+  except Exception as e:
+    if conexao.in_transaction:
+      conexao.rollback()
+    status = _falhar(conexao, reservada, e)
+    logger.warning(
+      'Tarefa %s (%s) falhou na tentativa %s/%s: %s -> %s',
+      reservada['id'], reservada['tipo'], reservada['tentativas'], reservada['max_tentativas'], e, status
+    )
+    return False
+
+  _concluir(conexao, reservada['id'])
+  return True
+
+
+def executar_pendentes(conexao, lote=TAREFAS_LOTE):
+  reservadas = reservar(conexao, lote)
+  for reservada in reservadas:
+    executar(conexao, reservada)
+  return len(reservadas)
+
+
+def remover_concluidas(conexao, retencao_horas=TAREFAS_RETENCAO_HORAS, lote=TAREFAS_LIMPEZA_LOTE, pausa=0.01):
+  # Lotes curtos, como a limpeza de carrinhos: o lock de escrita é solto
+  # entre eles e o checkout não espera a limpeza inteira
+  removidas = 0
+  while True:
+    def remover_lote():
+      cursor = conexao.execute(SQL_REMOVER_CONCLUIDAS, (f'-{retencao_horas} hours', lote))
+      conexao.commit()
+      return cursor.rowcount
+
+    quantidade = repetir_se_ocupado(remover_lote, conexao=conexao)
+    removidas += quantidade
+    if quantidade < lote:
+      return removidas
+    time.sleep(pausa)
+
+
+def trabalhar(parar, intervalo=TAREFAS_INTERVALO, uma_vez=False):
+  # jitter para vários processos não limparem juntos
+  proxima_limpeza = time.monotonic() + TAREFAS_LIMPEZA_INTERVALO * random.random()
+  with conexao_dedicada() as conexao:
+    while not parar.is_set():
+      try:
+        executadas = executar_pendentes(conexao)
+      except sqlite3.Error:
+        logger.exception('Falha ao reservar tarefas')
+        executadas = 0
+      if TAREFAS_RETENCAO_HORAS > 0 and time.monotonic() >= proxima_limpeza:
+        proxima_limpeza = time.monotonic() + TAREFAS_LIMPEZA_INTERVALO
+        try:
+          removidas = remover_concluidas(conexao)
+          if removidas:
+            logger.info('Limpeza da fila: %s tarefas concluídas removidas', removidas)
+        except sqlite3.Error:
+          logger.exception('Falha ao remover tarefas concluídas')
+      if not executadas:
+        if uma_vez:
+          return
+        parar.wait(intervalo)
+
+
+def _processo_trabalhador(intervalo, uma_vez):
+  parar = threading.Event()
+  # Termina a tarefa atual antes de sair
+  signal.signal(signal.SIGTERM, lambda *_: parar.set())
+  signal.signal(signal.SIGINT, lambda *_: parar.set())
+  trabalhar(parar, intervalo, uma_vez)
+
+
+SQL_PAGAMENTO = '''
+  SELECT pg.tipo, pg.valor, pg.status FROM pagamentos pg WHERE pg.pedido_id = ?
+'''
+
+SQL_APROVAR_PAGAMENTO = "UPDATE pagamentos SET status = 'aprovado' WHERE pedido_id = ? AND status = 'aguardando'"
+SQL_RECUSAR_PAGAMENTO = "UPDATE pagamentos SET status = 'recusado' WHERE pedido_id = ? AND status = 'aguardando'"
+
+SQL_DEVOLVER_ESTOQUE = '''
+  UPDATE produtos
+  SET estoque = estoque + (
+    SELECT SUM(ip.quantidade) FROM itens_pedido ip
+    WHERE ip.pedido_id = ? AND ip.produto_id = produtos.id
+  )
+  WHERE id IN (SELECT produto_id FROM itens_pedido WHERE pedido_id = ?)
+'''
+
+SQL_DADOS_CONFIRMACAO = '''
+  SELECT p.id, p.total, c.nome, c.email
+  FROM pedidos p
+  JOIN clientes c ON c.id = p.cliente_id
+  WHERE p.id = ?
+'''
+
+
+@tarefa('confirmar_pagamento')
+def confirmar_pagamento(conexao, dados):
+  pedido_id = dados['pedido_id']
+  pagamento = conexao.execute(SQL_PAGAMENTO, (pedido_id,)).fetchone()
+  if pagamento is None:
+    raise ErroDefinitivo(f'Pedido {pedido_id} sem pagamento')
+  if pagamento['status'] != 'aguardando':
+    return
+
+  # Fora da transação: a espera pelo gateway não segura o lock de escrita
+  resultado = obter_gateway().cobrar(f'pagamento:{pedido_id}', pagamento['valor'], pagamento['tipo'])
+
+  def registrar():
+    with transacao_imediata(conexao):
+      if resultado['status'] == 'aprovado':
+        if conexao.execute(SQL_APROVAR_PAGAMENTO, (pedido_id,)).rowcount:
+          conexao.execute("UPDATE pedidos SET status = 'confirmado' WHERE id = ?", (pedido_id,))
+          enfileirar(conexao, 'enviar_confirmacao', {'pedido_id': pedido_id}, chave=f'confirmacao:{pedido_id}')
+      elif conexao.execute(SQL_RECUSAR_PAGAMENTO, (pedido_id,)).rowcount:
+        # Pedido cancelado devolve ao estoque o que o checkout baixou
+        conexao.execute("UPDATE pedidos SET status = 'cancelado' WHERE id = ?", (pedido_id,))
+        conexao.execute(SQL_DEVOLVER_ESTOQUE, (pedido_id, pedido_id))
+        invalidar_catalogo(conexao)
+  repetir_se_ocupado(registrar)
+
+
+@tarefa('enviar_confirmacao')
+def enviar_confirmacao(conexao, dados):
+  pedido = conexao.execute(SQL_DADOS_CONFIRMACAO, (dados['pedido_id'],)).fetchone()
+  if pedido is None:
+    raise ErroDefinitivo(f'Pedido {dados["pedido_id"]} não encontrado')
+  # Sem servidor de e-mail configurado a mensagem vai para o log
+  logger.info(
+    'E-mail para %s <%s>: pedido #%s confirmado, total R$ %.2f',
+    pedido['nome'], pedido['email'], pedido['id'], pedido['total'] or 0
+  )
+
+
+cli = AppGroup('tarefas', help='Fila de tarefas em segundo plano.')
+
+
+@cli.command('worker')
+@click.option('--processos', type=int, default=1, show_default=True, help='Processos consumindo a fila.')
+@click.option('--intervalo', type=float, default=TAREFAS_INTERVALO, show_default=True, help='Segundos entre consultas com a fila vazia.')
+@click.option('--uma-vez', is_flag=True, help='Sai quando não houver mais tarefas vencidas.')
+def worker_comando(processos, intervalo, uma_vez):
+  """Executa as tarefas da fila até receber SIGTERM/SIGINT."""
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(process)d %(levelname)s %(message)s')
+  if processos <= 1:
+    _processo_trabalhador(intervalo, uma_vez)
+    return
+
+  contexto = multiprocessing.get_context('fork')
+  filhos = [
+    contexto.Process(target=_processo_trabalhador, args=(intervalo, uma_vez), name=f'tarefas-{i}')
+    for i in range(processos)
+  ]
+  for filho in filhos:
+    filho.start()
+
+  def repassar(sinal, _):
+    for filho in filhos:
+      if filho.is_alive():
+        os.kill(filho.pid, sinal)
+  signal.signal(signal.SIGTERM, repassar)
+  signal.signal(signal.SIGINT, repassar)
+  for filho in filhos:
+    filho.join()
+
+
+@cli.command('status')
+def status_comando():
+  """Mostra quantas tarefas há em cada estado."""
+  with conexao_dedicada(somente_leitura=True) as conexao:
+    linhas = conexao.execute('''
+      SELECT tipo, status, COUNT(*) AS quantidade FROM tarefas
+      GROUP BY tipo, status ORDER BY tipo, status
+      -- varredura intencional: relatório da fila inteira
+    ''').fetchall()
+  for linha in linhas:
+    click.echo(f'{linha["tipo"]:24} {linha["status"]:12} {linha["quantidade"]}')
+  if not linhas:
+    click.echo('Fila vazia.')
+
+
+@cli.command('reprocessar')
+@click.option('--tipo', help='Só as tarefas deste tipo.')
+def reprocessar_comando(tipo):
+  """Devolve à fila as tarefas que esgotaram as tentativas."""
+  with conexao_dedicada() as conexao:
+    with transacao_imediata(conexao):
+      cursor = conexao.execute(SQL_REPROCESSAR, (time.time(), tipo, tipo))
+  click.echo(f'{cursor.rowcount} tarefas devolvidas à fila.')
+
+
+@cli.command('limpar')
+@click.option('--retencao-horas', type=float, default=TAREFAS_RETENCAO_HORAS, show_default=True, help='Idade mínima das concluídas removidas.')
+def limpar_comando(retencao_horas):
+  """Remove as tarefas concluídas há mais tempo que a retenção."""
+  with conexao_dedicada() as conexao:
+    removidas = remover_concluidas(conexao, retencao_horas)
+  click.echo(f'{removidas} tarefas removidas.')
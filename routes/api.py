@@ -0,0 +1,301 @@
+import json
+import sqlite3
+from functools import wraps
+
+from flask import Blueprint, Response, g, request, session
+
+from models.model import conectar_db, repetir_se_ocupado, lendo_da_replica, somente_leitura, banco_ocupado
+from models.catalogo import listar_disponiveis, buscar_produtos, decodificar_cursor, por_pagina_valido, obter_produto, descartar_cache_local
+from models.carrinho import Dono, dono_carrinho, obter_armazenamento, resolver_lote, EstoqueIndisponivel, LoteInvalido
+from models.limites import vaga_checkout
+from models.pedidos import finalizar_pedido, listar_pedidos, PEDIDOS_POR_PAGINA, CarrinhoVazio, EstoqueInsuficiente
+
+# orjson serializa várias vezes mais rápido; sem ele, json da biblioteca padrão
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CAMPOS_PRODUTO = ('id', 'nome', 'descricao', 'preco', 'estoque')
+CAMPOS_ITEM = ('id', 'produto_id', 'nome_produto', 'preco_unitario', 'quantidade', 'subtotal')
+ACOES_LOTE = ('adicionar', 'atualizar', 'remover')
+LOTE_MAXIMO = 100
+PEDIDOS_POR_PAGINA_MAXIMO = 100
+
+SQL_PEDIDO = '''
+    SELECT p.id, p.data, p.status, p.total, pg.tipo as pagamento_tipo, pg.status as pagamento_status
+    FROM pedidos p
+    LEFT JOIN pagamentos pg ON pg.pedido_id = p.id
+    WHERE p.id = ? AND p.cliente_id = ?
+'''
+
+SQL_ITENS_PEDIDO = '''
+    SELECT ip.produto_id, pr.nome as produto_nome, ip.quantidade, ip.preco_unitario
+    FROM itens_pedido ip
+    JOIN produtos pr ON ip.produto_id = pr.id
+    WHERE ip.pedido_id = ?
+'''
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+class RequisicaoInvalida(Exception):
+    pass
+
+
+def serializar(dados):
+    if orjson is not None:
+        return orjson.dumps(dados)
+    return json.dumps(dados, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def resposta(dados, status=200, cabecalhos=None):
+    return Response(serializar(dados), status=status, headers=cabecalhos, mimetype='application/json')
+
+
+def erro(mensagem, status, **extras):
+    return resposta(dict(extras, erro=mensagem), status)
+
+
+@api.errorhandler(RequisicaoInvalida)
+def requisicao_invalida(e):
+    return erro(str(e), 400)
+
+
+@api.errorhandler(sqlite3.Error)
+def erro_banco(e):
+    if isinstance(e, sqlite3.OperationalError) and banco_ocupado(e):
+        return erro('Banco de dados ocupado, tente novamente.', 503)
+    return erro('Erro no banco de dados.', 500)
+
+
+def login_obrigatorio(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'cliente_id' not in session:
+            return erro('Login necessário.', 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def corpo_json():
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        raise RequisicaoInvalida('Corpo JSON inválido.')
+    return dados
+
+
+def inteiro(dados, campo, minimo=1):
+    valor = dados.get(campo)
+    # bool é int em Python, mas true não é uma quantidade
+    if not isinstance(valor, int) or isinstance(valor, bool) or valor < minimo:
+        raise RequisicaoInvalida(f'Campo "{campo}" deve ser um inteiro >= {minimo}.')
+    return valor
+
+
+def campos_pedidos():
+    # ?campos=id,nome,preco: a resposta leva só o que o cliente vai usar
+    texto = request.args.get('campos')
+    if not texto:
+        return CAMPOS_PRODUTO
+    campos = tuple(dict.fromkeys(campo.strip() for campo in texto.split(',') if campo.strip()))
+    invalidos = [campo for campo in campos if campo not in CAMPOS_PRODUTO]
+    if invalidos or not campos:
+        raise RequisicaoInvalida(f'Campos inválidos: {", ".join(invalidos)}. Use {", ".join(CAMPOS_PRODUTO)}.')
+    return campos
+
+
+def recortar(registro, campos):
+    return {campo: registro[campo] for campo in campos}
+
+
+def conteudo_carrinho(armazenamento, dono):
+    itens = [recortar(item, CAMPOS_ITEM) for item in armazenamento.listar(dono)] if dono else []
+    return {'itens': itens, 'total': round(sum(item['subtotal'] for item in itens), 2)}
+
+
+def sem_estoque(dono, produto_id, solicitado):
+    disponivel = obter_armazenamento().disponivel(dono, produto_id)
+    return erro('Estoque insuficiente.', 409, produto_id=produto_id, solicitado=solicitado, disponivel=disponivel)
+
+
+@api.route('/produtos')
+@somente_leitura(replica=True)
+def produtos():
+    campos = campos_pedidos()
+    busca = request.args.get('q', '').strip()
+    cursor = request.args.get('cursor')
+    apos = decodificar_cursor(cursor)
+    if cursor and apos is None:
+        raise RequisicaoInvalida('Cursor inválido.')
+    por_pagina = por_pagina_valido(request.args.get('por_pagina', type=int))
+
+    conexao = conectar_db()
+    if busca:
+        lista, proximo = buscar_produtos(conexao, busca, apos, por_pagina)
+    else:
+        lista, proximo = listar_disponiveis(conexao, apos, por_pagina)
+    return resposta({'produtos': [recortar(produto, campos) for produto in lista], 'proximo': proximo})
+
+
+@api.route('/produtos/<int:produto_id>')
+@somente_leitura(replica=True)
+def produto(produto_id):
+    campos = campos_pedidos()
+    encontrado = obter_produto(conectar_db(), produto_id)
+    if encontrado is None:
+        return erro('Produto não encontrado.', 404)
+    return resposta(recortar(encontrado, campos))
+
+
+@api.route('/carrinho')
+@somente_leitura()
+def carrinho():
+    return resposta(conteudo_carrinho(obter_armazenamento(), dono_carrinho()))
+
+
+@api.route('/carrinho/itens', methods=['POST'])
+def adicionar_item():
+    dados = corpo_json()
+    produto_id = inteiro(dados, 'produto_id')
+    quantidade = inteiro(dados, 'quantidade')
+    encontrado = conectar_db().execute('SELECT id, nome, preco FROM produtos WHERE id = ?', (produto_id,)).fetchone()
+    if encontrado is None:
+        return erro('Produto não encontrado.', 404, produto_id=produto_id)
+
+    armazenamento = obter_armazenamento()
+    dono = dono_carrinho(criar=True)
+    adicionado, nova_quantidade = repetir_se_ocupado(lambda: armazenamento.adicionar(dono, encontrado, quantidade))
+    if not adicionado:
+        return sem_estoque(dono, produto_id, nova_quantidade)
+    return resposta(conteudo_carrinho(armazenamento, dono))
+
+
+@api.route('/carrinho/itens/<int:item_id>', methods=['PATCH'])
+def atualizar_item(item_id):
+    quantidade = inteiro(corpo_json(), 'quantidade')
+    armazenamento = obter_armazenamento()
+    dono = dono_carrinho()
+    item = armazenamento.obter_item(dono, item_id) if dono else None
+    if item is None:
+        return erro('Item não está no carrinho.', 404, item_id=item_id)
+    if not repetir_se_ocupado(lambda: armazenamento.atualizar(dono, item_id, quantidade)):
+        return sem_estoque(dono, item['produto_id'], quantidade)
+    return resposta(conteudo_carrinho(armazenamento, dono))
+
+
+@api.route('/carrinho/itens/<int:item_id>', methods=['DELETE'])
+def remover_item(item_id):
+    armazenamento = obter_armazenamento()
+    dono = dono_carrinho()
+    if dono is None or armazenamento.obter_item(dono, item_id) is None:
+        return erro('Item não está no carrinho.', 404, item_id=item_id)
+    repetir_se_ocupado(lambda: armazenamento.remover(dono, item_id))
+    return resposta(conteudo_carrinho(armazenamento, dono))
+
+
+def operacoes_lote(dados):
+    operacoes = dados.get('operacoes')
+    if not isinstance(operacoes, list) or not 0 < len(operacoes) <= LOTE_MAXIMO:
+        raise RequisicaoInvalida(f'"operacoes" deve ser uma lista com 1 a {LOTE_MAXIMO} itens.')
+    resultado = []
+    for indice, operacao in enumerate(operacoes):
+        acao = operacao.get('acao') if isinstance(operacao, dict) else None
+        if acao not in ACOES_LOTE:
+            raise RequisicaoInvalida(f'Operação {indice}: "acao" deve ser {", ".join(ACOES_LOTE)}.')
+        if acao == 'adicionar':
+            resultado.append((acao, inteiro(operacao, 'produto_id'), inteiro(operacao, 'quantidade')))
+        elif acao == 'atualizar':
+            resultado.append((acao, inteiro(operacao, 'item_id'), inteiro(operacao, 'quantidade')))
+        else:
+            resultado.append((acao, inteiro(operacao, 'item_id'), 0))
+    return resultado
+
+
+@api.route('/carrinho/lote', methods=['POST'])
+def carrinho_lote():
+    # Várias alterações numa requisição e numa transação: se um produto
+    # não tem estoque, nenhuma delas é aplicada.
+    operacoes = operacoes_lote(corpo_json())
+    armazenamento = obter_armazenamento()
+    dono = dono_carrinho(criar=True)
+    itens = armazenamento.listar(dono)
+    try:
+        alteracoes = resolver_lote(itens, operacoes)
+    except LoteInvalido as e:
+        return erro(str(e), 404, operacao=e.indice)
+
+    atuais = {item['produto_id'] for item in itens}
+    novos = [produto_id for produto_id, quantidade in alteracoes.items() if quantidade and produto_id not in atuais]
+    produtos_novos = {}
+    if novos:
+        marcadores = ', '.join('?' * len(novos))
+        linhas = conectar_db().execute(f'SELECT id, nome, preco FROM produtos WHERE id IN ({marcadores})', novos).fetchall()
+        produtos_novos = {linha['id']: linha for linha in linhas}
+        for produto_id in novos:
+            if produto_id not in produtos_novos:
+                return erro('Produto não encontrado.', 404, produto_id=produto_id)
+
+    try:
+        repetir_se_ocupado(lambda: armazenamento.aplicar_lote(dono, alteracoes, produtos_novos))
+    except EstoqueIndisponivel as e:
+        return sem_estoque(dono, e.produto_id, alteracoes[e.produto_id])
+    return resposta(conteudo_carrinho(armazenamento, dono))
+
+
+@api.route('/checkout', methods=['POST'])
+@login_obrigatorio
+def checkout():
+    tipo_pagamento = corpo_json().get('tipo_pagamento')
+    if not tipo_pagamento or not isinstance(tipo_pagamento, str):
+        raise RequisicaoInvalida('Informe "tipo_pagamento".')
+
+    conexao = conectar_db()
+    cliente_id = session['cliente_id']
+    armazenamento = obter_armazenamento()
+    with vaga_checkout() as admitido:
+        if not admitido:
+            return resposta({'erro': 'Muitos pedidos em processamento, tente novamente.'}, 503, {'Retry-After': '1'})
+        try:
+            pedido_id = repetir_se_ocupado(
+                lambda: finalizar_pedido(conexao, cliente_id, tipo_pagamento, armazenamento)
+            )
+        except CarrinhoVazio:
+            return erro('Seu carrinho está vazio.', 409)
+        except EstoqueInsuficiente as e:
+            return erro(str(e), 409)
+
+    armazenamento.esvaziar(Dono(cliente_id, None))
+    descartar_cache_local()
+    pedido = conexao.execute(SQL_PEDIDO, (pedido_id, cliente_id)).fetchone()
+    return resposta(dict(pedido), 201)
+
+
+@api.route('/pedidos')
+@login_obrigatorio
+@somente_leitura()
+def pedidos():
+    antes = request.args.get('antes', type=int)
+    por_pagina = request.args.get('por_pagina', type=int) or PEDIDOS_POR_PAGINA
+    por_pagina = max(1, min(por_pagina, PEDIDOS_POR_PAGINA_MAXIMO))
+    lista, proximo = listar_pedidos(conectar_db(), session['cliente_id'], antes, por_pagina)
+    return resposta({'pedidos': lista, 'proximo': proximo})
+
+
+@api.route('/pedidos/<int:pedido_id>')
+@login_obrigatorio
+@somente_leitura(replica=True)
+def pedido(pedido_id):
+    cliente_id = session['cliente_id']
+    for tentativa in range(2):
+        conexao = conectar_db()
+        encontrado = conexao.execute(SQL_PEDIDO, (pedido_id, cliente_id)).fetchone()
+        # Pedido recém-criado ainda não copiado para a réplica: lê do principal
+        if encontrado or not lendo_da_replica():
+            break
+        g.leitura = 'ro'
+
+    if encontrado is None:
+        return erro('Pedido não encontrado.', 404)
+    itens = [dict(item) for item in conexao.execute(SQL_ITENS_PEDIDO, (pedido_id,))]
+    return resposta(dict(encontrado, itens=itens))